@@ -0,0 +1,114 @@
+"""Micro-benchmark of the data path of the protocols.
+
+Forwards data from a socket to another one, either with
+:func:`vaurien.util.get_data` (a new string per chunk) or with
+:func:`vaurien.util.get_data_into` and a preallocated buffer from a
+:class:`vaurien.util.BufferPool` (what the built-in protocols do), for
+1 KB, 8 KB and 64 KB chunks.
+
+When the tracemalloc module is available, the peak of memory allocated
+while forwarding is reported as well.
+
+Usage::
+
+    $ python bench_buffers.py --total 64
+"""
+import argparse
+import time
+
+import gevent
+from gevent import socket
+
+from vaurien.util import get_data, get_data_into, BufferPool
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+SIZES = (1024, 8192, 65536)
+
+
+def feed(sock, total, size):
+    chunk = 'x' * size
+    try:
+        for i in xrange(total // size):
+            sock.sendall(chunk)
+    finally:
+        sock.close()
+
+
+def drain(sock):
+    buffer = bytearray(65536)
+    while sock.recv_into(buffer):
+        pass
+
+
+def forward_strings(source, dest, size, pool):
+    chunks = 0
+    while True:
+        data = get_data(source, size)
+        if not data:
+            return chunks
+        dest.sendall(data)
+        chunks += 1
+
+
+def forward_buffers(source, dest, size, pool):
+    chunks = 0
+    buffer, view = pool.get(source)
+    while True:
+        read = get_data_into(source, view, size)
+        if not read:
+            pool.put(source)
+            return chunks
+        dest.sendall(view[:read])
+        chunks += 1
+
+
+def run(forward, total, size):
+    src_w, src_r = socket.socketpair()
+    dst_w, dst_r = socket.socketpair()
+    pool = BufferPool(size)
+    greens = [gevent.spawn(feed, src_w, total, size),
+              gevent.spawn(drain, dst_r)]
+
+    if tracemalloc is not None:
+        tracemalloc.start()
+    start = time.time()
+    chunks = forward(src_r, dst_w, size, pool)
+    duration = time.time() - start
+    if tracemalloc is not None:
+        allocated = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    else:
+        allocated = None
+
+    dst_w.close()
+    gevent.joinall(greens)
+    src_r.close()
+    dst_r.close()
+    return duration, chunks, allocated
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--total', type=int, default=64,
+                        help='Megabytes forwarded for each run')
+    args = parser.parse_args()
+    total = args.total * 1024 * 1024
+
+    for size in SIZES:
+        for name, forward in (('strings', forward_strings),
+                              ('buffers', forward_buffers)):
+            duration, chunks, allocated = run(forward, total, size)
+            line = '%6d bytes  %-8s %8.1f MB/s %8.2f us/chunk' % (
+                size, name, args.total / duration, duration * 1e6 / chunks)
+            if allocated is not None:
+                line += ' %8.1f KB allocated (peak)' % (allocated / 1024.)
+            print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""Micro-benchmark of the connection engines.
+
+Pushes small chunks one at a time through a *tcp* proxy to an echo
+backend, and reports the time spent per chunk with the *select* engine
+(a select() and a greenlet per readable socket, for every chunk) and the
+*pump* engine (two long-lived loops per connection), with and without
+the splice(2) passthrough.
+
+Usage::
+
+    $ python bench_engine.py --chunks 20000 --size 64
+"""
+import argparse
+import time
+
+import gevent
+from gevent.server import StreamServer
+from gevent.socket import create_connection, IPPROTO_TCP, TCP_NODELAY
+
+from vaurien import logger
+from vaurien.config import DEFAULT_SETTINGS
+from vaurien.proxy import DefaultProxy
+from vaurien.run import build_parser
+
+
+def echo(sock, address):
+    sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+    try:
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            sock.sendall(data)
+    finally:
+        sock.close()
+
+
+def run_engine(engine, backend, port, chunks, size, options=()):
+    args = build_parser().parse_args(['--protocol-tcp-keep-alive'] +
+                                     list(options))
+    settings = DEFAULT_SETTINGS.copy()
+    settings['vaurien.engine'] = engine
+    settings['args'] = args
+
+    proxy = DefaultProxy(proxy='localhost:%d' % port,
+                         backend='localhost:%d' % backend,
+                         protocol='tcp', settings=settings, logger=logger)
+    proxy.start()
+    try:
+        sock = create_connection(('localhost', port))
+        sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        chunk = 'x' * size
+        start = time.time()
+        for i in xrange(chunks):
+            sock.sendall(chunk)
+            received = 0
+            while received < size:
+                received += len(sock.recv(size - received))
+        duration = time.time() - start
+        sock.close()
+    finally:
+        proxy.stop()
+
+    return duration
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--chunks', type=int, default=20000)
+    parser.add_argument('--size', type=int, default=64)
+    parser.add_argument('--port', type=int, default=8010)
+    parser.add_argument('--backend-port', type=int, default=8020)
+    args = parser.parse_args()
+
+    backend = StreamServer(('localhost', args.backend_port), echo)
+    backend.start()
+
+    try:
+        results = {}
+        runs = (('select', 'select', ()),
+                ('pump', 'pump', ()),
+                ('splice', 'pump', ('--protocol-tcp-splice',)))
+        for index, (name, engine, options) in enumerate(runs):
+            duration = run_engine(engine, args.backend_port,
+                                  args.port + index, args.chunks, args.size,
+                                  options)
+            results[name] = duration
+            print('%-7s %8.2f us/chunk %10d chunks/s'
+                  % (name, duration * 1e6 / args.chunks,
+                     args.chunks / duration))
+            gevent.sleep(.1)
+    finally:
+        backend.stop()
+
+    for name in ('pump', 'splice'):
+        print('%s: %.1f%% of the select engine time per chunk'
+              % (name, results[name] * 100. / results['select']))
+
+
+if __name__ == '__main__':
+    main()
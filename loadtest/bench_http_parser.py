@@ -0,0 +1,59 @@
+"""Micro-benchmark of the HTTP parsers.
+
+The messages recorded in *corpus/http-requests.txt* and
+*corpus/http-responses.txt* are framed and parsed over and over with
+every header block parser available, the way the http protocol does it:
+the header block is accumulated and parsed once, the body is skipped.
+
+Usage::
+
+    $ python bench_http_parser.py --rounds 20000
+"""
+import argparse
+import os
+import time
+
+from vaurien.protocols.http import MessageParser, HEAD_PARSERS
+
+
+_CORPUS = os.path.join(os.path.dirname(__file__), 'corpus')
+
+
+def frame(data, requests, parse_head, rounds):
+    """Frames *data* *rounds* times, returns the number of messages."""
+    buffer = bytearray(data)
+    size = len(buffer)
+    count = 0
+    for i in xrange(rounds):
+        parser = MessageParser(requests=requests, parse_head=parse_head)
+        pos = 0
+        while pos < size:
+            pos = parser.feed_head(buffer, pos, size)
+            parser.parse()
+            pos = parser.feed_body(buffer, pos, size)
+            parser.reset()
+            count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rounds', type=int, default=20000)
+    options = parser.parse_args()
+
+    for kind in ('requests', 'responses'):
+        with open(os.path.join(_CORPUS, 'http-%s.txt' % kind), 'rb') as f:
+            data = f.read()
+        print('%s: %d bytes' % (kind, len(data)))
+        for name, parse_head in HEAD_PARSERS:
+            start = time.time()
+            count = frame(data, kind == 'requests', parse_head,
+                          options.rounds)
+            duration = time.time() - start
+            print('  %-12s %8.0f messages/s %7.1f MB/s'
+                  % (name, count / duration,
+                     len(data) * options.rounds / duration / 1024 / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""Micro-benchmark of the per-chunk cost of the behavior settings.
+
+*before* replays what the proxy used to do for every chunk: extracting
+the behavior settings from the command-line arguments, updating the
+behavior settings with them, and converting the raw values every time an
+option is read. *after* is what happens now: the options are compiled
+once, and reading them is an attribute lookup.
+
+Usage::
+
+    $ python bench_options.py --chunks 100000
+"""
+import argparse
+import time
+
+from vaurien.behaviors import get_behaviors
+from vaurien.run import build_parser
+from vaurien.util import extract_settings, convert_option
+
+
+def before(behavior, args, chunks):
+    settings = {}
+    options = behavior.options
+    for i in xrange(chunks):
+        settings.update(extract_settings(args, 'behavior', 'delay'))
+        for name in ('before', 'sleep'):
+            type_, default = options[name][1:3]
+            convert_option(settings.get(name, default), type_)
+
+
+def after(behavior, args, chunks):
+    for i in xrange(chunks):
+        behavior.option('before')
+        behavior.option('sleep')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--chunks', type=int, default=100000)
+    options = parser.parse_args()
+
+    args = build_parser().parse_args([])
+    behavior = get_behaviors()['delay']
+    behavior.update_settings(extract_settings(args, 'behavior', 'delay'))
+
+    results = {}
+    for name, func in (('before', before), ('after', after)):
+        start = time.time()
+        func(behavior, args, options.chunks)
+        results[name] = time.time() - start
+        print('%-7s %8.3f us/chunk' % (name, results[name] * 1e6 /
+                                       options.chunks))
+
+    print('after: %.1f%% of the time per chunk'
+          % (results['after'] * 100. / results['before']))
+
+
+if __name__ == '__main__':
+    main()
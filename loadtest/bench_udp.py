@@ -0,0 +1,95 @@
+"""Micro-benchmark of the UDP proxy.
+
+Sends datagrams one at a time through a *udp* proxy to an echo backend,
+and reports the time per datagram for a flow that already exists, and
+for new flows: every new client address opens a flow, with its socket
+connected to the backend.
+
+Usage::
+
+    $ python bench_udp.py --datagrams 20000 --flows 2000 --size 64
+"""
+import argparse
+import time
+
+from gevent.server import DatagramServer
+from gevent.socket import socket, AF_INET, SOCK_DGRAM
+
+from vaurien import logger
+from vaurien.config import DEFAULT_SETTINGS
+from vaurien.datagram import DatagramProxy
+from vaurien.run import build_parser
+
+
+class Echo(DatagramServer):
+
+    def handle(self, data, address):
+        self.socket.sendto(data, address)
+
+
+def exchange(sock, address, datagram):
+    sock.sendto(datagram, address)
+    return sock.recv(65536)
+
+
+def run_flow(address, datagrams, size):
+    """Sends *datagrams* from one client, returns the duration."""
+    sock = socket(AF_INET, SOCK_DGRAM)
+    datagram = 'x' * size
+    try:
+        start = time.time()
+        for i in xrange(datagrams):
+            exchange(sock, address, datagram)
+        return time.time() - start
+    finally:
+        sock.close()
+
+
+def run_flows(address, flows, size):
+    """Sends a datagram from *flows* clients, returns the duration."""
+    datagram = 'x' * size
+    start = time.time()
+    for i in xrange(flows):
+        sock = socket(AF_INET, SOCK_DGRAM)
+        try:
+            exchange(sock, address, datagram)
+        finally:
+            sock.close()
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--datagrams', type=int, default=20000)
+    parser.add_argument('--flows', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=64)
+    parser.add_argument('--port', type=int, default=8010)
+    parser.add_argument('--backend-port', type=int, default=8020)
+    args = parser.parse_args()
+
+    backend = Echo(('127.0.0.1', args.backend_port))
+    backend.start()
+
+    settings = DEFAULT_SETTINGS.copy()
+    settings['args'] = build_parser().parse_args([])
+    proxy = DatagramProxy(proxy='127.0.0.1:%d' % args.port,
+                          backend='localhost:%d' % args.backend_port,
+                          protocol='udp', settings=settings, logger=logger)
+    proxy.start()
+    address = '127.0.0.1', args.port
+
+    try:
+        duration = run_flow(address, args.datagrams, args.size)
+        print('one flow  %8.2f us/datagram %10d datagrams/s'
+              % (duration * 1e6 / args.datagrams,
+                 args.datagrams / duration))
+        duration = run_flows(address, args.flows, args.size)
+        print('new flows %8.2f us/flow     %10d flows/s'
+              % (duration * 1e6 / args.flows, args.flows / duration))
+    finally:
+        proxy.stop()
+        backend.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,8 +2,7 @@ from setuptools import setup, find_packages
 from vaurien import __version__
 
 
-install_requires = ['cornice', 'gevent', 'statsd-client', 'vaurienclient',
-                    'greenlet', 'http-parser']
+install_requires = ['cornice', 'gevent', 'vaurienclient', 'greenlet']
 
 try:
     import argparse     # NOQA
@@ -0,0 +1,261 @@
+"""HPACK, the header compression of HTTP/2, see RFC 7541.
+
+Every header block of a connection is decoded, in order, to follow the
+compression state of its sender. The proxy encodes the blocks it sends
+itself without indexing anything, so they don't change the state of the
+receiver and can be sent in any order.
+"""
+from collections import deque
+
+
+STATIC_TABLE = [
+    (':authority', ''), (':method', 'GET'), (':method', 'POST'),
+    (':path', '/'), (':path', '/index.html'), (':scheme', 'http'),
+    (':scheme', 'https'), (':status', '200'), (':status', '204'),
+    (':status', '206'), (':status', '304'), (':status', '400'),
+    (':status', '404'), (':status', '500'), ('accept-charset', ''),
+    ('accept-encoding', 'gzip, deflate'), ('accept-language', ''),
+    ('accept-ranges', ''), ('accept', ''),
+    ('access-control-allow-origin', ''), ('age', ''), ('allow', ''),
+    ('authorization', ''), ('cache-control', ''),
+    ('content-disposition', ''), ('content-encoding', ''),
+    ('content-language', ''), ('content-length', ''),
+    ('content-location', ''), ('content-range', ''), ('content-type', ''),
+    ('cookie', ''), ('date', ''), ('etag', ''), ('expect', ''),
+    ('expires', ''), ('from', ''), ('host', ''), ('if-match', ''),
+    ('if-modified-since', ''), ('if-none-match', ''), ('if-range', ''),
+    ('if-unmodified-since', ''), ('last-modified', ''), ('link', ''),
+    ('location', ''), ('max-forwards', ''), ('proxy-authenticate', ''),
+    ('proxy-authorization', ''), ('range', ''), ('referer', ''),
+    ('refresh', ''), ('retry-after', ''), ('server', ''),
+    ('set-cookie', ''), ('strict-transport-security', ''),
+    ('transfer-encoding', ''), ('user-agent', ''), ('vary', ''),
+    ('via', ''), ('www-authenticate', '')]
+
+_STATIC_FIELDS = dict((field, index + 1)
+                      for index, field in enumerate(STATIC_TABLE))
+_STATIC_NAMES = {}
+for _index, (_name, _value) in enumerate(STATIC_TABLE):
+    _STATIC_NAMES.setdefault(_name, _index + 1)
+
+# the symbols of each length of the Huffman code, which is canonical:
+# the codes of a length follow each other in the order of the symbols.
+# 256 is the end of string.
+_HUFFMAN_LENGTHS = {
+    5: map(ord, '012aceiost'),
+    6: map(ord, ' %-./3456789=A_bdfghlmnpru'),
+    7: map(ord, ':BCDEFGHIJKLMNOPQRSTUVWYjkqvwxyz'),
+    8: map(ord, '&*,;XZ'),
+    10: map(ord, '!"()?'),
+    11: map(ord, "'+|"),
+    12: map(ord, '#>'),
+    13: map(ord, '\x00$@[]~'),
+    14: map(ord, '^}'),
+    15: map(ord, '<`{'),
+    19: [92, 195, 208],
+    20: [128, 130, 131, 162, 184, 194, 224, 226],
+    21: [153, 161, 167, 172, 176, 177, 179, 209, 216, 217, 227, 229, 230],
+    22: [129, 132, 133, 134, 136, 146, 154, 156, 160, 163, 164, 169, 170,
+         173, 178, 181, 185, 186, 187, 189, 190, 196, 198, 228, 232, 233],
+    23: [1, 135, 137, 138, 139, 140, 141, 143, 147, 149, 150, 151, 152, 155,
+         157, 158, 165, 166, 168, 174, 175, 180, 182, 183, 188, 191, 197,
+         231, 239],
+    24: [9, 142, 144, 145, 148, 159, 171, 206, 215, 225, 236, 237],
+    25: [199, 207, 234, 235],
+    26: [192, 193, 200, 201, 202, 205, 210, 213, 218, 219, 238, 240, 242,
+         243, 255],
+    27: [203, 204, 211, 212, 214, 221, 222, 223, 241, 244, 245, 246, 247,
+         248, 250, 251, 252, 253, 254],
+    28: [2, 3, 4, 5, 6, 7, 8, 11, 12, 14, 15, 16, 17, 18, 19, 20, 21, 23,
+         24, 25, 26, 27, 28, 29, 30, 31, 127, 220, 249],
+    30: [10, 13, 22, 256]}
+
+_EOS = 256
+
+
+def _build_codes():
+    # the bits of every code, as a string of 0 and 1
+    codes = {}
+    code = 0
+    previous = 0
+    for length in sorted(_HUFFMAN_LENGTHS):
+        code <<= length - previous
+        previous = length
+        for symbol in sorted(_HUFFMAN_LENGTHS[length]):
+            codes[bin(code)[2:].zfill(length)] = symbol
+            code += 1
+    return codes
+
+
+_CODES = _build_codes()
+_LENGTHS = sorted(_HUFFMAN_LENGTHS)
+# the end of string is decoded as None
+_SYMBOLS = dict((code, symbol < _EOS and chr(symbol) or None)
+                for code, symbol in _CODES.items())
+_BITS = [bin(byte)[2:].zfill(8) for byte in range(256)]
+
+
+def huffman_decode(data):
+    """Returns the string Huffman-encoded in *data*.
+
+    Raises a ValueError if the encoding is invalid.
+    """
+    bits = ''.join([_BITS[byte] for byte in bytearray(data)])
+    end = len(bits)
+    decoded = []
+    pos = 0
+    while pos < end:
+        for length in _LENGTHS:
+            symbol = _SYMBOLS.get(bits[pos:pos + length], '')
+            if symbol != '':
+                break
+        else:
+            break
+        if symbol is None:
+            raise ValueError('End of string in a Huffman string')
+        decoded.append(symbol)
+        pos += length
+
+    padding = bits[pos:]
+    if len(padding) > 7 or padding != '1' * len(padding):
+        raise ValueError('Invalid padding in a Huffman string')
+    return ''.join(decoded)
+
+
+def _decode_integer(data, pos, prefix):
+    # an integer with a *prefix* bits prefix, see RFC 7541 section 5.1
+    mask = (1 << prefix) - 1
+    value = data[pos] & mask
+    pos += 1
+    if value < mask:
+        return value, pos
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value += (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+
+def _encode_integer(value, prefix, first=0):
+    mask = (1 << prefix) - 1
+    if value < mask:
+        return chr(first | value)
+    encoded = [chr(first | mask)]
+    value -= mask
+    while value >= 0x80:
+        encoded.append(chr(value & 0x7f | 0x80))
+        value >>= 7
+    encoded.append(chr(value))
+    return ''.join(encoded)
+
+
+def _encode_string(value):
+    # not Huffman-encoded
+    return _encode_integer(len(value), 7) + value
+
+
+class Decoder(object):
+    """Decodes the header blocks of one direction of a connection.
+
+    *updates* lists the dynamic table size updates of the last block.
+    """
+
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self.size = 0
+        self.updates = []
+        # the newest entry first
+        self._table = deque()
+
+    def _lookup(self, index):
+        if 0 < index <= len(STATIC_TABLE):
+            return STATIC_TABLE[index - 1]
+        position = index - len(STATIC_TABLE) - 1
+        if 0 <= position < len(self._table):
+            return self._table[position]
+        raise ValueError('Invalid HPACK index %d' % index)
+
+    def _evict(self, room):
+        while self._table and self.size + room > self.max_size:
+            name, value = self._table.pop()
+            self.size -= 32 + len(name) + len(value)
+
+    def _add(self, name, value):
+        size = 32 + len(name) + len(value)
+        self._evict(size)
+        if size <= self.max_size:
+            self._table.appendleft((name, value))
+            self.size += size
+
+    def _decode_string(self, data, pos):
+        huffman = data[pos] & 0x80
+        length, pos = _decode_integer(data, pos, 7)
+        if pos + length > len(data):
+            raise ValueError('Truncated HPACK string')
+        value = str(data[pos:pos + length])
+        if huffman:
+            value = huffman_decode(value)
+        return value, pos + length
+
+    def decode(self, block):
+        """Returns the list of the *(name, value)* headers of *block*.
+
+        Raises a ValueError if it can't be decoded.
+        """
+        data = bytearray(block)
+        headers = []
+        self.updates = []
+        pos = 0
+        try:
+            while pos < len(data):
+                byte = data[pos]
+                if byte & 0x80:
+                    index, pos = _decode_integer(data, pos, 7)
+                    headers.append(self._lookup(index))
+                    continue
+                if byte & 0xe0 == 0x20:
+                    self.max_size, pos = _decode_integer(data, pos, 5)
+                    self._evict(0)
+                    self.updates.append(self.max_size)
+                    continue
+
+                # a literal, indexed if its first bits are 01
+                indexing = byte & 0xc0 == 0x40
+                index, pos = _decode_integer(data, pos, indexing and 6 or 4)
+                if index:
+                    name = self._lookup(index)[0]
+                else:
+                    name, pos = self._decode_string(data, pos)
+                value, pos = self._decode_string(data, pos)
+                if indexing:
+                    self._add(name, value)
+                headers.append((name, value))
+        except IndexError:
+            raise ValueError('Truncated HPACK block')
+        return headers
+
+
+def encode(headers, updates=()):
+    """Returns the header block of *headers*, a list of *(name, value)*
+    tuples, starting with the dynamic table size *updates*.
+
+    Nothing is added to the dynamic table of the receiver, and its
+    entries aren't used.
+    """
+    encoded = [_encode_integer(size, 5, 0x20) for size in updates]
+    for name, value in headers:
+        index = _STATIC_FIELDS.get((name, value))
+        if index is not None:
+            encoded.append(_encode_integer(index, 7, 0x80))
+            continue
+        # literals without indexing
+        index = _STATIC_NAMES.get(name)
+        if index is not None:
+            encoded.append(_encode_integer(index, 4))
+        else:
+            encoded.append('\x00' + _encode_string(name))
+        encoded.append(_encode_string(value))
+    return ''.join(encoded)
@@ -1,8 +1,10 @@
 from gevent.queue import PriorityQueue, Empty
-import time
+import gevent
 import contextlib
 import sys
 
+from vaurien.util import monotonic
+
 # Sentinel used to mark an empty slot in the MCClientPool queue.
 # Using sys.maxint as the timestamp ensures that empty slots will always
 # sort *after* live connection objects in the queue.
@@ -10,17 +12,77 @@ EMPTY_SLOT = sys.maxint, None
 
 
 class FactoryPool(object):
+    """Pool of connections created by *factory*.
+
+    - *maxsize*: the maximum number of connections, None for no limit.
+    - *timeout*: the number of seconds after which a connection is stale
+      and gets replaced.
+    - *min_size*: the number of connections opened by :meth:`prewarm`.
+    - *check*: a function called with an idle connection before handing
+      it out. When it returns False the connection is replaced.
+    - *metrics* and *prefix*: a :class:`vaurien.metrics.Metrics` registry
+      and the prefix of the pool metrics names.
+    """
 
-    def __init__(self, factory, maxsize=200, timeout=60):
+    def __init__(self, factory, maxsize=200, timeout=60, min_size=0,
+                 check=None, metrics=None, prefix='pool'):
         self.factory = factory
         self.maxsize = maxsize
         self.timeout = timeout
+        if maxsize is not None:
+            min_size = min(min_size, maxsize)
+        self.min_size = min_size
+        self.check = check
+        self.metrics = metrics
+        self.size = 0
+        self.in_use = 0
+        self.draining = False
+        self._names = dict((name, '%s.%s' % (prefix, name))
+                           for name in ('size', 'created', 'reused',
+                                        'discarded', 'wait', 'checkout'))
         self.clients = PriorityQueue(maxsize)
         # If there is a maxsize, prime the queue with empty slots.
         if maxsize is not None:
             for _ in xrange(maxsize):
                 self.clients.put(EMPTY_SLOT)
 
+    def prewarm(self):
+        """Opens *min_size* connections in parallel. Meant to be called
+        before the pool is used.
+
+        Returns the number of connections opened. Connections that can't
+        be opened are left for a later checkout to retry.
+        """
+        greens = [gevent.spawn(self._create)
+                  for _ in xrange(self.min_size - self.size)]
+        gevent.joinall(greens)
+        opened = [green.value for green in greens if green.successful()]
+        # taking the empty slots first, the new connections would sort
+        # before them.
+        if self.maxsize is not None:
+            for _ in opened:
+                self.clients.get()
+        for connection in opened:
+            self.clients.put(connection)
+        return len(opened)
+
+    def drain(self):
+        """Stops recycling connections: the idle ones are closed now, the
+        ones in use when they are given back."""
+        self.draining = True
+        while True:
+            try:
+                ts, client = self.clients.get_nowait()
+            except Empty:
+                break
+            if client is not None:
+                self._discard(client)
+
+    @property
+    def drained(self):
+        """True once a draining pool has no connection in use."""
+        return self.draining and self.in_use == 0
+
     @contextlib.contextmanager
     def reserve(self):
         """Context-manager to obtain a Client object from the pool."""
@@ -30,47 +92,94 @@ class FactoryPool(object):
         finally:
             self._checkin_connection(ts, client)
 
+    def _create(self):
+        client = self.factory()
+        self.size += 1
+        self._incr('created')
+        return monotonic(), client
+
+    def _discard(self, client):
+        self.size -= 1
+        self._incr('discarded')
+        if hasattr(client, 'disconnect'):
+            client.disconnect()
+        elif hasattr(client, 'close'):
+            client.close()
+
+    def _incr(self, name):
+        if self.metrics is not None:
+            self.metrics.incr(self._names[name])
+            if not self.draining:
+                self.metrics.gauge(self._names['size'], self.size)
+
+    def _observe(self, name, started):
+        if self.metrics is not None:
+            self.metrics.observe(self._names[name],
+                                 (monotonic() - started) * 1000)
+
     def _checkout_connection(self):
+        started = monotonic()
+        try:
+            connection = self._get_connection()
+        finally:
+            self._observe('checkout', started)
+        self.in_use += 1
+        return connection
+
+    def _get_connection(self):
         # If there's no maxsize, no need to block waiting for a connection.
         blocking = self.maxsize is not None
 
         # Loop until we get a non-stale connection, or we create a new one.
         while True:
+            waiting = monotonic()
             try:
                 ts, client = self.clients.get(blocking)
             except Empty:
                 # No maxsize and no free connections, create a new one.
-                # XXX TODO: we should be using a monotonic clock here.
-                # see http://www.python.org/dev/peps/pep-0418/
-                now = int(time.time())
-                return now, self.factory()
+                return self._create()
             else:
-                now = int(time.time())
+                if blocking:
+                    self._observe('wait', waiting)
                 # If we got an empty slot placeholder, create a new connection.
                 if client is None:
-                    return now, self.factory()
-                # If the connection is not stale, go ahead and use it.
-                if ts + self.timeout > now:
+                    try:
+                        return self._create()
+                    except Exception:
+                        self.clients.put(EMPTY_SLOT)
+                        raise
+                # If the connection is neither stale nor closed by the
+                # backend, go ahead and use it.
+                if (ts + self.timeout > monotonic() and
+                        (self.check is None or self.check(client))):
+                    self._incr('reused')
                     return ts, client
-                # Otherwise, the connection is stale.
-                # Close it, push an empty slot onto the queue, and retry.
-                if hasattr(client, 'disconnect'):
-                    client.disconnect()
-
-                self.clients.put(EMPTY_SLOT)
+                # Otherwise, close it, push an empty slot onto the queue,
+                # and retry.
+                self._discard(client)
+                if self.maxsize is not None:
+                    self.clients.put(EMPTY_SLOT)
                 continue
 
     def _checkin_connection(self, ts, client):
         """Return a connection to the pool."""
+        self.in_use -= 1
+        if self.draining:
+            self._discard(client)
+            return
+
         if hasattr(client, '_closed') and client._closed:
-            self.clients.put(EMPTY_SLOT)
+            self.size -= 1
+            self._incr('discarded')
+            if self.maxsize is not None:
+                self.clients.put(EMPTY_SLOT)
             return
 
         # If the connection is now stale, don't return it to the pool.
         # Push an empty slot instead so that it will be refreshed when needed.
-        now = int(time.time())
-        if ts + self.timeout > now:
+        if ts + self.timeout > monotonic():
             self.clients.put((ts, client))
         else:
+            self._discard(client)
             if self.maxsize is not None:
                 self.clients.put(EMPTY_SLOT)
@@ -0,0 +1,125 @@
+"""Reading several datagrams per system call with recvmmsg(2).
+
+Linux only. On other systems, or if the C library does not expose
+recvmmsg(), :func:`available` returns False and callers are expected to
+read one datagram at a time with recvfrom().
+"""
+import os
+import socket
+import struct
+import ctypes
+import ctypes.util
+from errno import EAGAIN, EWOULDBLOCK
+
+
+MSG_DONTWAIT = 0x40
+# the size of a sockaddr_storage
+_NAME_SIZE = 128
+
+
+class _iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(_iovec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _msghdr),
+                ('msg_len', ctypes.c_uint)]
+
+
+def _load_recvmmsg():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        func = libc.recvmmsg
+    except (OSError, AttributeError):
+        return None
+
+    func.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr), ctypes.c_uint,
+                     ctypes.c_int, ctypes.c_void_p]
+    func.restype = ctypes.c_int
+    return func
+
+
+_recvmmsg = _load_recvmmsg()
+
+
+def available():
+    """Returns True if recvmmsg(2) can be used on this system."""
+    return _recvmmsg is not None
+
+
+def _address(name):
+    # the (host, port) tuple of a sockaddr, as recvfrom() returns it
+    family = struct.unpack_from('=H', name)[0]
+    port = struct.unpack_from('>H', name, 2)[0]
+    if family == socket.AF_INET6:
+        flowinfo, = struct.unpack_from('>I', name, 4)
+        scope_id, = struct.unpack_from('=I', name, 24)
+        return (socket.inet_ntop(family, name[8:24]), port, flowinfo,
+                scope_id)
+    return socket.inet_ntop(socket.AF_INET, name[4:8]), port
+
+
+class Receiver(object):
+    """Reads up to *count* datagrams of up to *size* bytes at once.
+
+    The buffers are allocated once. Longer datagrams are truncated, as
+    with recvfrom().
+    """
+
+    def __init__(self, count=32, size=65535):
+        self.count = count
+        self.size = size
+        self._data = ctypes.create_string_buffer(count * size)
+        self._names = ctypes.create_string_buffer(count * _NAME_SIZE)
+        self._iovecs = (_iovec * count)()
+        self._messages = (_mmsghdr * count)()
+
+        data = ctypes.addressof(self._data)
+        names = ctypes.addressof(self._names)
+        for index in range(count):
+            iovec = self._iovecs[index]
+            iovec.iov_base = data + index * size
+            iovec.iov_len = size
+            header = self._messages[index].msg_hdr
+            header.msg_name = names + index * _NAME_SIZE
+            header.msg_namelen = _NAME_SIZE
+            header.msg_iov = ctypes.pointer(iovec)
+            header.msg_iovlen = 1
+
+    def receive(self, fd):
+        """Returns the *(data, address)* of the datagrams waiting on the
+        socket *fd*, without blocking. The list is empty if there are
+        none.
+        """
+        received = _recvmmsg(fd, self._messages, self.count, MSG_DONTWAIT,
+                             None)
+        if received == -1:
+            err = ctypes.get_errno()
+            if err in (EAGAIN, EWOULDBLOCK):
+                return []
+            raise socket.error(err, os.strerror(err))
+
+        datagrams = []
+        data = ctypes.addressof(self._data)
+        names = ctypes.addressof(self._names)
+        for index in range(received):
+            message = self._messages[index]
+            name = ctypes.string_at(names + index * _NAME_SIZE,
+                                    message.msg_hdr.msg_namelen)
+            datagrams.append((ctypes.string_at(data + index * self.size,
+                                               message.msg_len),
+                              _address(name)))
+            message.msg_hdr.msg_namelen = _NAME_SIZE
+        return datagrams
@@ -0,0 +1,62 @@
+"""Weighted random selection with Walker's alias method.
+
+Building the tables is O(n), picking an item is O(1) whatever the
+weights are, so very small weights like 0.01 cost nothing more than
+round percents.
+"""
+import random
+
+
+class AliasSampler(object):
+    """Picks items with a probability proportional to their weight.
+
+    *choices* is a sequence of (item, weight) tuples, the weights being
+    positive numbers. A sampler is immutable: to change the weights,
+    build a new one and replace the old one.
+    """
+
+    def __init__(self, choices, random=random.random):
+        choices = [(item, float(weight)) for item, weight in choices]
+        for item, weight in choices:
+            if weight < 0:
+                raise ValueError('Negative weight for %r' % (item,))
+
+        # items that can't be picked are left out of the tables
+        choices = [(item, weight) for item, weight in choices if weight > 0]
+        if not choices:
+            raise ValueError('The weights total needs to be positive')
+        total = sum(weight for item, weight in choices)
+
+        size = len(choices)
+        self.items = [item for item, weight in choices]
+        self.weights = [weight for item, weight in choices]
+        self._random = random
+        self._size = size
+        self._prob = [0.] * size
+        self._alias = range(size)
+
+        # scaled so that the average is 1
+        scaled = [weight * size / total for weight in self.weights]
+        small = [i for i, value in enumerate(scaled) if value < 1.]
+        large = [i for i, value in enumerate(scaled) if value >= 1.]
+
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self._prob[less] = scaled[less]
+            self._alias[less] = more
+            scaled[more] -= 1. - scaled[less]
+            if scaled[more] < 1.:
+                small.append(more)
+            else:
+                large.append(more)
+
+        # what is left is 1, give or take rounding errors
+        for index in small + large:
+            self._prob[index] = 1.
+
+    def pick(self):
+        value = self._random() * self._size
+        index = int(value)
+        if value - index < self._prob[index]:
+            return self.items[index]
+        return self.items[self._alias[index]]
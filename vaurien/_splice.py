@@ -0,0 +1,96 @@
+"""Kernel-side forwarding between two sockets with splice(2).
+
+Linux only. On other systems, or if the C library does not expose
+splice(), :func:`available` returns False and callers are expected to use
+the userspace data path.
+"""
+import os
+import ctypes
+import ctypes.util
+from errno import EAGAIN, EWOULDBLOCK
+
+from gevent.socket import wait_read, wait_write
+
+
+SPLICE_F_MOVE = 1
+SPLICE_F_NONBLOCK = 2
+_FLAGS = SPLICE_F_MOVE | SPLICE_F_NONBLOCK
+
+
+def _load_splice():
+    # Python 3.10+
+    if hasattr(os, 'splice'):
+        return lambda src, dst, count, flags: os.splice(src, dst, count,
+                                                        flags=flags)
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        func = libc.splice
+    except (OSError, AttributeError):
+        return None
+
+    func.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                     ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+    func.restype = ctypes.c_ssize_t
+
+    def splice(src, dst, count, flags):
+        res = func(src, None, dst, None, count, flags)
+        if res == -1:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return res
+
+    return splice
+
+
+_splice = _load_splice()
+
+
+def available():
+    """Returns True if splice(2) can be used on this system."""
+    return _splice is not None
+
+
+class Splicer(object):
+    """Moves data from a socket to another one through a pipe, without
+    copying it in userspace.
+
+    A splicer is meant to be used for one direction of one connection,
+    and closed afterwards: if forwarding is interrupted some data may
+    be left in the pipe.
+    """
+
+    def __init__(self, size=65536):
+        self.size = size
+        self.read_fd, self.write_fd = os.pipe()
+
+    def forward(self, source, dest, timeout=None):
+        """Moves up to *size* bytes from *source* to *dest*.
+
+        Returns the number of bytes moved, 0 meaning the source
+        reached EOF. The pipe is always empty when this method returns.
+        """
+        while True:
+            try:
+                count = _splice(source.fileno(), self.write_fd, self.size,
+                                _FLAGS)
+                break
+            except OSError, e:
+                if e.errno not in (EAGAIN, EWOULDBLOCK):
+                    raise
+                wait_read(source.fileno(), timeout=timeout)
+
+        left = count
+        while left > 0:
+            try:
+                left -= _splice(self.read_fd, dest.fileno(), left, _FLAGS)
+            except OSError, e:
+                if e.errno not in (EAGAIN, EWOULDBLOCK):
+                    raise
+                wait_write(dest.fileno(), timeout=timeout)
+
+        return count
+
+    def close(self):
+        os.close(self.read_fd)
+        os.close(self.write_fd)
@@ -0,0 +1,70 @@
+"""TLS on both sides of the proxy.
+
+The proxy can terminate the TLS connections of its clients and open TLS
+connections to the backends, so the protocols and behaviors see the
+decrypted data in between.
+"""
+from gevent import ssl
+
+
+def create_server_context(certfile, keyfile=None, alpn=None):
+    """Returns the context of the client connections, with the
+    certificate chain of *certfile* and the private key of *keyfile*, or
+    of *certfile* too if None.
+
+    Clients resume their sessions with tickets, see
+    :func:`ssl.SSLContext.load_cert_chain` for the files format. *alpn*
+    lists the application protocols offered, if any.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
+    context.load_cert_chain(certfile, keyfile or None)
+    if alpn:
+        context.set_alpn_protocols(alpn)
+    return context
+
+
+def create_client_context(cafile=None, insecure=False, alpn=None):
+    """Returns the context of the backend connections.
+
+    The certificates of the backends are checked against the system CAs,
+    or the ones of *cafile*, unless *insecure* is True. *alpn* lists the
+    application protocols asked for, if any.
+    """
+    context = ssl.create_default_context(cafile=cafile or None)
+    if insecure:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    if alpn:
+        context.set_alpn_protocols(alpn)
+    return context
+
+
+def is_tls(sock):
+    return isinstance(sock, ssl.SSLSocket)
+
+
+def buffered(sock):
+    """Returns the number of decrypted bytes a TLS socket holds, that
+    poll() can't see."""
+    if isinstance(sock, ssl.SSLSocket):
+        return sock.pending()
+    return 0
+
+
+def drain_records(sock):
+    """Reads the records a peer sends over an idle TLS connection, like
+    session tickets.
+
+    Returns False if application data or the end of the connection came
+    instead.
+    """
+    timeout = sock.gettimeout()
+    sock.settimeout(0)
+    try:
+        sock.recv(1)
+    except ssl.SSLWantReadError:
+        return True
+    finally:
+        sock.settimeout(timeout)
+    return False
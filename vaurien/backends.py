@@ -0,0 +1,144 @@
+"""Groups of backends.
+
+A proxy sends its connections to a group of one or more backends, each
+of them with its own connection pool. The backend of a new connection is
+picked by the group strategy:
+
+- *round-robin*: every backend in turn.
+- *least-connections*: the backend with the fewest connections in use,
+  relative to its weight.
+- *weighted*: a random backend, with a probability proportional to its
+  weight.
+
+Backends are given as a comma-separated list of *HOST:PORT* addresses, or
+as a list of addresses. An address can end with *=WEIGHT*, e.g.
+*localhost:8001=3,localhost:8002*. The default weight is 1.
+"""
+from gevent.socket import gethostbyname, error
+
+from vaurien._sampler import AliasSampler
+
+
+STRATEGIES = ('round-robin', 'least-connections', 'weighted')
+
+
+def parse_backends(backends):
+    """Returns a list of (address, weight) tuples for *backends*.
+
+    Raises a ValueError if an address or a weight is invalid.
+    """
+    if isinstance(backends, basestring):
+        backends = backends.split(',')
+
+    parsed = []
+    for backend in backends:
+        backend = backend.strip()
+        weight = 1.
+        if '=' in backend:
+            backend, weight = backend.rsplit('=', 1)
+            try:
+                weight = float(weight)
+            except ValueError:
+                raise ValueError('Invalid weight for %r' % backend)
+            if weight <= 0:
+                raise ValueError('Invalid weight for %r' % backend)
+        try:
+            port = int(backend.rsplit(':', 1)[1])
+        except (IndexError, ValueError):
+            raise ValueError('Expected HOST:PORT: %r' % backend)
+        if not 0 < port < 65536:
+            raise ValueError('Expected HOST:PORT: %r' % backend)
+        parsed.append((backend, weight))
+
+    if not parsed:
+        raise ValueError('No backend')
+    return parsed
+
+
+class Backend(object):
+    """A backend address and the pool of connections to it."""
+
+    def __init__(self, address, weight, pool):
+        self.address = address
+        self.weight = weight
+        self.pool = pool
+
+    def __str__(self):
+        if self.weight == 1:
+            return self.address
+        return '%s=%g' % (self.address, self.weight)
+
+    @property
+    def in_use(self):
+        return self.pool.in_use
+
+
+class BackendGroup(object):
+    """The backends a proxy balances its connections on.
+
+    *create_pool* is called with the address of every backend and its
+    (host, port) tuple, and returns its :class:`vaurien._pool.FactoryPool`.
+    Host names are resolved once, when the group is created.
+    """
+
+    def __init__(self, backends, create_pool, strategy='round-robin'):
+        if strategy not in STRATEGIES:
+            raise ValueError('Unknown strategy %r. Pick one of: %s.'
+                             % (strategy, ', '.join(STRATEGIES)))
+        self.strategy = strategy
+
+        self.backends = []
+        for address, weight in parse_backends(backends):
+            host, port = address.rsplit(':', 1)
+            try:
+                dest = gethostbyname(host), int(port)
+            except error, e:
+                raise ValueError('Could not resolve %r: %s' % (address, e))
+            self.backends.append(Backend(address, weight,
+                                         create_pool(address, dest)))
+
+        self._next = 0
+        self._sampler = AliasSampler([(backend, backend.weight)
+                                      for backend in self.backends])
+        self.pick = getattr(self, '_pick_' + strategy.replace('-', '_'))
+
+    def __str__(self):
+        return ','.join(str(backend) for backend in self.backends)
+
+    def _pick_round_robin(self):
+        backend = self.backends[self._next]
+        self._next = (self._next + 1) % len(self.backends)
+        return backend
+
+    def _pick_least_connections(self):
+        # starting from the next one in turn, so ties are spread out
+        start = self._pick_round_robin()
+        best = start
+        for backend in self.backends:
+            if backend.in_use / backend.weight < best.in_use / best.weight:
+                best = backend
+        return best
+
+    def _pick_weighted(self):
+        return self._sampler.pick()
+
+    def prewarm(self):
+        """Prewarms the pools of all backends, returns the number of
+        connections opened."""
+        return sum(backend.pool.prewarm() for backend in self.backends)
+
+    def drain(self):
+        for backend in self.backends:
+            backend.pool.drain()
+
+    @property
+    def drained(self):
+        return all(backend.pool.drained for backend in self.backends)
+
+    @property
+    def in_use(self):
+        return sum(backend.in_use for backend in self.backends)
+
+    def get_status(self):
+        return [{'backend': backend.address, 'weight': backend.weight,
+                 'in_use': backend.in_use} for backend in self.backends]
@@ -4,10 +4,14 @@ from abc import ABCMeta, abstractmethod
 class Behavior(object):
     """Registry for behaviors.
 
-    A behavior is a class that implements two methods:
+    A behavior is a class that implements three methods:
 
     - on_before_handle
+    - on_between_handle
     - on_after_handle
+
+    and optionally *on_message* and *on_datagram*, see
+    :class:`vaurien.behaviors.dummy.Dummy`.
     """
     __metaclass__ = ABCMeta
     _cache = {}
@@ -93,3 +97,12 @@ Behavior.register(Transient)
 
 from vaurien.behaviors.abort import Abort
 Behavior.register(Abort)
+
+from vaurien.behaviors.drop import Drop
+Behavior.register(Drop)
+
+from vaurien.behaviors.duplicate import Duplicate
+Behavior.register(Duplicate)
+
+from vaurien.behaviors.reorder import Reorder
+Behavior.register(Reorder)
@@ -1,16 +1,25 @@
 import socket
-import re
 
 from vaurien.behaviors.dummy import Dummy
-from vaurien.util import get_data
-from vaurien.protocols.http import Http
 
 class Abort(Dummy):
     """Simulate an aborted connection by a client before receiving a response.
+
+    With the *http2* protocol, the stream is reset instead. A WebSocket
+    connection of the *http* protocol gets close frames first.
     """
     name = 'abort'
 
+    def on_before_handle(self, protocol, source, dest, to_backend):
+        handled = protocol.abort_message(source, dest, to_backend)
+        if handled is not None:
+            return handled
+        return True
+
     def on_between_handle(self, protocol, source, dest, to_backend):
+        if protocol.multiplexed:
+            # only the stream was aborted
+            return True
         dest.shutdown(socket.SHUT_RDWR)
         dest.close()
 
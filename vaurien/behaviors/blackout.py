@@ -7,6 +7,7 @@ class Blackout(Dummy):
     """
     name = 'blackout'
     options = {}
+    options.update(Dummy.options)
 
     def on_before_handle(self, protocol, source, dest, to_backend):
         # close source socket
@@ -1,3 +1,5 @@
+import random
+
 import gevent
 from vaurien.behaviors.dummy import Dummy
 
@@ -5,20 +7,43 @@ from vaurien.behaviors.dummy import Dummy
 class Delay(Dummy):
     """Adds a delay before or after the backend is called.
 
-    The delay can happen *after* or *before* the backend is called.
+    The delay can happen *after* or *before* the backend is called. A
+    random *jitter* can be added to it. Datagrams are delayed without
+    holding back the next ones, and so are the HTTP/2 streams.
+
+    With the *http2* protocol, *before* is ignored: the request opening
+    a stream always goes to the server at once and its response is held,
+    see :meth:`vaurien.protocols.http2.Http2.delay_message`.
     """
     name = 'delay'
     options = {'sleep': ("Delay in seconds (float)", float, 1),
                'before':
                ("If True adds before the backend is called. Otherwise"
-                " after", bool, True)}
+                " after", bool, True),
+               'jitter': ("Random extra delay in seconds, up to",
+                          float, 0.)}
     options.update(Dummy.options)
 
+    def _delay(self):
+        jitter = self.option('jitter')
+        if jitter > 0:
+            return self.option('sleep') + random.uniform(0, jitter)
+        return self.option('sleep')
+
     def on_before_handle(self, protocol, source, dest, to_backend):
+        # a protocol may hold the message only, not the whole connection
+        handled = protocol.delay_message(source, dest, to_backend,
+                                         self._delay())
+        if handled is not None:
+            return handled
         if self.option('before'):
-            gevent.sleep(self.option('sleep'))
+            gevent.sleep(self._delay())
         return True
 
     def on_after_handle(self, protocol, source, dest, to_backend):
-        if not self.option('before'):
-            gevent.sleep(self.option('sleep'))
+        if not self.option('before') and not protocol.multiplexed:
+            gevent.sleep(self._delay())
+
+    def on_datagram(self, flow, data, to_backend):
+        gevent.spawn_later(self._delay(), flow.send, data, to_backend)
+        return False
@@ -0,0 +1,19 @@
+from vaurien.behaviors.dummy import Dummy
+
+
+class Drop(Dummy):
+    """Drops datagrams, as a lossy network does.
+
+    Applies to the UDP proxy, and to the messages of the WebSocket
+    connections of the *http* protocol.
+    """
+    name = 'drop'
+
+    def on_before_handle(self, protocol, source, dest, to_backend):
+        handled = protocol.drop_message(source, dest, to_backend)
+        if handled is not None:
+            return handled
+        return True
+
+    def on_datagram(self, flow, data, to_backend):
+        return False
@@ -1,29 +1,60 @@
+from vaurien.util import convert_option, compile_options, apply_settings
 
 
 class Dummy(object):
     """Transparent behavior. Nothing's done.
     """
     name = 'dummy'
-    options = {}
+    options = {'messages': ("Comma-separated names of the messages the "
+                            "behavior applies to, e.g. GET,SET for Redis. "
+                            "All of them if empty.", str, '')}
 
     def __init__(self):
         self.settings = {}
+        self.version = 0
+        self.opts = compile_options(self.options, self.settings)
+        self._messages = self._parse_messages()
+
+    def _parse_messages(self):
+        messages = getattr(self.opts, 'messages', '')
+        names = [name.strip().upper() for name in messages.split(',')]
+        return frozenset(name for name in names if name)
 
     def update_settings(self, settings):
-        self.settings.update(settings)
+        apply_settings(self, settings)
+        self._messages = self._parse_messages()
 
     def _convert(self, value, type_):
-        if isinstance(value, type_):
-            return value
-        if type_ == bool:
-            value = value.lower()
-            return value in ('y', 'yes', '1', 'on')
-        return type_(value)
+        return convert_option(value, type_)
 
     def option(self, name):
-        type_, default = self.options[name][1:3]
-        value = self.settings.get(name, default)
-        return self._convert(value, type_)
+        return getattr(self.opts, name)
+
+    def on_message(self, protocol, message):
+        """Called with the :class:`vaurien.protocols.base.Message` about
+        to be forwarded, by the protocols that know where messages start.
+
+        Returns False to forward it untouched, without calling the other
+        hooks. The messages are filtered by name with the *messages*
+        option, the ones the protocol can't name being left alone.
+
+        It is only called for the messages the options of the protocol
+        pick, e.g. *--protocol-postgresql-types*: both filters apply.
+        """
+        if not self._messages:
+            return True
+        return (message.name is not None and
+                message.name.upper() in self._messages)
+
+    def on_datagram(self, flow, data, to_backend):
+        """Called for every datagram of the UDP proxy, see
+        :class:`vaurien.datagram.DatagramProxy`.
+
+        Returns True to forward it as is. A behavior can also forward it
+        itself with *flow.send(data, to_backend)*, later or several
+        times, and return False. It must not block.
+        """
+        return True
 
     def on_before_handle(self, protocol, source, dest, to_backend):
         return True
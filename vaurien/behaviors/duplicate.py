@@ -0,0 +1,16 @@
+from vaurien.behaviors.dummy import Dummy
+
+
+class Duplicate(Dummy):
+    """Sends datagrams several times.
+
+    Only applies to the UDP proxy.
+    """
+    name = 'duplicate'
+    options = {'copies': ("Number of extra copies", int, 1)}
+    options.update(Dummy.options)
+
+    def on_datagram(self, flow, data, to_backend):
+        for _ in range(self.option('copies')):
+            flow.send(data, to_backend)
+        return True
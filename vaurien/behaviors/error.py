@@ -2,7 +2,6 @@ import os
 import random
 
 from vaurien.behaviors.dummy import Dummy
-from vaurien.util import get_data
 
 
 _ERRORS = {
@@ -62,6 +61,17 @@ class Error(Dummy):
     data is injected.
 
     The *inject* option is deactivated when the *http* protocol is used.
+
+    The protocols knowing their messages fail them instead, see
+    :meth:`vaurien.protocols.base.BaseProtocol.inject_error`. With the
+    *smtp* protocol, the commands are answered with an error reply fitting
+    them instead of reaching the server, unless the connection is
+    encrypted, see :class:`vaurien.protocols.smtp.SMTP`. With the *http2*
+    protocol, only the stream fails, see
+    :class:`vaurien.protocols.http2.Http2`. The messages of a WebSocket
+    are corrupted, see :class:`vaurien.protocols.http.Http`. With the
+    *mongodb* protocol, the commands get an error reply, see
+    :class:`vaurien.protocols.mongodb.MongoDB`.
     """
     name = 'error'
     options = {'inject': ("Inject errors inside valid data", bool, False),
@@ -78,19 +88,21 @@ class Error(Dummy):
             return super(Error, self).on_before_handle(protocol, source,
                                                        dest, to_backend)
 
-        # read the data
-        data = get_data(source)
+        handled = protocol.inject_error(source, dest, to_backend)
+        if handled is not None:
+            return handled
+
+        if to_backend and protocol.duplex:
+            # the data goes to the backend untouched: the protocol forwards
+            # it, and keeps track of it to follow the replies
+            return True
+
+        # read the data, the protocol may have peeked at it already
+        data = protocol.read_data(source)
         if not data:
             return False
 
         # error out
-        if protocol.name == 'http' and to_backend:
-            # we'll just send back a random error
-            source.sendall(random_http_error())
-            source.close()
-            source._closed = True
-            return False
-
         if self.option('inject'):
             if not to_backend:      # back to the client
                 middle = len(data) / 2
@@ -1,7 +1,6 @@
 import gevent
 
 from vaurien.behaviors.dummy import Dummy
-from vaurien.util import get_data
 
 
 class Hang(Dummy):
@@ -11,12 +10,13 @@ class Hang(Dummy):
     """
     name = 'hang'
     options = {}
+    options.update(Dummy.options)
 
     def on_before_handle(self, protocol, source, dest, to_backend):
         # consume the socket and hang
-        data = get_data(source)
+        data = protocol.read_data(source)
         while data:
-            data = get_data(source)
+            data = protocol.read_data(source)
 
         while True:
             gevent.sleep(1.)
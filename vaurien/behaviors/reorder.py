@@ -0,0 +1,34 @@
+import gevent
+
+from vaurien.behaviors.dummy import Dummy
+
+
+class Reorder(Dummy):
+    """Holds datagrams back so the next ones overtake them.
+
+    A datagram is held until the next one this behavior picks in the same
+    direction, which is sent first, or for *hold* seconds at most.
+
+    Only applies to the UDP proxy.
+    """
+    name = 'reorder'
+    options = {'hold': ("Seconds a datagram is held at most", float, 0.1)}
+    options.update(Dummy.options)
+
+    def _release(self, flow, to_backend):
+        held = flow.held.pop(to_backend, None)
+        if held is not None:
+            flow.send(held[0], to_backend)
+
+    def on_datagram(self, flow, data, to_backend):
+        held = flow.held.pop(to_backend, None)
+        if held is not None:
+            held[1].kill(block=False)
+            flow.send(data, to_backend)
+            flow.send(held[0], to_backend)
+            return False
+
+        timer = gevent.spawn_later(self.option('hold'), self._release, flow,
+                                   to_backend)
+        flow.held[to_backend] = data, timer
+        return False
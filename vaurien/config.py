@@ -261,19 +261,29 @@ DEFAULT_SETTINGS = SettingsDict({
     # default ratios
     'vaurien.proxy': 'localhost:8000',
     'vaurien.backend': 'localhost:80',
+    'vaurien.balance': 'round-robin',
     'vaurien.behavior': '100:dummy',
     'vaurien.bufsize': 8192,
     'vaurien.timeout': 30,
     'vaurien.stay_connected': False,
     'vaurien.pool_max_size': 100,
     'vaurien.pool_timeout': 30,
+    'vaurien.pool_min_size': 0,
     'vaurien.sync': False,
     'vaurien.backlog': 8192,
+    'vaurien.engine': 'pump',
+    'vaurien.granularity': 'chunk',
+    'vaurien.tls_certfile': '',
+    'vaurien.tls_keyfile': '',
+    'vaurien.backend_tls': False,
+    'vaurien.backend_tls_cafile': '',
+    'vaurien.backend_tls_insecure': False,
+    'vaurien.udp': False,
 
     # stats config
     'statsd.enabled': False,
     'statsd.host': 'localhost',
     'statsd.port': 8125,
     'statsd.prefix': 'vaurien',
-    'statsd.sample_rate': 1.0
+    'statsd.flush_interval': 1.0
 })
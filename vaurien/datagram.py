@@ -0,0 +1,265 @@
+"""The UDP proxy.
+
+UDP has no connections, so the proxy keeps a table of *flows*: the
+first datagram of a client address opens a socket to a backend, and the
+datagrams of that address go through it in both directions. A flow
+expires once it has seen no datagram for *timeout* seconds.
+
+The datagrams are read in batches, with recvmmsg(2) where the system has
+it, and relayed from the hub: no greenlet is spawned per datagram, only
+one per flow to read the replies of its backend.
+
+Behaviors act on datagrams with their :meth:`on_datagram` hook, see
+:class:`vaurien.behaviors.dummy.Dummy`.
+"""
+import time
+import socket as _socket
+from errno import EAGAIN, EWOULDBLOCK, ECONNREFUSED
+from socket import error
+
+import gevent
+from gevent.server import DatagramServer
+from gevent.socket import socket, timeout, AF_INET, SOCK_DGRAM
+
+from vaurien.util import (parse_address, get_prefixed_sections,
+                          get_reuse_port_listener)
+from vaurien.behaviors import get_behaviors
+from vaurien.backends import BackendGroup
+from vaurien.proxy import (BaseProxy, RandomBehaviors, OnTheFlyBehaviors,
+                           _Choice)
+from vaurien import _recvmmsg
+
+
+# the largest UDP payload
+_MAX_DATAGRAM = 65535
+
+
+class _Destination(object):
+    """Stands for the connection pool of a backend: counts its flows, so
+    the groups can balance and drain them. *dest* is the address of the
+    backend, resolved once when the group is created."""
+
+    def __init__(self, dest):
+        self.dest = dest
+        self.in_use = 0
+        self.draining = False
+
+    def prewarm(self):
+        return 0
+
+    def drain(self):
+        self.draining = True
+
+    @property
+    def drained(self):
+        return self.draining and self.in_use == 0
+
+
+class _Flow(object):
+    """The datagrams of a client address, and the socket relaying them to
+    its backend."""
+
+    def __init__(self, proxy, address, destination, sock, choice):
+        self.proxy = proxy
+        self.address = address
+        self.destination = destination
+        self.sock = sock
+        self.choice = choice
+        self.greenlet = None
+        self.last_activity = time.time()
+        # for the behaviors keeping datagrams back
+        self.held = {}
+
+    def send(self, data, to_backend):
+        """Sends *data* to the backend, or to the client, right away."""
+        self.proxy._send(self, data, to_backend)
+
+    def idle(self):
+        return time.time() - self.last_activity
+
+
+class DatagramProxy(BaseProxy, DatagramServer):
+
+    def __init__(self, proxy, backend, protocol='udp', behaviors=None,
+                 settings=None, metrics=None, logger=None, **kwargs):
+        self.settings = settings
+        cfg = self.settings.getsection('vaurien')
+
+        if behaviors is None:
+            behaviors = get_behaviors()
+
+        logger.info('Starting the Chaos UDP Server')
+        parsed_proxy = parse_address(proxy)
+        # the datagrams are relayed from the hub, see handle()
+        kwargs['spawn'] = None
+        if cfg.get('reuse_port', False):
+            # the kernel spreads the datagrams on the processes
+            listener = get_reuse_port_listener(parsed_proxy,
+                                               type_=SOCK_DGRAM)
+            DatagramServer.__init__(self, listener, **kwargs)
+        else:
+            DatagramServer.__init__(self, parsed_proxy, **kwargs)
+        self.max_accept = 64
+        self._logger = logger
+        self.behaviors = behaviors
+        self.behaviors.update(get_prefixed_sections(self.settings, 'behavior',
+                                                    logger))
+        self._configure_behaviors()
+        self.behavior = get_behaviors()['dummy']
+        self.behavior_name = 'dummy'
+        self.timeout = cfg.get('timeout', 30)
+        self.protocol = protocol
+        self.pool_min_size = 0
+
+        self._init_metrics(metrics)
+        self.balance = cfg.get('balance', 'round-robin')
+        self.generation = 1
+        self._group = self._create_group(backend, self.balance)
+        self.backend = str(self._group)
+        # (generation, group) of the previous backends
+        self._draining = []
+        self._routes = {}
+        self._groups = {}
+        # client address -> _Flow
+        self.flows = {}
+        if _recvmmsg.available():
+            self._receiver = _recvmmsg.Receiver()
+        else:
+            self._receiver = None
+
+        logger.info('Options:')
+        logger.info('* proxies from %s to %s' % (proxy, backend))
+        logger.info('* timeout: %d' % self.timeout)
+        logger.info('* recvmmsg: %d' % (self._receiver is not None))
+
+    def _create_group(self, backends, strategy, protocol=None):
+        return BackendGroup(backends,
+                            lambda address, dest: _Destination(dest),
+                            strategy)
+
+    def start(self):
+        DatagramServer.start(self)
+        if self._flusher is not None:
+            self._flusher.start()
+
+    def stop(self, *args, **kwargs):
+        try:
+            DatagramServer.stop(self, *args, **kwargs)
+        finally:
+            gevent.killall([flow.greenlet for flow in self.flows.values()])
+            if self._flusher is not None:
+                self._flusher.stop()
+
+    def do_read(self):
+        # called by the server when the socket is readable, until it
+        # returns None
+        if self._receiver is not None:
+            datagrams = self._receiver.receive(self._socket.fileno())
+            return datagrams and (datagrams,) or None
+        try:
+            return ([self._socket.recvfrom(_MAX_DATAGRAM)],)
+        except error, e:
+            if e.args[0] in (EAGAIN, EWOULDBLOCK):
+                return None
+            raise
+
+    def handle(self, datagrams):
+        # runs in the hub, so nothing here blocks
+        flows = self.flows
+        now = time.time()
+        for data, address in datagrams:
+            flow = flows.get(address)
+            if flow is None:
+                flow = self._open_flow(address)
+            flow.last_activity = now
+            self._relay(flow, data, True)
+
+    def _open_flow(self, address):
+        # the flow sticks to the backend it started with, even if the
+        # backend changes meanwhile
+        destination = self._group.pick().pool
+        # the address is numeric, so connecting looks nothing up. The
+        # socket is connected before gevent wraps it, as gevent would
+        # resolve the address again in a thread, and the hub can't wait
+        # for it.
+        raw = _socket.socket(AF_INET, SOCK_DGRAM)
+        raw.connect(destination.dest)
+        sock = socket(_sock=raw)
+        sock.settimeout(self.timeout)
+        destination.in_use += 1
+
+        flow = _Flow(self, address, destination, sock,
+                     _Choice(*self.get_behavior()))
+        self.flows[address] = flow
+        names = self._connection_names
+        self._active += 1
+        self.metrics.incr(names['start'])
+        self.metrics.gauge(names['active'], self._active)
+        flow.greenlet = gevent.spawn(self._read_replies, flow)
+        return flow
+
+    def _read_replies(self, flow):
+        started = time.time()
+        try:
+            while True:
+                try:
+                    data = flow.sock.recv(_MAX_DATAGRAM)
+                except timeout:
+                    if flow.idle() >= self.timeout:
+                        return
+                    continue
+                except error, e:
+                    if e.args[0] == ECONNREFUSED:
+                        # nothing listens on the backend, for now
+                        continue
+                    self._logger.debug('Flow of %s failed: %s'
+                                       % (flow.address, e))
+                    return
+                flow.last_activity = time.time()
+                self._relay(flow, data, False)
+        finally:
+            self._close_flow(flow, started)
+
+    def _close_flow(self, flow, started):
+        if self.flows.get(flow.address) is flow:
+            del self.flows[flow.address]
+        for data, timer in flow.held.values():
+            timer.kill(block=False)
+        flow.held.clear()
+        flow.sock.close()
+        flow.destination.in_use -= 1
+        self._prune_drained()
+
+        names = self._connection_names
+        self._active -= 1
+        self.metrics.incr(names['end'])
+        self.metrics.gauge(names['active'], self._active)
+        self.metrics.observe(names['duration'],
+                             (time.time() - started) * 1000)
+
+    def _relay(self, flow, data, to_backend):
+        behavior, name = self._pick_behavior(flow.choice, to_backend)
+        self._count_chunk(name, to_backend)
+        if name == 'dummy' or behavior.on_datagram(flow, data, to_backend):
+            self._send(flow, data, to_backend)
+
+    def _send(self, flow, data, to_backend):
+        # a full buffer or a closed flow loses the datagram, as the
+        # network would
+        try:
+            if to_backend:
+                flow.sock.send(data, 0, 0)
+            else:
+                self._socket.sendto(data, flow.address)
+        except error, e:
+            self.metrics.incr('%s.lost' % self.protocol)
+            self._logger.debug('Datagram to %s lost: %s'
+                               % (to_backend and 'backend' or 'client', e))
+
+
+class RandomDatagramProxy(RandomBehaviors, DatagramProxy):
+    pass
+
+
+class OnTheFlyDatagramProxy(OnTheFlyBehaviors, DatagramProxy):
+    pass
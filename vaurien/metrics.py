@@ -0,0 +1,164 @@
+"""In-process metrics.
+
+The proxy records its metrics in a :class:`Metrics` registry, which only
+updates a few dicts: nothing is sent over the network when a connection
+starts or a chunk goes through. When statsd is enabled, a
+:class:`StatsdFlusher` sends what changed since the previous flush every
+*interval* seconds, packing as many metrics as possible in each UDP
+packet.
+
+Metric names have a low cardinality: they are made of the protocol, the
+behavior and the direction of the data, e.g. *tcp.delay.to_backend*.
+"""
+from collections import defaultdict
+
+import gevent
+from gevent import socket
+
+
+class Histogram(object):
+    """Count, sum, min and max of observed values.
+
+    The totals are kept for the life of the process, the min and max
+    are reset on every flush.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def reset(self):
+        self.min = self.max = None
+
+
+class Metrics(object):
+    """Registry of counters, gauges and histograms."""
+
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.gauges = {}
+        self.histograms = defaultdict(Histogram)
+        # what was sent on the previous flush
+        self._flushed = {}
+
+    def incr(self, name, value=1):
+        self.counters[name] += value
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def observe(self, name, value):
+        self.histograms[name].observe(value)
+
+    def get_stats(self):
+        """Returns the totals of the counters and histograms and the
+        current value of the gauges, in a flat mapping.
+
+        The totals can be added up across processes, not the gauges.
+        """
+        stats = dict(self.counters)
+        stats.update(self.gauges)
+        for name, histogram in self.histograms.items():
+            stats[name + '.count'] = histogram.count
+            stats[name + '.sum'] = histogram.sum
+        return stats
+
+    def collect(self):
+        """Returns the statsd lines for what changed since the previous
+        call."""
+        lines = []
+        flushed = self._flushed
+
+        for name, value in self.counters.items():
+            delta = value - flushed.get(name, 0)
+            if delta:
+                lines.append('%s:%d|c' % (name, delta))
+                flushed[name] = value
+
+        for name, value in self.gauges.items():
+            lines.append('%s:%s|g' % (name, value))
+
+        for name, histogram in self.histograms.items():
+            key = name + '.count'
+            count = histogram.count - flushed.get(key, 0)
+            if not count:
+                continue
+            key_sum = name + '.sum'
+            total = histogram.sum - flushed.get(key_sum, 0)
+            lines.append('%s.count:%d|c' % (name, count))
+            lines.append('%s.mean:%.3f|g' % (name, total / count))
+            lines.append('%s.min:%.3f|g' % (name, histogram.min))
+            lines.append('%s.max:%.3f|g' % (name, histogram.max))
+            flushed[key] = histogram.count
+            flushed[key_sum] = histogram.sum
+            histogram.reset()
+
+        return lines
+
+
+class StatsdFlusher(object):
+    """Sends the metrics of a registry to statsd every *interval* seconds.
+
+    The lines are batched in packets of at most *packet_size* bytes.
+    """
+
+    def __init__(self, metrics, host='localhost', port=8125,
+                 prefix='vaurien', interval=1., packet_size=512):
+        self.metrics = metrics
+        self.address = (host, port)
+        self.prefix = prefix and prefix + '.' or ''
+        self.interval = interval
+        self.packet_size = packet_size
+        self._sock = None
+        self._greenlet = None
+
+    def start(self):
+        family, type_, proto, _, address = socket.getaddrinfo(
+            self.address[0], self.address[1], 0, socket.SOCK_DGRAM)[0]
+        self.address = address
+        self._sock = socket.socket(family, type_, proto)
+        self._greenlet = gevent.spawn(self._run)
+
+    def stop(self):
+        if self._greenlet is None:
+            return
+        self._greenlet.kill()
+        self._greenlet = None
+        self.flush()
+        self._sock.close()
+
+    def _run(self):
+        while True:
+            gevent.sleep(self.interval)
+            self.flush()
+
+    def get_packets(self):
+        packets = []
+        packet = ''
+        for line in self.metrics.collect():
+            line = self.prefix + line
+            if packet and len(packet) + len(line) + 1 > self.packet_size:
+                packets.append(packet)
+                packet = ''
+            packet = packet and packet + '\n' + line or line
+        if packet:
+            packets.append(packet)
+        return packets
+
+    def flush(self):
+        for packet in self.get_packets():
+            try:
+                self._sock.sendto(packet, self.address)
+            except socket.error:
+                # statsd is best-effort
+                pass
@@ -72,6 +72,9 @@ Protocol.register(Redis)
 from vaurien.protocols.memcache import Memcache
 Protocol.register(Memcache)
 
+from vaurien.protocols.memcache_binary import MemcacheBinary
+Protocol.register(MemcacheBinary)
+
 from vaurien.protocols.http import Http
 Protocol.register(Http)
 
@@ -80,3 +83,15 @@ Protocol.register(SMTP)
 
 from vaurien.protocols.mysql import MySql
 Protocol.register(MySql)
+
+from vaurien.protocols.postgresql import PostgreSql
+Protocol.register(PostgreSql)
+
+from vaurien.protocols.http2 import Http2
+Protocol.register(Http2)
+
+from vaurien.protocols.mongodb import MongoDB
+Protocol.register(MongoDB)
+
+from vaurien.protocols.auto import Auto
+Protocol.register(Auto)
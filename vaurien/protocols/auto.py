@@ -0,0 +1,134 @@
+import copy
+import struct
+import time
+from socket import MSG_PEEK
+
+import gevent
+from gevent.socket import wait_read, timeout
+
+from vaurien.protocols.base import BaseProtocol
+from vaurien.protocols.postgresql import (SSL_REQUEST, GSSENC_REQUEST,
+                                          CANCEL_REQUEST)
+
+
+# the most bytes peeked at to tell the protocol
+_SNIFF_SIZE = 16
+
+_HTTP_METHODS = frozenset(['GET', 'HEAD', 'POST', 'PUT', 'DELETE', 'OPTIONS',
+                           'PATCH', 'TRACE', 'CONNECT'])
+_MEMCACHE_COMMANDS = frozenset([
+    'get', 'gets', 'gat', 'gats', 'set', 'add', 'replace', 'append',
+    'prepend', 'cas', 'incr', 'decr', 'delete', 'touch', 'stats', 'version',
+    'verbosity', 'flush_all', 'quit', 'mg', 'ms', 'md', 'ma', 'mn', 'me'])
+_WORDS = dict([(word, 'http') for word in _HTTP_METHODS] +
+              [(word, 'memcache') for word in _MEMCACHE_COMMANDS] +
+              # the preface of HTTP/2 with prior knowledge
+              [('PRI', 'http2')])
+_POSTGRESQL_CODES = frozenset([196608, SSL_REQUEST, GSSENC_REQUEST,
+                               CANCEL_REQUEST])
+
+
+def detect(data):
+    """Returns the name of the protocol starting with *data*, '' if it is
+    none of them, or None if more data is needed to tell.
+
+    TLS connections are handled by the *tcp* protocol.
+    """
+    if not data:
+        return None
+    first = data[0]
+    if first == '\x16':
+        # a TLS record, its version starts with 3
+        if len(data) < 2:
+            return None
+        return data[1] == '\x03' and 'tcp' or ''
+    if first == '\x80':
+        return 'memcache_binary'
+    if first == '*':
+        return 'redis'
+    if first == '\x00':
+        # the length and the code of a PostgreSQL startup message
+        if len(data) < 8:
+            return None
+        code = struct.unpack('>I', data[4:8])[0]
+        return code in _POSTGRESQL_CODES and 'postgresql' or ''
+
+    for pos, char in enumerate(data):
+        if char in ' \r\n':
+            return _WORDS.get(data[:pos], '')
+    if any(word.startswith(data) for word in _WORDS):
+        return None
+    return ''
+
+
+def parse_routes(routes, host):
+    """Returns a mapping of the protocol names of a comma-separated list
+    of *name=host:port* or *name=port* routes to their backend, *host*
+    being the one of the ports alone.
+
+    Raises a ValueError for a malformed route.
+    """
+    parsed = {}
+    for route in routes.split(','):
+        route = route.strip()
+        if not route:
+            continue
+        if '=' not in route:
+            raise ValueError('Expected PROTOCOL=[HOST:]PORT: %r' % route)
+        name, backend = [part.strip() for part in route.split('=', 1)]
+        if ':' not in backend:
+            backend = '%s:%s' % (host, backend)
+        parsed[name] = backend
+    return parsed
+
+
+class Auto(BaseProtocol):
+    """Picks the protocol of each connection from its first bytes.
+
+    The proxy peeks at them, leaving them in the socket, and handles the
+    connection with the protocol they match: *http*, *http2*, *redis*,
+    *memcache*, *memcache_binary* or *postgresql*. TLS connections go
+    through *tcp*.
+
+    Connections matching nothing, or whose client doesn't speak within
+    *sniff_timeout* seconds because the server speaks first as with
+    MySQL or SMTP, are handled by the *fallback* protocol.
+
+    The connections of each protocol go to the proxy backend, or to their
+    own one listed in *routes*, e.g. *http=8080,redis=cache:6379*. They
+    get their own pools of backend connections. The options of the
+    protocols picked are the usual ones.
+    """
+    name = 'auto'
+    options = copy.copy(BaseProtocol.options)
+    del options['keep_alive']
+    options['fallback'] = ("The protocol of the connections matching none.",
+                           str, 'tcp')
+    options['sniff_timeout'] = ("Seconds to wait for the first bytes of a "
+                                "connection.", float, 1.)
+    options['routes'] = ("Comma-separated PROTOCOL=[HOST:]PORT, the backend "
+                         "of the connections of a protocol. The proxy "
+                         "backend if not listed.", str, '')
+
+    def sniff(self, sock):
+        """Returns the name of the protocol of the connection of *sock*,
+        from its first bytes. They are left in the socket."""
+        deadline = time.time() + self.option('sniff_timeout')
+        data = name = None
+        while True:
+            left = deadline - time.time()
+            if left <= 0:
+                break
+            try:
+                wait_read(sock.fileno(), timeout=left)
+            except timeout:
+                break
+            peeked = sock.recv(_SNIFF_SIZE, MSG_PEEK)
+            name = detect(peeked)
+            if name is not None or not peeked or len(peeked) == _SNIFF_SIZE:
+                break
+            if peeked == data:
+                # the socket stays readable until the data is consumed
+                gevent.sleep(0.01)
+            data = peeked
+        return name or self.option('fallback')
@@ -1,5 +1,32 @@
 import copy
-from vaurien.util import get_data
+
+from vaurien.behaviors.dummy import Dummy
+from vaurien.util import (get_data, get_data_into, BufferPool, convert_option,
+                          compile_options, apply_settings)
+
+
+class Message(object):
+    """What a behavior is told about a message before it's forwarded.
+
+    *name* is the command or the type of the message, None if the
+    protocol can't tell. *size* is its size in bytes if it's known from
+    its start, None otherwise. *to_backend* is True for the messages of
+    the client.
+    """
+    __slots__ = ('name', 'size', 'to_backend')
+
+    def __init__(self, name, size=None, to_backend=True):
+        self.name = name
+        self.size = size
+        self.to_backend = to_backend
+
+
+def _proceed():
+    return True
+
+
+# the behavior of the messages the options of a protocol leave alone
+PASSTHROUGH = Dummy()
 
 
 class BaseProtocol(object):
@@ -11,6 +38,21 @@ class BaseProtocol(object):
                'keep_alive': ("Keep the connection alive", bool, False)
                }
 
+    # True when the handler only reads from its source socket, so both
+    # directions of a connection can be pumped at the same time.
+    # Half-duplex handlers read the answer from the backend themselves.
+    duplex = False
+
+    # the application protocols negotiated with ALPN over TLS, if any
+    alpn = None
+
+    # True when the connection carries several streams: the faults then
+    # apply to the stream of a message, the other ones going on.
+    multiplexed = False
+
+    # read buffers, bound to the sockets
+    _buffers = None
+
     def __init__(self, settings=None, proxy=None):
         self.proxy = proxy
         if proxy is not None:
@@ -22,6 +64,9 @@ class BaseProtocol(object):
             self.settings = {}
         else:
             self.settings = copy.copy(settings)
+        self.version = 0
+        self.opts = compile_options(self.options, self.settings)
+        self._compile()
 
     def _abort_handling(self, to_backend, backend_sock):
         if not to_backend:
@@ -31,27 +76,242 @@ class BaseProtocol(object):
                 backend_sock._closed = True
 
     def update_settings(self, settings):
-        self.settings.update(settings)
+        previous = self.opts, self.settings, self.version
+        apply_settings(self, settings)
+        try:
+            self._compile()
+        except ValueError:
+            self.opts, self.settings, self.version = previous
+            raise
+
+    def _compile(self):
+        """Prepares what the protocol derives from its options, when its
+        settings change. Raises a ValueError to reject them."""
 
     def _convert(self, value, type_):
-        if isinstance(value, type_):
-            return value
-        if type_ == bool:
-            value = value.lower()
-            return value in ('y', 'yes', '1', 'on')
-        return type_(value)
+        return convert_option(value, type_)
 
     def option(self, name):
-        type_, default = self.options[name][1:3]
-        value = self.settings.get(name, default)
-        return self._convert(value, type_)
+        return getattr(self.opts, name)
+
+    def may_idle(self, backend_sock, idle):
+        """Returns True if a connection with nothing in flight, idle for
+        *idle* seconds, can stay open past the proxy timeout."""
+        return False
+
+    def get_details(self):
+        """Returns a mapping of what the proxy reports about the protocol
+        when it starts, like the implementation it picked among several."""
+        return {}
+
+    def can_splice(self, behavior):
+        """Returns True if the data can be moved by the kernel with
+        splice(2) when *behavior* is active, skipping the handler."""
+        return False
+
+    # The faults the behaviors ask for, applied to the next message of
+    # *source* by the protocols knowing their messages. They return what
+    # the on_before_handle() hook of the behavior returns, or None to
+    # leave the fault to the behavior.
+
+    def inject_error(self, source, dest, to_backend):
+        """Fails the next message of *source*, as the *error* behavior
+        does."""
+        return None
+
+    def drop_message(self, source, dest, to_backend):
+        """Drops the next message of *source*, as the *drop* behavior
+        does."""
+        return None
+
+    def abort_message(self, source, dest, to_backend):
+        """Aborts the next message of *source*, as the *abort* behavior
+        does."""
+        return None
+
+    def delay_message(self, source, dest, to_backend, seconds):
+        """Holds the next message of *source* for *seconds*, as the
+        *delay* behavior does."""
+        return None
 
     def _get_data(self, sock, buffer=None):
         if buffer is None:
             buffer = self.option('buffer')
         return get_data(sock, buffer)
 
+    def _get_buffer(self, sock):
+        """Returns the *(bytearray, memoryview)* read buffer of *sock*."""
+        size = self.option('buffer')
+        if self._buffers is None or self._buffers.size != size:
+            self._buffers = BufferPool(size)
+        return self._buffers.get(sock)
+
+    def release_buffer(self, sock):
+        """Gives the read buffer of *sock* back, once it's closed."""
+        sock._kept = 0
+        if self._buffers is not None:
+            self._buffers.put(sock)
+
+    def read_data(self, sock):
+        """Returns the next data of *sock*: what is waiting in its read
+        buffer, see :meth:`_keep`, or else what can be read from it.
+
+        Behaviors consuming data themselves read it this way, as the
+        protocols may have peeked at it already, see :meth:`describe`.
+        """
+        if self.has_pending(sock):
+            return str(self._get_buffer(sock)[0][:self._fill(sock)])
+        return self._get_data(sock)
+
+    def has_pending(self, sock):
+        """Returns True if data read from *sock* is waiting in its buffer
+        to be handled, see :meth:`_keep`."""
+        return getattr(sock, '_kept', 0) > 0
+
+    def is_idle(self, sock):
+        """Returns True if *sock* is between two messages, so it can be
+        handed to another client."""
+        parser = getattr(sock, '_parser', None)
+        return (not self.has_pending(sock) and
+                (parser is None or parser.at_boundary()))
+
+    def _get_view(self, sock, size=None):
+        """Reads data in the buffer of *sock* and returns a memoryview
+        of what was read.
+
+        Unlike :meth:`_get_data` nothing is allocated per call, but the
+        view is only valid until the next read on the same socket.
+        """
+        buffer, view = self._get_buffer(sock)
+        if size is None or size > len(buffer):
+            size = len(buffer)
+        return view[:get_data_into(sock, view, size)]
+
+    def _fill(self, sock):
+        """Returns the number of bytes of data at the start of the read
+        buffer of *sock*: the data kept by :meth:`_keep` if any, or else
+        what could be read from the socket.
+
+        Used by the protocols that handle one message per call: what
+        they read past the end of a message is kept for the next call.
+        """
+        buffer, view = self._get_buffer(sock)
+        kept = getattr(sock, '_kept', 0)
+        if kept:
+            sock._kept = 0
+            return kept
+        return get_data_into(sock, view)
+
+    def _keep(self, sock, start, end):
+        """Keeps the *start:end* bytes of the read buffer of *sock* for the
+        next :meth:`_fill`."""
+        if start < end:
+            if start:
+                buffer = self._get_buffer(sock)[0]
+                buffer[:end - start] = buffer[start:end]
+            sock._kept = end - start
+
+    def _peek(self, sock, size):
+        """Reads until at least *size* bytes are at the start of the read
+        buffer of *sock*, and keeps them for the next :meth:`_fill`.
+
+        Returns the number of bytes available, less than *size* if *sock*
+        was closed.
+        """
+        buffer, view = self._get_buffer(sock)
+        available = self._fill(sock)
+        while 0 < available < size:
+            read = get_data_into(sock, view[available:])
+            if not read:
+                break
+            available += read
+        self._keep(sock, 0, available)
+        return available
+
+    def describe(self, source, dest, to_backend):
+        """Returns the :class:`Message` the next call forwards from
+        *source*, or None if the protocol forwards chunks of data.
+
+        Called before the message is read, it may :meth:`_peek` at its
+        start.
+        """
+        return None
+
+    def _peek_words(self, sock, count, limit=256):
+        """Returns the first *count* words of the data to be read from
+        *sock*, peeking at it with :meth:`_peek`.
+
+        Fewer words are returned if *sock* is closed first or if they
+        don't fit in *limit* bytes.
+        """
+        buffer = self._get_buffer(sock)[0]
+        limit = min(limit, len(buffer))
+        available = self._peek(sock, 1)
+        while True:
+            head = str(buffer[:min(available, limit)])
+            words = head.split()
+            if words and not head[-1].isspace():
+                # the last word may go on
+                words.pop()
+            if len(words) >= count or available >= limit:
+                return words[:count]
+            size = self._peek(sock, available + 1)
+            if size <= available:
+                return words[:count]
+            available = size
+
+    def _create_parser(self, to_backend):
+        """Returns a parser for the messages read from the client if
+        *to_backend* is True, from the backend otherwise.
+
+        A parser has a *feed(buffer, start, end)* method returning the
+        position right after the first message ending in
+        *buffer[start:end]*, or -1, and an *at_boundary()* method telling
+        if it is between two messages.
+        """
+        raise NotImplementedError()
+
+    def _get_parser(self, sock, to_backend):
+        """Returns the parser of the messages read from *sock*."""
+        parser = getattr(sock, '_parser', None)
+        if parser is None:
+            parser = sock._parser = self._create_parser(to_backend)
+        return parser
+
+    def _forward_message(self, source, dest, parser):
+        """Forwards one message from *source* to *dest*, as it is read.
+
+        Returns False if *source* was closed before the end of the
+        message or if the data could not be parsed.
+        """
+        buffer, view = self._get_buffer(source)
+        while True:
+            size = self._fill(source)
+            if not size:
+                return False
+            try:
+                end = parser.feed(buffer, 0, size)
+            except ValueError, e:
+                if self.logger is not None:
+                    self.logger.error('%s: %s' % (self.name, e))
+                return False
+            if end != -1:
+                break
+            dest.sendall(view[:size])
+
+        dest.sendall(view[:end])
+        self._keep(source, end, size)
+        return True
+
     def __call__(self, source, dest, to_backend, behavior):
+        if behavior.name == 'dummy':
+            # nothing to call for the data going through untouched
+            return self._handle(source, dest, to_backend, _proceed)
+        on_message = getattr(behavior, 'on_message', None)
+        if on_message is not None:
+            message = self.describe(source, dest, to_backend)
+            if message is not None and not on_message(self, message):
+                return self._handle(source, dest, to_backend, _proceed)
         if not behavior.on_before_handle(self, source, dest, to_backend):
             return True
         try:
@@ -1,26 +1,395 @@
 import re
 import copy
+from collections import deque
 
 try:
-    from http_parser.parser import HttpParser
+    import httptools
 except ImportError:
-    from http_parser.pyparser import HttpParser
+    httptools = None
 
-from vaurien.protocols.base import BaseProtocol
+try:
+    from http_parser.parser import HttpParser as _CHttpParser
+except ImportError:
+    _CHttpParser = None
+
+from vaurien.behaviors.error import random_http_error
+from vaurien.protocols.base import BaseProtocol, Message, PASSTHROUGH
+from vaurien.protocols.websocket import (Framer, WebSocket, parse_opcodes,
+                                         DROP, CORRUPT)
 
 
-HOST_REPLACE = re.compile(r'\r\nHost: .+\r\n')
+HOST_REPLACE = re.compile(r'^Host:[^\r\n]*', re.M | re.I)
 CRLF = '\r\n'
 
+# the header block of a message is kept in memory to be parsed, up to
+# this size
+MAX_HEAD = 65536
+# chunk size lines and trailers are short
+_MAX_LINE = 4096
+
+# framing of the body of a message
+_HEAD, _NONE, _LENGTH, _CHUNK_SIZE, _CHUNK_DATA, _TRAILERS, _CLOSE = range(7)
+
+
+def parse_head(head):
+    """Parses the header block *head* of a message.
+
+    Returns the words of its start line and a mapping of the lower-cased
+    header names to their values. Repeated headers are joined with
+    commas. Raises a ValueError if *head* is not a valid header block.
+    """
+    lines = str(head).lstrip(CRLF).split('\n')
+    start = lines[0].rstrip('\r').split(None, 2)
+    if len(start) < 2:
+        raise ValueError('Invalid HTTP start line: %r' % lines[0][:80])
+
+    headers = {}
+    for line in lines[1:]:
+        line = line.rstrip('\r')
+        if not line:
+            continue
+        name, sep, value = line.partition(':')
+        if not sep:
+            raise ValueError('Invalid HTTP header: %r' % line[:80])
+        name = name.strip().lower()
+        value = value.strip()
+        if name in headers:
+            headers[name] += ', ' + value
+        else:
+            headers[name] = value
+    return start, headers
+
+
+class _HttptoolsHead(object):
+    # collects what httptools finds in a header block
+
+    def __init__(self):
+        self.url = ''
+        self.headers = {}
+
+    def on_url(self, url):
+        self.url += url
+
+    def on_header(self, name, value):
+        name = name.lower()
+        if name in self.headers:
+            self.headers[name] += ', ' + value
+        else:
+            self.headers[name] = value
+
+
+def parse_head_httptools(head):
+    """Like :func:`parse_head`, with httptools."""
+    head = str(head).lstrip(CRLF)
+    found = _HttptoolsHead()
+    if head[:5] == 'HTTP/':
+        parser = httptools.HttpResponseParser(found)
+    else:
+        parser = httptools.HttpRequestParser(found)
+    try:
+        parser.feed_data(head)
+    except httptools.HttpParserError, e:
+        raise ValueError('Invalid HTTP header block: %s' % e)
+    version = 'HTTP/' + parser.get_http_version()
+    if head[:5] == 'HTTP/':
+        start = [version, str(parser.get_status_code())]
+    else:
+        start = [parser.get_method(), found.url, version]
+    return start, found.headers
+
+
+def parse_head_http_parser(head):
+    """Like :func:`parse_head`, with the C extension of http-parser."""
+    head = str(head).lstrip(CRLF)
+    response = head[:5] == 'HTTP/'
+    parser = _CHttpParser(kind=response and 1 or 0)
+    if (parser.execute(head, len(head)) != len(head) or
+            not parser.is_headers_complete()):
+        raise ValueError('Invalid HTTP header block: %r' % head[:80])
+    version = 'HTTP/%d.%d' % parser.get_version()
+    if response:
+        start = [version, str(parser.get_status_code())]
+    else:
+        start = [parser.get_method(), parser.get_url(), version]
+    headers = dict((name.lower(), value)
+                   for name, value in parser.get_headers().items())
+    return start, headers
+
+
+# the header block parsers, fastest first. The C extension of http-parser
+# builds more than what is needed here, and is slower than parse_head
+# on the messages of loadtest/corpus.
+HEAD_PARSERS = [('python', parse_head)]
+if httptools is not None:
+    HEAD_PARSERS.insert(0, ('httptools', parse_head_httptools))
+if _CHttpParser is not None:
+    HEAD_PARSERS.append(('http_parser', parse_head_http_parser))
+
+
+def get_head_parser(name='auto'):
+    """Returns the name and the function of the header block parser
+    called *name*, or of the fastest one available for *auto*.
+
+    Raises a ValueError if it is not available.
+    """
+    for parser_name, func in HEAD_PARSERS:
+        if name in ('auto', parser_name):
+            return parser_name, func
+    raise ValueError('The %r HTTP parser is not available. Pick one of: %s.'
+                     % (name, ', '.join(parser_name for parser_name, func
+                                        in HEAD_PARSERS)))
+
+
+class MessageParser(object):
+    """Incremental framing of HTTP/1.x messages.
+
+    The header block of a message is accumulated by :meth:`feed_head`,
+    then parsed once by :meth:`parse`. The body is framed by
+    :meth:`feed_body` from its Content-Length or its chunks without being
+    accumulated: only the chunk size lines are looked at.
+
+    Once parsed, *method* is the method of a request, *status* the status
+    of a response, and *keep_alive* tells if the connection can be used
+    for another message. *upgrade* is the lower-cased protocol a request
+    asks to switch to, or the one a response switches to.
+
+    *parse_head* is the function parsing the header blocks, see
+    :func:`get_head_parser`.
+    """
+
+    def __init__(self, requests=False, parse_head=parse_head):
+        self.requests = requests
+        self._parse_head = parse_head
+        self.head = bytearray()
+        self.headers = {}
+        self.method = None
+        self.status = None
+        self.keep_alive = True
+        self.upgrade = None
+        self._state = _HEAD
+        # bytes of the body, or of the current chunk and its CRLF, left
+        self._skip = 0
+        self._line = bytearray()
+
+    def at_boundary(self):
+        """Returns True if the parser is between two messages."""
+        return self._state == _HEAD and not self.head
+
+    @property
+    def in_head(self):
+        """True until the header block is parsed."""
+        return self._state == _HEAD
+
+    @property
+    def done(self):
+        """True once the whole message was fed."""
+        return self._state == _NONE
+
+    def feed_head(self, buffer, start, end):
+        """Adds *buffer[start:end]* to the header block.
+
+        Returns the position right after the header block once it is
+        complete, or -1. Raises a ValueError if it is too large.
+        """
+        offset = len(self.head)
+        self.head.extend(buffer[start:end])
+        if not offset:
+            # empty lines between two messages are ignored
+            while self.head[:2] == CRLF:
+                del self.head[:2]
+                start += 2
+        pos = self.head.find('\n\r\n', max(offset - 2, 0))
+        if pos == -1:
+            if len(self.head) > MAX_HEAD:
+                raise ValueError('HTTP header block too large')
+            return -1
+        pos += 3
+        used = pos - offset
+        del self.head[pos:]
+        return start + used
+
+    def parse(self, method=None):
+        """Parses the header block and sets up the framing of the body.
+
+        *method* is the method of the request a response answers.
+        """
+        start, headers = self._parse_head(self.head)
+        self.headers = headers
+        connection = [token.strip().lower()
+                      for token in headers.get('connection', '').split(',')]
+        if 'upgrade' in connection:
+            self.upgrade = headers.get('upgrade', '').strip().lower()
+        else:
+            self.upgrade = None
+
+        tunnel = False
+        if self.requests:
+            self.method, version = start[0].upper(), start[-1].upper()
+            self.status = None
+            body = True
+        else:
+            version = start[0].upper()
+            try:
+                self.status = int(start[1])
+            except ValueError:
+                raise ValueError('Invalid HTTP status: %r' % start[1])
+            body = not (method == 'HEAD' or self.status < 200 or
+                        self.status in (204, 304))
+            tunnel = (self.status == 101 and self.upgrade != 'websocket' or
+                      method == 'CONNECT' and 200 <= self.status < 300)
+
+        if version == 'HTTP/1.0':
+            self.keep_alive = 'keep-alive' in connection
+        else:
+            self.keep_alive = 'close' not in connection
+
+        self._state = _NONE
+        if tunnel:
+            # the connection is not HTTP anymore
+            self._state = _CLOSE
+            self.keep_alive = False
+            return
+        if not body:
+            return
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            self._state = _CHUNK_SIZE
+        elif 'content-length' in headers:
+            lengths = set(length.strip() for length
+                          in headers['content-length'].split(','))
+            try:
+                if len(lengths) != 1:
+                    raise ValueError()
+                self._skip = int(lengths.pop())
+                if self._skip < 0:
+                    raise ValueError()
+            except ValueError:
+                raise ValueError('Invalid Content-Length: %r'
+                                 % headers['content-length'])
+            if self._skip:
+                self._state = _LENGTH
+        elif (not self.requests or self.method == 'CONNECT' or
+              self.upgrade not in (None, 'websocket')):
+            # read until the connection is closed. The frames of a
+            # WebSocket come after the response instead
+            self._state = _CLOSE
+            self.keep_alive = False
+
+    def reset(self):
+        """Gets ready for the next message."""
+        self.head = bytearray()
+        self._state = _HEAD
+
+    def feed_body(self, buffer, start, end):
+        """Parses *buffer[start:end]*, part of the body.
+
+        Returns the position right after the end of the body, or -1 if
+        all the data is part of it. Raises a ValueError if the chunks are
+        invalid.
+        """
+        pos = start
+        while pos < end:
+            state = self._state
+            if state in (_LENGTH, _CHUNK_DATA):
+                count = min(self._skip, end - pos)
+                pos += count
+                self._skip -= count
+                if self._skip:
+                    return -1
+                if state == _LENGTH:
+                    self._state = _NONE
+                    return pos
+                self._state = _CHUNK_SIZE
+                continue
+
+            if state == _CLOSE:
+                return -1
+            if state == _NONE:
+                return pos
+
+            eol = buffer.find('\n', pos, end)
+            if eol == -1:
+                self._line.extend(buffer[pos:end])
+                if len(self._line) > _MAX_LINE:
+                    raise ValueError('HTTP chunk line too long')
+                return -1
+            self._line.extend(buffer[pos:eol])
+            line = str(self._line).strip()
+            self._line = bytearray()
+            pos = eol + 1
+
+            if state == _CHUNK_SIZE:
+                try:
+                    size = int(line.split(';', 1)[0], 16)
+                except ValueError:
+                    raise ValueError('Invalid HTTP chunk size: %r'
+                                     % line[:80])
+                if size:
+                    self._skip = size + len(CRLF)
+                    self._state = _CHUNK_DATA
+                else:
+                    self._state = _TRAILERS
+            elif not line:
+                # the end of the trailers
+                self._state = _NONE
+                return pos
+
+        if self._state == _NONE:
+            return pos
+        return -1
+
 
 class Http(BaseProtocol):
     """HTTP protocol.
+
+    Requests and responses are handled one at a time, in both directions
+    at the same time, so pipelined requests flow through. The header
+    block of every message is parsed once, the bodies are streamed.
+
+    The backend connections are kept in the pool between two clients
+    unless the backend asks to close them. The client connections are
+    kept open if the *keep_alive* option is set and the client asks for
+    it.
+
+    Once a WebSocket handshake is done, the frames of the connection are
+    forwarded by a :class:`vaurien.protocols.websocket.Framer`, and the
+    behaviors apply to the messages whose type is in *websocket_frames*:
+
+    - *drop* drops the message.
+    - *error* corrupts a few bytes of its payload.
+    - *abort* sends a close frame with the *websocket_close_code* status
+      to both peers instead, and closes the connection.
+    - *delay* holds it and the ones following it back, as with TCP.
+
+    The name of their :class:`vaurien.protocols.base.Message` is the type
+    of the frame, e.g. *TEXT*.
     """
     name = 'http'
     options = copy.copy(BaseProtocol.options)
     options['overwrite_host_header'] = ("If True, the HTTP Host header will "
                                         "be rewritten with backend address.",
                                         bool, False)
+    options['reuse_socket'] = ("If True, the socket is reused.", bool, True)
+    options['keep_alive'] = ("Keep the connection alive", bool, True)
+    options['parser'] = ("The HTTP header parser: auto picks the fastest "
+                         "one available.", str, 'auto',
+                         ['auto'] + [parser[0] for parser in HEAD_PARSERS])
+    options['websocket_frames'] = ("Comma-separated types of the WebSocket "
+                                   "frames starting the messages the "
+                                   "behaviors apply to.", str, 'TEXT,BINARY')
+    options['websocket_close_code'] = ("Status of the close frames sent by "
+                                       "the abort behavior.", int, 1001)
+    options['websocket_idle_timeout'] = ("Seconds a WebSocket can stay idle. "
+                                         "0 for no limit.", float, 0)
+    duplex = True
+
+    def _compile(self):
+        self.parser, self._parse_head = get_head_parser(self.option('parser'))
+        self._framer = Framer(self,
+                              parse_opcodes(self.option('websocket_frames')),
+                              self.option('websocket_close_code'))
+
+    def get_details(self):
+        return {'parser': self.parser}
 
     def _close_both(self, source, dest):
         source.close()
@@ -29,47 +398,189 @@ class Http(BaseProtocol):
         dest._closed = True
         return False
 
+    def _create_parser(self, to_backend):
+        return MessageParser(requests=to_backend,
+                             parse_head=self._parse_head)
+
+    def get_pending_requests(self, backend_sock):
+        """Returns the *(method, keep_alive)* of the requests sent on
+        *backend_sock* waiting for a response, oldest first."""
+        requests = getattr(backend_sock, '_requests', None)
+        if requests is None:
+            requests = backend_sock._requests = deque()
+        return requests
+
+    def get_websocket(self, backend_sock):
+        """Returns the :class:`vaurien.protocols.websocket.WebSocket`
+        state of the connection to *backend_sock*, or None before its
+        handshake."""
+        return getattr(backend_sock, '_websocket', None)
+
+    def is_idle(self, sock):
+        return (super(Http, self).is_idle(sock) and
+                not getattr(sock, '_requests', None) and
+                self.get_websocket(sock) is None)
+
+    def may_idle(self, backend_sock, idle):
+        timeout = self.option('websocket_idle_timeout')
+        return (self.get_websocket(backend_sock) is not None and
+                (not timeout or idle < timeout))
+
+    def describe(self, source, dest, to_backend):
+        if not self._peek(source, 1):
+            return None
+        websocket = self.get_websocket(to_backend and dest or source)
+        if websocket is not None:
+            found = self._framer.describe(websocket, source, to_backend)
+            return found and Message(found[0], found[1], to_backend)
+        if not to_backend:
+            # responses are named after the method of their request
+            pending = self.get_pending_requests(source)
+            return Message(pending and pending[0][0] or None,
+                           to_backend=False)
+        words = self._peek_words(source, 1)
+        return Message(words and words[0] or None)
+
+    def __call__(self, source, dest, to_backend, behavior):
+        backend_sock = to_backend and dest or source
+        websocket = self.get_websocket(backend_sock)
+        if websocket is None and to_backend:
+            parser = getattr(source, '_parser', None)
+            if parser is not None and parser.upgrade == 'websocket':
+                # the frames only come once the handshake is done
+                self._peek(source, 1)
+                websocket = self.get_websocket(backend_sock)
+        if websocket is not None:
+            self._framer.wait(source)
+            if behavior.name != 'dummy' and not self._framer.targeted(
+                    websocket, source, to_backend):
+                behavior = PASSTHROUGH
+        return super(Http, self).__call__(source, dest, to_backend,
+                                          behavior)
+
+    # the faults of the behaviors, for the WebSocket connections. They
+    # return None for the other ones.
+
+    def drop_message(self, source, dest, to_backend):
+        """Drops the WebSocket message starting with the next frame of
+        *source*, as the *drop* behavior does."""
+        websocket = self.get_websocket(to_backend and dest or source)
+        if websocket is None:
+            return None
+        return self._framer.fault(websocket, source, to_backend, DROP)
+
+    def inject_error(self, source, dest, to_backend):
+        """Corrupts the payload of the WebSocket message starting with
+        the next frame of *source*, as the *error* behavior does.
+
+        A request is read and gets a 5xx error response instead of
+        reaching the server, and its client connection is closed.
+        """
+        websocket = self.get_websocket(to_backend and dest or source)
+        if websocket is not None:
+            return self._framer.fault(websocket, source, to_backend, CORRUPT)
+        if not to_backend:
+            return None
+        if not self.read_data(source):
+            return False
+        source.sendall(random_http_error())
+        source.close()
+        source._closed = True
+        return False
+
+    def abort_message(self, source, dest, to_backend):
+        """Closes the WebSocket connection instead of forwarding the
+        next frame of *source*, as the *abort* behavior does."""
+        if self.get_websocket(to_backend and dest or source) is None:
+            return None
+        return self._framer.close(source, dest, to_backend)
+
+    def _rewrite_head(self, head, backend_sock):
+        host = getattr(backend_sock, '_backend', None) or self.proxy.backend
+        return HOST_REPLACE.sub('Host: %s' % host, str(head), 1)
+
     def _handle(self, source, dest, to_backend, on_between_handle):
-        buffer_size = self.option('buffer')
+        websocket = self.get_websocket(to_backend and dest or source)
+        if websocket is not None:
+            return self._framer.handle(websocket, source, dest, to_backend,
+                                       on_between_handle)
+        parser = self._get_parser(source, to_backend)
+        buffer, view = self._get_buffer(source)
 
-        # Getting the HTTP query and sending it to the backend.
-        parser = HttpParser()
-        while not parser.is_message_complete():
-            data = self._get_data(source, buffer_size)
-            if not data:
-                return self._close_both(source, dest)
-            nparsed = parser.execute(data, len(data))
-            assert nparsed == len(data)
-            if self.option('overwrite_host_header'):
-                data = HOST_REPLACE.sub('\r\nHost: %s\r\n'
-                                        % self.proxy.backend, data)
-            dest.sendall(data)
-        keep_alive_src = parser.should_keep_alive()
-        method = parser.get_method()
-
-        if on_between_handle():
-            # Getting the HTTP response and sending it back to the source.
-            parser = HttpParser()
-            while not (parser.is_message_complete() or
-                       (method == 'HEAD' and parser.is_headers_complete())):
-                data = self._get_data(dest, buffer_size)
-                if not data:
+        # the header block
+        try:
+            while True:
+                size = self._fill(source)
+                if not size:
+                    if to_backend and parser.at_boundary():
+                        # the client is done, the backend connection can
+                        # serve another one
+                        source.close()
+                        source._closed = True
+                        return False
                     return self._close_both(source, dest)
-                nparsed = parser.execute(data, len(data))
-                assert nparsed == len(data)
-                source.sendall(data)
-            keep_alive_dst = parser.should_keep_alive()
-
-            # do we close the client ?
-            if not keep_alive_src or not self.option('keep_alive'):
-                source.close()
-                source._closed = True
-
-            if (not keep_alive_dst or not self.option('reuse_socket') or not
-                self.option('keep_alive')):
+                pos = parser.feed_head(buffer, 0, size)
+                if pos != -1:
+                    break
+
+            if to_backend:
+                parser.parse()
+                request = parser.method, parser.keep_alive
+                self.get_pending_requests(dest).append(request)
+            else:
+                pending = self.get_pending_requests(source)
+                method, client_keep_alive = pending and pending[0] or (None,
+                                                                       True)
+                parser.parse(method)
+                if parser.status == 101 and parser.upgrade == 'websocket':
+                    # set before the client gets the response and sends
+                    # its first frame
+                    source._websocket = WebSocket()
+                    if pending:
+                        pending.popleft()
+                elif parser.status >= 200 and pending:
+                    pending.popleft()
+        except ValueError, e:
+            if self.logger is not None:
+                self.logger.error('http: %s' % e)
+            return self._close_both(source, dest)
+
+        if to_backend and self.option('overwrite_host_header'):
+            dest.sendall(self._rewrite_head(parser.head, dest))
+        else:
+            dest.sendall(parser.head)
+
+        # the body, streamed
+        try:
+            while not parser.done:
+                if pos == size:
+                    size, pos = self._fill(source), 0
+                    if not size:
+                        # the end of a body read until the connection is
+                        # closed, or of the connection in the middle of a
+                        # message
+                        return self._close_both(source, dest)
+                end = parser.feed_body(buffer, pos, size)
+                if end == -1:
+                    end = size
+                dest.sendall(view[pos:end])
+                pos = end
+        except ValueError, e:
+            if self.logger is not None:
+                self.logger.error('http: %s' % e)
+            return self._close_both(source, dest)
+
+        self._keep(source, pos, size)
+        parser.reset()
+
+        if not to_backend and parser.status >= 200:
+            if not parser.keep_alive:
+                # the backend closes the connection, and so does the
+                # client once it has the response
+                return self._close_both(source, dest)
+            if not (client_keep_alive and self.option('keep_alive')):
                 dest.close()
                 dest._closed = True
-        else:
-            keep_alive_dst = False
+                return False
 
-        return keep_alive_dst and self.option('keep_alive')
+        return on_between_handle()
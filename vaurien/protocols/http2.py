@@ -0,0 +1,701 @@
+import copy
+import struct
+from socket import error
+
+import gevent
+from gevent.lock import Semaphore
+
+from vaurien.protocols.base import BaseProtocol, Message, PASSTHROUGH
+from vaurien import _hpack
+
+
+PREFACE = 'PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n'
+# the length, type, flags and stream of the frames
+HEADER_SIZE = 9
+
+DATA, HEADERS, PRIORITY, RST_STREAM, SETTINGS, PUSH_PROMISE, PING, GOAWAY, \
+    WINDOW_UPDATE, CONTINUATION = range(10)
+
+FRAMES = {DATA: 'DATA', HEADERS: 'HEADERS', PRIORITY: 'PRIORITY',
+          RST_STREAM: 'RST_STREAM', SETTINGS: 'SETTINGS',
+          PUSH_PROMISE: 'PUSH_PROMISE', PING: 'PING', GOAWAY: 'GOAWAY',
+          WINDOW_UPDATE: 'WINDOW_UPDATE', CONTINUATION: 'CONTINUATION'}
+
+END_STREAM = 0x1
+END_HEADERS = 0x4
+PADDED = 0x8
+PRIORITY_FLAG = 0x20
+
+ERRORS = {'NO_ERROR': 0x0, 'PROTOCOL_ERROR': 0x1, 'INTERNAL_ERROR': 0x2,
+          'FLOW_CONTROL_ERROR': 0x3, 'SETTINGS_TIMEOUT': 0x4,
+          'STREAM_CLOSED': 0x5, 'FRAME_SIZE_ERROR': 0x6,
+          'REFUSED_STREAM': 0x7, 'CANCEL': 0x8, 'COMPRESSION_ERROR': 0x9,
+          'CONNECT_ERROR': 0xa, 'ENHANCE_YOUR_CALM': 0xb,
+          'INADEQUATE_SECURITY': 0xc, 'HTTP_1_1_REQUIRED': 0xd}
+
+# the frames starting a header block
+_BLOCKS = frozenset([HEADERS, PUSH_PROMISE])
+# the largest frame payload every peer accepts
+_MAX_PAYLOAD = 16384
+
+
+def frame(type_, flags, stream, payload=''):
+    """Returns an HTTP/2 frame."""
+    return (struct.pack('>I', len(payload))[1:] +
+            struct.pack('>BBI', type_, flags, stream) + payload)
+
+
+def _unpack(buffer, pos=0):
+    # the (length, type, flags, stream) of the frame header at *pos*
+    length = struct.unpack_from('>I', buffer, pos)[0] >> 8
+    type_, flags, stream = struct.unpack_from('>BBI', buffer, pos + 3)
+    return length, type_, flags, stream & 0x7fffffff
+
+
+class FrameParser(object):
+    """Incremental framing of HTTP/2 frames, see
+    https://httpwg.org/specs/rfc7540.html#FrameHeader
+
+    The frames are framed with their 9 bytes header, their payloads are
+    skipped over. With *requests*, the parser first expects the client
+    connection preface, and *preface* is True until it was read.
+
+    *type*, *flags*, *stream* and *length* are the ones of the last
+    frame, *type* is None for the preface.
+    """
+
+    def __init__(self, requests=False):
+        self.preface = requests
+        self.type = self.flags = self.stream = None
+        self.length = 0
+        self._header = bytearray()
+        # bytes of the payload left, None between two frames
+        self._skip = None
+
+    def at_boundary(self):
+        """Returns True if the parser is between two frames."""
+        return self._skip is None and not self._header
+
+    def feed(self, buffer, start, end):
+        """Parses *buffer[start:end]*.
+
+        Returns the position right after the first frame that ends in
+        it, or -1 if all the data is part of an unfinished frame.
+        """
+        pos = start
+        while True:
+            if self._skip is not None:
+                count = min(self._skip, end - pos)
+                pos += count
+                self._skip -= count
+                if self._skip:
+                    return -1
+                self._skip = None
+                return pos
+
+            if pos == end:
+                return -1
+            size = self.preface and len(PREFACE) or HEADER_SIZE
+            count = min(size - len(self._header), end - pos)
+            self._header.extend(buffer[pos:pos + count])
+            pos += count
+            if self.preface and \
+                    not PREFACE.startswith(str(self._header)):
+                raise ValueError('Not an HTTP/2 connection preface')
+            if len(self._header) < size:
+                return -1
+
+            if self.preface:
+                self.preface = False
+                self.type = self.flags = self.stream = None
+                self.length = 0
+            else:
+                (self.length, self.type, self.flags,
+                 self.stream) = _unpack(self._header)
+            self._header = bytearray()
+            self._skip = self.length
+
+
+class _Block(object):
+    """A header block read from a peer: its HEADERS or PUSH_PROMISE frame
+    and the CONTINUATION frames that follow, and its decoded headers."""
+
+    def __init__(self, type_, flags, stream):
+        self.type = type_
+        self.flags = flags
+        self.stream = stream
+        self.promised = None
+        self.frames = []
+        self.headers = []
+        self.updates = []
+
+    @property
+    def size(self):
+        return sum(len(data) for data in self.frames)
+
+    def get(self, name):
+        for header, value in self.headers:
+            if header == name:
+                return value
+        return None
+
+
+class _Stream(object):
+    """An open stream: the path of its request, and the ends its client
+    and its server closed."""
+    __slots__ = ('path', 'ended', 'responded')
+
+    CLIENT, SERVER = 1, 2
+
+    def __init__(self, path, ended=0):
+        self.path = path
+        self.ended = ended
+        self.responded = False
+
+
+class _Held(object):
+    """The frames of a delayed stream, sent by *timer*."""
+
+    def __init__(self):
+        self.timer = None
+        self.frames = []
+        # the bytes of the DATA frames, for the flow control
+        self.data = 0
+
+
+class Connection(object):
+    """The state of an HTTP/2 connection, shared by its two directions,
+    which are keyed by *to_backend*.
+
+    - *decoders*: the HPACK decoders of the header blocks of each peer.
+    - *reencode*: True once the header blocks of a direction are encoded
+      again, as the proxy changed their order or dropped some of them.
+    - *streams*: the :class:`_Stream` open streams.
+    - *reset*: the streams reset by the proxy, and the fault still to
+      report to the peers.
+    - *held*: the :class:`_Held` frames of the delayed streams.
+    - *started*: True once the SETTINGS frame starting a direction went
+      through. The frames the proxy sends before are *pending*, as
+      nothing can come before it.
+    """
+
+    def __init__(self):
+        self.decoders = {True: _hpack.Decoder(), False: _hpack.Decoder()}
+        self.reencode = {True: False, False: False}
+        # the locks of the sockets each direction writes to
+        self.locks = {True: Semaphore(), False: Semaphore()}
+        self.streams = {}
+        self.reset = {}
+        self.held = {True: {}, False: {}}
+        self.started = {True: False, False: False}
+        self.pending = {True: [], False: []}
+        # header blocks read ahead to describe them
+        self.blocks = {}
+        self.error = None
+        self._last_stream = 0
+
+    @property
+    def idle(self):
+        """True when no stream is open."""
+        return not self.streams and not (self.held[True] or
+                                         self.held[False])
+
+    def on_block(self, block, to_backend):
+        if block.type == PUSH_PROMISE:
+            # the client can't send on a pushed stream
+            self.streams[block.promised] = _Stream(block.get(':path'),
+                                                   _Stream.CLIENT)
+            return
+        stream = self.streams.get(block.stream)
+        if stream is None and to_backend and \
+                block.stream > self._last_stream:
+            self._last_stream = block.stream
+            stream = self.streams[block.stream] = _Stream(
+                block.get(':path'))
+        if stream is not None and not to_backend:
+            stream.responded = True
+        self.on_frame(block.type, block.flags, block.stream, to_backend)
+
+    def on_frame(self, type_, flags, stream_id, to_backend):
+        if type_ == SETTINGS:
+            self.started[to_backend] = True
+        elif type_ == RST_STREAM:
+            self.streams.pop(stream_id, None)
+        elif flags & END_STREAM and type_ in (DATA, HEADERS):
+            stream = self.streams.get(stream_id)
+            if stream is not None:
+                stream.ended |= to_backend and _Stream.CLIENT or \
+                    _Stream.SERVER
+                if stream.ended == _Stream.CLIENT | _Stream.SERVER:
+                    del self.streams[stream_id]
+
+
+class Http2(BaseProtocol):
+    """HTTP/2 protocol, for gRPC and the other HTTP/2 services.
+
+    The clients connect with prior knowledge (h2c), or over TLS with the
+    *h2* ALPN protocol when the proxy terminates it. The frames are
+    forwarded as they are read, in both directions at the same time, and
+    the behaviors apply to the streams one at a time instead of the whole
+    connection:
+
+    - *frames* lists the frames the behaviors apply to, by default the
+      HEADERS starting the requests and the responses. The name of their
+      :class:`vaurien.protocols.base.Message` is the path of the request,
+      e.g. */helloworld.Greeter/SayHello* for gRPC.
+    - *delay* holds back the frames of the stream only.
+    - *error* answers the request with a *status* response, or resets a
+      response already started.
+    - *abort* resets the stream, with the *reset_code* error code.
+
+    The other behaviors apply to the connection as with TCP.
+
+    The header blocks are decoded to follow the streams. Once a stream was
+    delayed or reset, the header blocks the proxy forwards are encoded
+    again, without compression state: their order can change. The DATA
+    frames are always forwarded as they are.
+
+    Connections with no stream open stay open past the proxy timeout, up
+    to *idle_timeout* seconds. They are not reused by other clients.
+    """
+    name = 'http2'
+    duplex = True
+    multiplexed = True
+    alpn = ['h2']
+    options = copy.copy(BaseProtocol.options)
+    del options['keep_alive']
+    options['buffer'] = ("Buffer size", int, 65536)
+    options['frames'] = ("Comma-separated types of the frames the "
+                         "behaviors apply to.", str, 'HEADERS')
+    options['status'] = ("Status of the responses sent by the error "
+                         "behavior.", int, 503)
+    options['reset_code'] = ("Error code of the streams reset by the "
+                             "abort behavior.", str, 'CANCEL')
+    options['idle_timeout'] = ("Seconds a connection can stay idle with no "
+                               "stream open. 0 for no limit.", float, 0)
+
+    def _compile(self):
+        types = dict((name, type_) for type_, name in FRAMES.items())
+        frames = set()
+        for name in self.option('frames').split(','):
+            name = name.strip().upper()
+            if not name:
+                continue
+            if name not in types:
+                raise ValueError('Unknown HTTP/2 frame %r' % name)
+            frames.add(types[name])
+        code = self.option('reset_code').strip().upper()
+        if code not in ERRORS:
+            raise ValueError('Unknown HTTP/2 error code %r' % code)
+        if not 100 <= self.option('status') < 600:
+            raise ValueError('Invalid HTTP status %d' % self.option('status'))
+        self._frames = frozenset(frames)
+        self._reset_code = ERRORS[code]
+
+    def _create_parser(self, to_backend):
+        return FrameParser(requests=to_backend)
+
+    def get_connection(self, backend_sock):
+        """Returns the :class:`Connection` state of the connection to
+        *backend_sock*."""
+        connection = getattr(backend_sock, '_http2', None)
+        if connection is None:
+            connection = backend_sock._http2 = Connection()
+        return connection
+
+    def is_idle(self, sock):
+        # the streams and the compression state belong to the client
+        return False
+
+    def may_idle(self, backend_sock, idle):
+        timeout = self.option('idle_timeout')
+        return (self.get_connection(backend_sock).idle and
+                (not timeout or idle < timeout))
+
+    def _log_error(self, e):
+        if self.logger is not None:
+            self.logger.error('%s: %s' % (self.name, e))
+
+    def _next_frame(self, connection, source, to_backend):
+        # the (length, type, flags, stream) of the next frame of *source*,
+        # or None before the preface or once *source* is closed
+        block = connection.blocks.get(to_backend)
+        if block is not None:
+            return block.size, block.type, block.flags, block.stream
+        if self._get_parser(source, to_backend).preface:
+            return None
+        if self._peek(source, HEADER_SIZE) < HEADER_SIZE:
+            return None
+        return _unpack(self._get_buffer(source)[0])
+
+    def _targeted(self, connection, source, to_backend):
+        # tells if the behaviors apply to the next frame of *source*
+        header = self._next_frame(connection, source, to_backend)
+        if header is None:
+            return False
+        type_, stream = header[1], header[3]
+        return (stream != 0 and type_ in self._frames and
+                stream not in connection.reset and
+                stream not in connection.held[to_backend])
+
+    def describe(self, source, dest, to_backend):
+        connection = self.get_connection(to_backend and dest or source)
+        header = self._next_frame(connection, source, to_backend)
+        if header is None or header[3] == 0:
+            return None
+        length, type_, flags, stream = header
+        block = connection.blocks.get(to_backend)
+        if block is None and type_ in _BLOCKS and to_backend:
+            # the path of a new request is in its block, read ahead
+            try:
+                block = self._read_block(connection, source, to_backend)
+            except ValueError, e:
+                connection.error = e
+                return None
+            if block is None:
+                return None
+            connection.blocks[to_backend] = block
+
+        known = connection.streams.get(stream)
+        if known is not None:
+            path = known.path
+        else:
+            path = block is not None and block.get(':path') or None
+        size = block is not None and block.size or HEADER_SIZE + length
+        return Message(path, size, to_backend)
+
+    def __call__(self, source, dest, to_backend, behavior):
+        if behavior.name != 'dummy':
+            connection = self.get_connection(to_backend and dest or source)
+            if not self._targeted(connection, source, to_backend):
+                behavior = PASSTHROUGH
+        return super(Http2, self).__call__(source, dest, to_backend,
+                                           behavior)
+
+    # the faults of the behaviors
+
+    def delay_message(self, source, dest, to_backend, seconds):
+        """Holds the next frame of *source* and the ones of its stream
+        that follow in the same direction for *seconds*, as the *delay*
+        behavior does. The other streams go on.
+
+        A request opening a stream goes to the server at once, its
+        response is held instead: the server must see the streams open
+        in order.
+
+        Returns True, the frame is then handled as usual.
+        """
+        connection = self.get_connection(to_backend and dest or source)
+        header = self._next_frame(connection, source, to_backend)
+        if header is None or header[3] == 0:
+            return True
+        stream = header[3]
+        if to_backend and stream not in connection.streams:
+            to_backend, dest = False, source
+        held = connection.held[to_backend]
+        if stream in connection.reset or stream in held:
+            return True
+        # the header blocks of the other streams will go first
+        connection.reencode[to_backend] = True
+        entry = held[stream] = _Held()
+        entry.timer = gevent.spawn_later(seconds, self._release, connection,
+                                         dest, to_backend, stream)
+        return True
+
+    def reset_stream(self, source, dest, to_backend, code=None):
+        """Resets the stream of the next frame of *source*, as the *abort*
+        behavior does: both peers get a RST_STREAM frame with the *code*
+        error code, *reset_code* by default, and the frames of the stream
+        are dropped from then on.
+
+        Returns True, the frame is then handled as usual.
+        """
+        if code is None:
+            code = self._reset_code
+        return self._fault(source, dest, to_backend, ('reset', code))
+
+    def abort_message(self, source, dest, to_backend):
+        """Resets the stream of the next frame of *source* with the
+        *reset_code* error code, see :meth:`reset_stream`."""
+        return self.reset_stream(source, dest, to_backend)
+
+    def inject_error(self, source, dest, to_backend):
+        """Fails the stream of the next frame of *source*, as the *error*
+        behavior does: a request not answered yet gets a *status*
+        response, the other streams are reset with INTERNAL_ERROR.
+
+        Returns True, the frame is then handled as usual.
+        """
+        return self._fault(source, dest, to_backend,
+                           ('error', ERRORS['INTERNAL_ERROR']))
+
+    def _fault(self, source, dest, to_backend, fault):
+        connection = self.get_connection(to_backend and dest or source)
+        header = self._next_frame(connection, source, to_backend)
+        if header is None or header[3] == 0:
+            return True
+        stream = header[3]
+        if stream in connection.reset:
+            return True
+        # the header blocks of the stream are dropped from now on
+        connection.reencode[True] = connection.reencode[False] = True
+        connection.reset[stream] = fault
+        client_sock = to_backend and source or dest
+        backend_sock = to_backend and dest or source
+        for direction in (True, False):
+            entry = connection.held[direction].pop(stream, None)
+            if entry is None:
+                continue
+            entry.timer.kill(block=False)
+            if entry.data:
+                self._credit(connection, direction,
+                             direction and client_sock or backend_sock,
+                             entry.data)
+        return True
+
+    def _release(self, connection, dest, to_backend, stream):
+        entry = connection.held[to_backend].pop(stream, None)
+        if entry is None or not entry.frames:
+            return
+        try:
+            self._send(connection, dest, to_backend, ''.join(entry.frames))
+        except error, e:
+            self._log_error(e)
+
+    def _send(self, connection, sock, to_backend, data):
+        # sends *data* to the destination of the direction *to_backend*
+        with connection.locks[to_backend]:
+            if connection.started[to_backend]:
+                sock.sendall(data)
+            else:
+                connection.pending[to_backend].append(data)
+
+    def _credit(self, connection, to_backend, source, size):
+        # gives the flow control window of the DATA frames the proxy
+        # drops back to their sender
+        self._send(connection, source, not to_backend,
+                   frame(WINDOW_UPDATE, 0, 0, struct.pack('>I', size)))
+
+    def _report(self, connection, stream_id, block, client_sock,
+                backend_sock, to_backend):
+        # tells the peers about the fault of a stream, once its frame
+        # was dropped
+        kind, code = connection.reset[stream_id]
+        connection.reset[stream_id] = None
+        stream = connection.streams.pop(stream_id, None)
+        if stream is not None:
+            # the server knows about the stream
+            self._send(connection, backend_sock, True,
+                       frame(RST_STREAM, 0, stream_id,
+                             struct.pack('>I', ERRORS['CANCEL'])))
+
+        responded = stream is not None and stream.responded
+        if kind == 'error' and not responded and (stream is not None or
+                                                  to_backend):
+            response = _hpack.encode([(':status',
+                                       str(self.option('status')))])
+            data = frame(HEADERS, END_STREAM | END_HEADERS, stream_id,
+                         response)
+            if stream is not None:
+                ended = stream.ended & _Stream.CLIENT
+            else:
+                ended = block is not None and block.flags & END_STREAM
+            if not ended:
+                # the rest of the request isn't needed
+                data += frame(RST_STREAM, 0, stream_id,
+                              struct.pack('>I', ERRORS['NO_ERROR']))
+        else:
+            data = frame(RST_STREAM, 0, stream_id, struct.pack('>I', code))
+        self._send(connection, client_sock, False, data)
+
+    # the forwarding
+
+    def _read_frame(self, source, parser):
+        # reads the next frame of *source* whole, None if it's closed first
+        buffer, view = self._get_buffer(source)
+        pieces = []
+        while True:
+            size = self._fill(source)
+            if not size:
+                return None
+            end = parser.feed(buffer, 0, size)
+            if end != -1:
+                break
+            pieces.append(view[:size].tobytes())
+        pieces.append(view[:end].tobytes())
+        self._keep(source, end, size)
+        return ''.join(pieces)
+
+    def _read_block(self, connection, source, to_backend):
+        # reads the next header block of *source* and decodes it, as the
+        # blocks must be decoded in order
+        parser = self._get_parser(source, to_backend)
+        data = self._read_frame(source, parser)
+        if data is None:
+            return None
+        block = _Block(parser.type, parser.flags, parser.stream)
+        block.frames.append(data)
+        payload = data[HEADER_SIZE:]
+        if block.flags & PADDED:
+            pad = ord(payload[0])
+            payload = payload[1:len(payload) - pad]
+        if block.type == PUSH_PROMISE:
+            block.promised = struct.unpack('>I', payload[:4])[0] & 0x7fffffff
+            payload = payload[4:]
+        elif block.flags & PRIORITY_FLAG:
+            payload = payload[5:]
+        fragments = [payload]
+
+        flags = block.flags
+        while not flags & END_HEADERS:
+            data = self._read_frame(source, parser)
+            if data is None:
+                return None
+            if parser.type != CONTINUATION or parser.stream != block.stream:
+                raise ValueError('Expected a CONTINUATION frame')
+            block.frames.append(data)
+            fragments.append(data[HEADER_SIZE:])
+            flags = parser.flags
+
+        decoder = connection.decoders[to_backend]
+        block.headers = decoder.decode(''.join(fragments))
+        block.updates = decoder.updates
+        return block
+
+    def _encode_block(self, block):
+        # the frames of *block* encoded again, without the priority
+        fragment = _hpack.encode(block.headers, block.updates)
+        if block.type == PUSH_PROMISE:
+            fragment = struct.pack('>I', block.promised) + fragment
+        pieces = [fragment[pos:pos + _MAX_PAYLOAD]
+                  for pos in range(0, len(fragment), _MAX_PAYLOAD)] or ['']
+        frames = []
+        for index, piece in enumerate(pieces):
+            last = index == len(pieces) - 1
+            flags = last and END_HEADERS or 0
+            if index == 0:
+                frames.append(frame(block.type,
+                                    flags | block.flags & END_STREAM,
+                                    block.stream, piece))
+            else:
+                frames.append(frame(CONTINUATION, flags, block.stream,
+                                    piece))
+        return ''.join(frames)
+
+    def _send_block(self, connection, dest, block, to_backend):
+        connection.on_block(block, to_backend)
+        if connection.reencode[to_backend]:
+            data = self._encode_block(block)
+        else:
+            data = ''.join(block.frames)
+        entry = connection.held[to_backend].get(block.stream)
+        if entry is not None and block.type != PUSH_PROMISE:
+            entry.frames.append(data)
+        else:
+            # the promised streams must reach the client in order, and
+            # can come before the response
+            self._send(connection, dest, to_backend, data)
+
+    def _batch(self, connection, buffer, pos, size, parser, to_backend):
+        # the frames following *pos* that can go with it, as they are
+        held, reset = connection.held[to_backend], connection.reset
+        while size - pos >= HEADER_SIZE:
+            length, type_, flags, stream = _unpack(buffer, pos)
+            if (pos + HEADER_SIZE + length > size or type_ in _BLOCKS or
+                    type_ == CONTINUATION or
+                    (stream and (type_ in self._frames or stream in held or
+                                 stream in reset))):
+                break
+            pos = parser.feed(buffer, pos, size)
+            connection.on_frame(type_, flags, stream, to_backend)
+        return pos
+
+    def _forward_frames(self, connection, source, dest, parser, to_backend):
+        buffer, view = self._get_buffer(source)
+        with connection.locks[to_backend]:
+            while True:
+                size = self._fill(source)
+                if not size:
+                    return False
+                end = parser.feed(buffer, 0, size)
+                if end != -1:
+                    break
+                dest.sendall(view[:size])
+            if parser.type is not None:
+                connection.on_frame(parser.type, parser.flags,
+                                    parser.stream, to_backend)
+            end = self._batch(connection, buffer, end, size, parser,
+                              to_backend)
+            dest.sendall(view[:end])
+            pending = connection.pending[to_backend]
+            if pending and connection.started[to_backend]:
+                dest.sendall(''.join(pending))
+                del pending[:]
+        self._keep(source, end, size)
+        return True
+
+    def _handle(self, source, dest, to_backend, on_between_handle):
+        connection = self.get_connection(to_backend and dest or source)
+        parser = self._get_parser(source, to_backend)
+        try:
+            if connection.error is not None:
+                raise connection.error
+
+            block = connection.blocks.pop(to_backend, None)
+            if block is None and not parser.preface:
+                if self._peek(source, HEADER_SIZE) < HEADER_SIZE:
+                    return False
+                length, type_, flags, stream = _unpack(
+                    self._get_buffer(source)[0])
+                if type_ == CONTINUATION:
+                    raise ValueError('Unexpected CONTINUATION frame')
+                if type_ in _BLOCKS:
+                    block = self._read_block(connection, source, to_backend)
+                    if block is None:
+                        return False
+            else:
+                stream = block is not None and block.stream or 0
+
+            if stream in connection.reset:
+                if not self._drop(connection, source, dest, parser, block,
+                                  to_backend):
+                    return False
+            elif block is not None:
+                self._send_block(connection, dest, block, to_backend)
+            elif stream in connection.held[to_backend]:
+                data = self._read_frame(source, parser)
+                if data is None:
+                    return False
+                connection.on_frame(parser.type, parser.flags, stream,
+                                    to_backend)
+                entry = connection.held[to_backend][stream]
+                entry.frames.append(data)
+                if parser.type == DATA:
+                    entry.data += parser.length
+            elif not self._forward_frames(connection, source, dest, parser,
+                                          to_backend):
+                return False
+        except ValueError, e:
+            self._log_error(e)
+            return False
+        return on_between_handle()
+
+    def _drop(self, connection, source, dest, parser, block, to_backend):
+        # drops the next frame of a reset stream
+        if block is not None:
+            stream = block.stream
+            connection.on_frame(block.type, block.flags, stream, to_backend)
+        else:
+            if self._read_frame(source, parser) is None:
+                return False
+            stream = parser.stream
+            connection.on_frame(parser.type, parser.flags, stream,
+                                to_backend)
+            if parser.type == DATA and parser.length:
+                self._credit(connection, to_backend, source, parser.length)
+        if connection.reset[stream] is not None:
+            client_sock, backend_sock = to_backend and (source, dest) or \
+                (dest, source)
+            self._report(connection, stream, block, client_sock,
+                         backend_sock, to_backend)
+        return True
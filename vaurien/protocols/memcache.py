@@ -1,76 +1,226 @@
-import re
+from collections import deque
 
-from vaurien.protocols.base import BaseProtocol
-from vaurien.util import chunked
+from vaurien.protocols.base import BaseProtocol, Message
 
 
-RE_LEN = re.compile('Content-Length: (\d+)', re.M | re.I)
-RE_KEEPALIVE = re.compile('Connection: Keep-Alive')
-RE_MEMCACHE_COMMAND = re.compile('(.*)\r\n')
-
-EOH = '\r\n\r\n'
 CRLF = '\r\n'
 
+# commands followed by a data block, and the position of its size
+_STORAGE = {'set': 4, 'add': 4, 'replace': 4, 'append': 4, 'prepend': 4,
+            'cas': 4, 'ms': 2}
+_META = frozenset(['mg', 'ms', 'md', 'ma', 'mn', 'me'])
+# lines of a response that are followed by more lines, up to END
+_LISTS = frozenset(['VALUE', 'STAT', 'ITEM', 'PREFIX'])
+# errors end a response, even in the middle of a list
+_ERRORS = frozenset(['ERROR', 'CLIENT_ERROR', 'SERVER_ERROR'])
+# the replies the quiet meta commands still send, e.g. the hits of mg
+_QUIET_REPLIES = frozenset(['VA', 'HD', 'NS', 'EX', 'NF']) | _ERRORS
+
+# only the beginning of longer lines is kept, e.g. for a multi-get of
+# many keys: the words needed for the framing come first.
+_MAX_LINE = 2048
+
+
+class MemcacheParser(object):
+    """Incremental parser for the memcache text protocol, see
+    https://github.com/memcached/memcached/blob/master/doc/protocol.txt
+
+    Only the framing of the messages is tracked: the lines are parsed, the
+    data blocks are skipped over without being accumulated, so the memory
+    used does not depend on the size of the values or on the number of
+    keys of a multi-get. Meta commands are supported.
+
+    For requests, the name of the last command is kept in *command*, and
+    *reply* tells if the backend will answer it: it is False for the
+    *noreply* storage commands, the quiet meta commands and *quit*.
+    *quiet* is True for the quiet meta commands, which are answered when
+    they fail, or hit for *mg*. For responses, *kind* is the first word
+    of the last one.
+    """
+
+    def __init__(self, requests=False):
+        self.requests = requests
+        self.command = None
+        self.reply = True
+        self.quiet = False
+        self.kind = None
+        self._line = bytearray()
+        # bytes of a data block and its CRLF left to skip
+        self._skip = 0
+        # the message ends once the data block is skipped
+        self._last = False
+        # in a response made of several lines, up to END
+        self._list = False
+
+    def at_boundary(self):
+        """Returns True if the parser is between two messages."""
+        return not (self._line or self._skip or self._list)
+
+    def feed(self, buffer, start, end):
+        """Parses *buffer[start:end]*.
+
+        Returns the position right after the first message that ends in
+        it, or -1 if all the data is part of an unfinished message.
+        Raises a ValueError if the data can't be parsed.
+        """
+        pos = start
+        while pos < end:
+            if self._skip:
+                count = min(self._skip, end - pos)
+                pos += count
+                self._skip -= count
+                if self._skip:
+                    return -1
+                if self._last:
+                    return pos
+                continue
+
+            eol = buffer.find('\n', pos, end)
+            if eol == -1:
+                self._extend(buffer, pos, end)
+                return -1
+
+            if self._line:
+                self._extend(buffer, pos, eol + 1)
+                line = str(self._line)
+                self._line = bytearray()
+            else:
+                line = str(buffer[pos:min(eol + 1, pos + _MAX_LINE)])
+            pos = eol + 1
+
+            words = line.rstrip(CRLF).split()
+            if self.requests:
+                done = self._on_request(words)
+            else:
+                done = self._on_response(words)
+            if done:
+                return pos
+
+        return -1
+
+    def _extend(self, buffer, start, end):
+        end = min(end, start + _MAX_LINE - len(self._line))
+        if end > start:
+            self._line.extend(buffer[start:end])
+
+    def _size(self, words, index):
+        try:
+            size = int(words[index])
+        except (IndexError, ValueError):
+            # meta commands can also give the size as a S flag
+            sizes = [word[1:] for word in words[1:] if word[:1] == 'S']
+            try:
+                size = int(sizes[0])
+            except (IndexError, ValueError):
+                raise ValueError('Invalid memcache size: %r'
+                                 % ' '.join(words))
+        if size < 0:
+            raise ValueError('Invalid memcache size: %r' % ' '.join(words))
+        return size + len(CRLF)
+
+    def _on_request(self, words):
+        if not words:
+            raise ValueError('Empty memcache command')
+        command = self.command = words[0].lower()
+        self.quiet = command in _META and 'q' in words[1:]
+        if command in _META:
+            self.reply = not self.quiet
+        else:
+            self.reply = command != 'quit' and words[-1] != 'noreply'
+
+        if command in _STORAGE:
+            self._skip = self._size(words, _STORAGE[command])
+            self._last = True
+            return False
+        return True
+
+    def _on_response(self, words):
+        if not words:
+            raise ValueError('Empty memcache response')
+        kind = words[0]
+        if not self._list:
+            self.kind = kind
+        if kind == 'END' or kind in _ERRORS:
+            self._list = False
+            return True
+        if kind == 'VALUE':
+            self._list = True
+            self._skip = self._size(words, 3)
+            self._last = False
+            return False
+        if kind == 'VA':
+            self._skip = self._size(words, 1)
+            self._last = True
+            return False
+        if kind in _LISTS:
+            self._list = True
+            return False
+        # any other line is the whole reply, unless it is in a list
+        return not self._list
+
 
 class Memcache(BaseProtocol):
     """Memcache protocol.
+
+    Commands and responses are handled one at a time, in both directions
+    at the same time, so pipelined commands flow through.
+
+    The backend connections are reused once every command got its reply.
+    The quiet meta commands may get none: they are done once a later
+    command is answered with anything they can't send, like an *EN*
+    miss or a *MN* for the *mn* ending a pipeline.
     """
     name = 'memcache'
+    duplex = True
+
+    def _create_parser(self, to_backend):
+        return MemcacheParser(requests=to_backend)
+
+    def get_pending_commands(self, backend_sock):
+        """Returns the *(name, quiet)* of the commands sent on
+        *backend_sock* that may still get a reply, oldest first."""
+        commands = getattr(backend_sock, '_commands', None)
+        if commands is None:
+            commands = backend_sock._commands = deque()
+        return commands
+
+    def is_idle(self, sock):
+        return (super(Memcache, self).is_idle(sock) and
+                not getattr(sock, '_commands', None))
+
+    def describe(self, source, dest, to_backend):
+        if not self._peek(source, 1):
+            return None
+        if not to_backend:
+            return Message(None, to_backend=False)
+        words = self._peek_words(source, 1)
+        return Message(words and words[0].lower() or None)
 
     def _handle(self, source, dest, to_backend, on_between_handle):
-        # https://github.com/memcached/memcached/blob/master/doc/protocol.txt
-        # Sending the query
-        buffer = self._get_data(source)
-        if not buffer:
-            self._abort_handling(to_backend, dest)
-            return
-
-        # sending the first packet
-        dest.sendall(buffer)
-        on_between_handle()
-
-        # finding the command we sent.
-        cmd = RE_MEMCACHE_COMMAND.search(buffer)
-
-        if cmd is None:
-            # wat ?
-            self._abort_handling(to_backend, dest)
-            return
-
-        # looking at the command
-        cmd = cmd.groups()[0]
-        buffer_size = self.option('buffer')
-
-        cmd_parts = cmd.split()
-        mcmd = cmd_parts[0]
-
-        if mcmd in ('set', 'add', 'replace', 'append'):
-            cmd_size = len(cmd) + len(CRLF)
-            data_size = int(cmd_parts[-1])
-            total_size = cmd_size + data_size
-
-            # grabbing more data if needed
-            left_to_read = total_size - len(buffer) + len(CRLF)
-            if left_to_read > 0:
-                for chunk in chunked(left_to_read, buffer_size):
-                    data = source.recv(chunk)
-                    buffer += data
-                    dest.sendall(data)
-
-        # Receiving the response now
-        buffer = self._get_data(dest, buffer_size)
-        source.sendall(buffer)
-
-        if buffer.startswith('VALUE'):
-            # we're getting back a value.
-            EOW = 'END' + CRLF
+        parser = self._get_parser(source, to_backend)
+        if not self._forward_message(source, dest, parser):
+            return False
+
+        if to_backend:
+            if parser.reply or parser.quiet:
+                self.get_pending_commands(dest).append((parser.command,
+                                                        parser.quiet))
         else:
-            EOW = CRLF
-
-        while not buffer.endswith(EOW):
-            data = self._get_data(dest, buffer_size)
-            buffer += data
-            source.sendall(data)
-
-        # we're done
-        return True    # keeping connected
+            self._on_reply(self.get_pending_commands(source), parser.kind)
+
+        return on_between_handle()
+
+    def _on_reply(self, commands, kind):
+        # the replies carry no key by default: one a quiet command can
+        # send goes to the oldest command, the other ones skip the quiet
+        # commands before their own. A mn reply follows all the replies
+        # of the commands sent before it.
+        if kind == 'MN':
+            while commands and commands.popleft() != ('mn', False):
+                pass
+            return
+        if kind not in _QUIET_REPLIES:
+            while commands and commands[0][1]:
+                commands.popleft()
+        if commands:
+            commands.popleft()
@@ -0,0 +1,205 @@
+import struct
+
+from vaurien.protocols.base import BaseProtocol, Message, PASSTHROUGH
+
+
+REQUEST_MAGIC = 0x80
+RESPONSE_MAGIC = 0x81
+
+# magic, opcode, key length, extras length, data type, vbucket or status,
+# total body length, opaque, cas
+HEADER = struct.Struct('>BBHBBHIIQ')
+HEADER_SIZE = HEADER.size
+
+OPCODES = {
+    0x00: 'get', 0x01: 'set', 0x02: 'add', 0x03: 'replace',
+    0x04: 'delete', 0x05: 'increment', 0x06: 'decrement', 0x07: 'quit',
+    0x08: 'flush', 0x09: 'getq', 0x0a: 'noop', 0x0b: 'version',
+    0x0c: 'getk', 0x0d: 'getkq', 0x0e: 'append', 0x0f: 'prepend',
+    0x10: 'stat', 0x11: 'setq', 0x12: 'addq', 0x13: 'replaceq',
+    0x14: 'deleteq', 0x15: 'incrementq', 0x16: 'decrementq',
+    0x17: 'quitq', 0x18: 'flushq', 0x19: 'appendq', 0x1a: 'prependq',
+    0x1b: 'verbosity', 0x1c: 'touch', 0x1d: 'gat', 0x1e: 'gatq',
+    0x20: 'sasl_list_mechs', 0x21: 'sasl_auth', 0x22: 'sasl_step',
+    0x23: 'gatk', 0x24: 'gatkq'}
+
+OPCODE_NAMES = dict((name, opcode) for opcode, name in OPCODES.items())
+
+# quiet commands only get a response on errors, or for a get hit
+QUIET = frozenset(opcode for opcode, name in OPCODES.items()
+                  if name.endswith('q'))
+
+STAT = OPCODE_NAMES['stat']
+
+
+def parse_opcodes(opcodes):
+    """Returns the set of opcodes of a comma-separated list of names or
+    numbers, or None if the list is empty.
+
+    Raises a ValueError for an unknown opcode.
+    """
+    selected = set()
+    for name in opcodes.split(','):
+        name = name.strip().lower()
+        if not name:
+            continue
+        if name in OPCODE_NAMES:
+            selected.add(OPCODE_NAMES[name])
+            continue
+        try:
+            selected.add(int(name, 0))
+        except ValueError:
+            raise ValueError('Unknown memcache opcode %r' % name)
+    return selected or None
+
+
+class BinaryParser(object):
+    """Incremental parser for the memcache binary protocol, see
+    https://github.com/memcached/memcached/wiki/BinaryProtocolRevamped
+
+    Packets are framed with the total body length of their 24 bytes
+    header. Headers are unpacked in place, bodies are skipped over
+    without being copied.
+
+    The *opcode*, *key_length* and *status* of the last header are kept.
+    """
+
+    def __init__(self, requests=False):
+        self.requests = requests
+        self.magic = requests and REQUEST_MAGIC or RESPONSE_MAGIC
+        self.opcode = None
+        self.key_length = 0
+        self.status = 0
+        # a header split between two reads
+        self._header = bytearray()
+        # bytes of the body left to skip
+        self._skip = 0
+
+    def at_boundary(self):
+        """Returns True if the parser is between two packets."""
+        return not (self._header or self._skip)
+
+    def feed(self, buffer, start, end):
+        """Parses *buffer[start:end]*.
+
+        Returns the position right after the first packet that ends in
+        it, or -1 if all the data is part of an unfinished packet.
+        Raises a ValueError if the data is not a valid packet.
+        """
+        pos = start
+        while pos < end:
+            if self._skip:
+                count = min(self._skip, end - pos)
+                pos += count
+                self._skip -= count
+                if self._skip:
+                    return -1
+                return pos
+
+            if self._header or end - pos < HEADER_SIZE:
+                count = min(HEADER_SIZE - len(self._header), end - pos)
+                self._header.extend(buffer[pos:pos + count])
+                pos += count
+                if len(self._header) < HEADER_SIZE:
+                    return -1
+                self._on_header(self._header, 0)
+                self._header = bytearray()
+            else:
+                self._on_header(buffer, pos)
+                pos += HEADER_SIZE
+
+            if not self._skip:
+                return pos
+
+        return -1
+
+    def _on_header(self, buffer, pos):
+        (magic, self.opcode, self.key_length, extras_length, data_type,
+         self.status, body_length, opaque, cas) = HEADER.unpack_from(buffer,
+                                                                     pos)
+        if magic != self.magic:
+            raise ValueError('Invalid memcache magic: 0x%02x' % magic)
+        if self.key_length + extras_length > body_length:
+            raise ValueError('Invalid memcache body length: %d'
+                             % body_length)
+        self._skip = body_length
+
+
+class MemcacheBinary(BaseProtocol):
+    """Memcache binary protocol.
+
+    Packets are handled one at a time, in both directions at the same
+    time, so quiet commands batches flow through.
+
+    The behaviors only apply to the packets with the opcodes listed in
+    the *opcodes* option, e.g. *getq,getkq*: the other packets go through
+    untouched. Behaviors can also get the name of the opcode of the
+    packet being handled with :meth:`get_opcode`.
+    """
+    name = 'memcache_binary'
+    duplex = True
+    options = {'opcodes': ("Comma-separated opcodes the behaviors apply "
+                           "to. All of them if empty.", str, '')}
+    options.update(BaseProtocol.options)
+
+    def _compile(self):
+        self._selected = parse_opcodes(self.option('opcodes'))
+
+    def _create_parser(self, to_backend):
+        return BinaryParser(requests=to_backend)
+
+    def get_opcode(self, sock):
+        """Returns the name of the opcode of the packet being read from
+        *sock*, or None."""
+        opcode = getattr(sock, '_opcode', None)
+        if opcode is None:
+            return None
+        return OPCODES.get(opcode, '0x%02x' % opcode)
+
+    def get_expected_replies(self, backend_sock):
+        """Returns the number of responses still expected on
+        *backend_sock*."""
+        return getattr(backend_sock, '_expected', 0)
+
+    def is_idle(self, sock):
+        return (super(MemcacheBinary, self).is_idle(sock) and
+                not self.get_expected_replies(sock))
+
+    def _peek_opcode(self, sock):
+        # the beginning of the next packet is left in the buffer for the
+        # handler.
+        if self._peek(sock, 2) < 2:
+            return None
+        return self._get_buffer(sock)[0][1]
+
+    def describe(self, source, dest, to_backend):
+        if self._peek(source, HEADER_SIZE) < HEADER_SIZE:
+            return None
+        header = HEADER.unpack_from(self._get_buffer(source)[0], 0)
+        opcode, body_length = header[1], header[6]
+        return Message(OPCODES.get(opcode, '0x%02x' % opcode),
+                       HEADER_SIZE + body_length, to_backend)
+
+    def __call__(self, source, dest, to_backend, behavior):
+        source._opcode = opcode = self._peek_opcode(source)
+        if (opcode is not None and self._selected is not None and
+                opcode not in self._selected):
+            behavior = PASSTHROUGH
+        return super(MemcacheBinary, self).__call__(source, dest, to_backend,
+                                                    behavior)
+
+    def _handle(self, source, dest, to_backend, on_between_handle):
+        parser = self._get_parser(source, to_backend)
+        if not self._forward_message(source, dest, parser):
+            return False
+
+        if to_backend:
+            if parser.opcode not in QUIET:
+                dest._expected = self.get_expected_replies(dest) + 1
+        elif (parser.opcode not in QUIET and
+              (parser.opcode != STAT or not parser.key_length)):
+            # the stats come in several packets, up to one without a key,
+            # and the responses to quiet commands are not counted
+            source._expected = max(self.get_expected_replies(source) - 1, 0)
+
+        return on_between_handle()
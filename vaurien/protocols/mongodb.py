@@ -0,0 +1,402 @@
+import copy
+import struct
+
+from gevent.lock import Semaphore
+
+from vaurien.protocols.base import BaseProtocol, Message, PASSTHROUGH
+
+
+# messageLength, requestID, responseTo and opCode, little-endian
+HEADER = struct.Struct('<iiii')
+HEADER_SIZE = HEADER.size
+# the largest message a server accepts
+MAX_MESSAGE = 48000000
+
+OP_REPLY = 1
+OP_UPDATE = 2001
+OP_INSERT = 2002
+OP_QUERY = 2004
+OP_GET_MORE = 2005
+OP_DELETE = 2006
+OP_KILL_CURSORS = 2007
+OP_COMPRESSED = 2012
+OP_MSG = 2013
+
+# the flags of OP_MSG
+CHECKSUM_PRESENT = 1 << 0
+MORE_TO_COME = 1 << 1
+# the flag of a failed OP_REPLY
+QUERY_FAILURE = 1 << 1
+
+# the names of the legacy operations, the ones of the commands doing
+# the same
+_OPERATIONS = {OP_UPDATE: 'update', OP_INSERT: 'insert', OP_QUERY: 'query',
+               OP_GET_MORE: 'getMore', OP_DELETE: 'delete',
+               OP_KILL_CURSORS: 'killCursors'}
+# the operations getting a reply
+_ANSWERED = frozenset([OP_QUERY, OP_GET_MORE, OP_MSG])
+# the beginning of the messages peeked at to find their command
+_PEEK = 512
+# the beginning of the payloads kept: the flags of OP_MSG, or the
+# original opcode of OP_COMPRESSED
+_CAPTURE = 4
+
+
+def _cstring(data, pos, end):
+    # the null-terminated string at *pos*, and the position after it
+    stop = data.find('\x00', pos, end)
+    if stop == -1:
+        return None, end
+    return str(data[pos:stop]), stop + 1
+
+
+def _first_key(data, pos, end):
+    # the name of the first element of the BSON document at *pos*
+    if pos + 5 > end or data[pos + 4] == 0:
+        return None
+    return _cstring(data, pos + 5, end)[0]
+
+
+def command_name(data, end=None):
+    """Returns the name of the command of the message starting *data*,
+    e.g. *find*, from its first *end* bytes, or None if they don't tell.
+
+    Only the first key of the command document is read. The legacy
+    operations are named after the commands replacing them, and the
+    queries on collections *query*. Compressed messages have no name.
+    """
+    if end is None:
+        end = len(data)
+    if end < HEADER_SIZE:
+        return None
+    opcode = HEADER.unpack_from(data, 0)[3]
+    if opcode == OP_MSG:
+        pos = HEADER_SIZE + 4
+        while pos < end:
+            kind = data[pos]
+            if kind == 0:
+                return _first_key(data, pos + 1, end)
+            if kind != 1 or pos + 5 > end:
+                return None
+            # a document sequence, before the command
+            pos += 1 + struct.unpack_from('<i', data, pos + 1)[0]
+        return None
+    if opcode == OP_QUERY:
+        collection, pos = _cstring(data, HEADER_SIZE + 4, end)
+        if collection is None:
+            return None
+        if not collection.endswith('.$cmd'):
+            return 'query'
+        return _first_key(data, pos + 8, end)
+    return _OPERATIONS.get(opcode)
+
+
+def parse_commands(commands):
+    """Returns the set of the lower-cased names of a comma-separated
+    list of commands, or None if the list is empty."""
+    names = set(name.strip().lower() for name in commands.split(','))
+    names.discard('')
+    return names and frozenset(names) or None
+
+
+def _bson(elements):
+    # a BSON document of (name, value) elements, floats, ints and strings
+    encoded = []
+    for name, value in elements:
+        if isinstance(value, float):
+            encoded.append('\x01%s\x00%s' % (name, struct.pack('<d', value)))
+        elif isinstance(value, int):
+            encoded.append('\x10%s\x00%s' % (name, struct.pack('<i', value)))
+        else:
+            encoded.append('\x02%s\x00%s%s\x00'
+                           % (name, struct.pack('<i', len(value) + 1), value))
+    body = ''.join(encoded)
+    return struct.pack('<i', len(body) + 5) + body + '\x00'
+
+
+def error_reply(response_to, opcode, code, message):
+    """Returns a reply to the request *response_to* with the *code* error:
+    an OP_REPLY to an OP_QUERY, an OP_MSG to the others."""
+    if opcode == OP_QUERY:
+        payload = (struct.pack('<iqii', QUERY_FAILURE, 0, 0, 1) +
+                   _bson([('$err', message), ('code', code)]))
+        opcode = OP_REPLY
+    else:
+        payload = struct.pack('<I', 0) + '\x00' + _bson(
+            [('ok', 0.), ('errmsg', message), ('code', code)])
+        opcode = OP_MSG
+    return HEADER.pack(HEADER_SIZE + len(payload), 0, response_to,
+                       opcode) + payload
+
+
+class MessageParser(object):
+    """Incremental framing of MongoDB messages, see
+    https://www.mongodb.com/docs/manual/reference/mongodb-wire-protocol/
+
+    Messages are framed with the length of their 16 bytes header, the
+    payloads are skipped over without being decoded: only their first 4
+    bytes are kept, see :attr:`flags`.
+
+    *length*, *request_id*, *response_to* and *opcode* are the ones of
+    the last message.
+    """
+
+    def __init__(self, requests=False):
+        self.requests = requests
+        self.length = 0
+        self.request_id = self.response_to = self.opcode = None
+        self.payload = bytearray()
+        self._header = bytearray()
+        # bytes of the payload left, None between two messages
+        self._skip = None
+
+    def at_boundary(self):
+        """Returns True if the parser is between two messages."""
+        return self._skip is None and not self._header
+
+    @property
+    def flags(self):
+        """The flags of an OP_MSG, or the original opcode of an
+        OP_COMPRESSED. 0 if the payload is too short."""
+        if len(self.payload) < 4:
+            return 0
+        return struct.unpack('<I', bytes(self.payload[:4]))[0]
+
+    @property
+    def answered(self):
+        """True if the last message gets a reply."""
+        opcode = self.opcode
+        if opcode == OP_COMPRESSED:
+            opcode = self.flags
+        elif opcode == OP_MSG and self.flags & MORE_TO_COME:
+            return False
+        return opcode in _ANSWERED
+
+    def feed(self, buffer, start, end):
+        """Parses *buffer[start:end]*.
+
+        Returns the position right after the first message that ends in
+        it, or -1 if all the data is part of an unfinished message.
+        Raises a ValueError if its length is invalid.
+        """
+        pos = start
+        while True:
+            if self._skip is not None:
+                count = min(self._skip, end - pos)
+                room = _CAPTURE - len(self.payload)
+                if room > 0:
+                    self.payload.extend(buffer[pos:pos + min(count, room)])
+                pos += count
+                self._skip -= count
+                if self._skip:
+                    return -1
+                self._skip = None
+                return pos
+
+            if pos == end:
+                return -1
+            count = min(HEADER_SIZE - len(self._header), end - pos)
+            self._header.extend(buffer[pos:pos + count])
+            pos += count
+            if len(self._header) < HEADER_SIZE:
+                return -1
+
+            (self.length, self.request_id, self.response_to,
+             self.opcode) = HEADER.unpack(bytes(self._header))
+            if not HEADER_SIZE <= self.length <= MAX_MESSAGE:
+                raise ValueError('Invalid MongoDB message length %d'
+                                 % self.length)
+            self._header = bytearray()
+            self.payload = bytearray()
+            self._skip = self.length - HEADER_SIZE
+
+
+class Session(object):
+    """The requests of a MongoDB connection waiting for their replies.
+
+    *pending* maps their request ids to the name of their command, when
+    it was looked for, or None. An exhaust cursor gets several replies,
+    each one answering the previous one.
+
+    *replying* is held while a reply is sent to the client, by the
+    server or by a behavior.
+    """
+
+    def __init__(self):
+        self.pending = {}
+        self.replying = Semaphore()
+
+    @property
+    def idle(self):
+        """True when no reply is expected from the server."""
+        return not self.pending
+
+    def on_request(self, parser, name):
+        if parser.answered:
+            self.pending[parser.request_id] = name
+
+    def on_reply(self, parser):
+        name = self.pending.pop(parser.response_to, None)
+        if parser.opcode == OP_MSG and parser.flags & MORE_TO_COME:
+            self.pending[parser.request_id] = name
+
+
+class MongoDB(BaseProtocol):
+    """MongoDB protocol.
+
+    Messages are handled one at a time, in both directions at the same
+    time, and are forwarded from the length of their header. The replies
+    are matched to their requests by their *responseTo* id.
+
+    - *commands* lists the commands the behaviors apply to, e.g.
+      *find,insert*, and to their replies. The name of a command is only
+      looked for when a behavior or this option needs it: it is the first
+      key of its document, see :func:`command_name`. The name of the
+      :class:`vaurien.protocols.base.Message` of a reply is the one of
+      its command.
+    - *error* answers a command with an *error_code* error instead of
+      sending it to the server, or replaces its reply with one.
+
+    Connections with no reply expected stay open past the proxy timeout,
+    up to *idle_timeout* seconds, as the drivers keep them in their
+    pools. Behaviors can get the :class:`Session` of a connection with
+    :meth:`get_session`.
+    """
+    name = 'mongodb'
+    duplex = True
+    options = copy.copy(BaseProtocol.options)
+    del options['keep_alive']
+    options['commands'] = ("Comma-separated commands the behaviors apply "
+                           "to. All of them if empty.", str, '')
+    options['error_code'] = ("Code of the errors sent by the error "
+                             "behavior.", int, 11600)
+    options['idle_timeout'] = ("Seconds a connection can stay idle between "
+                               "two commands. 0 for no limit.", float, 0)
+
+    def _compile(self):
+        self._commands = parse_commands(self.option('commands'))
+
+    def _create_parser(self, to_backend):
+        return MessageParser(requests=to_backend)
+
+    def get_session(self, backend_sock):
+        """Returns the :class:`Session` of the connection to
+        *backend_sock*."""
+        session = getattr(backend_sock, '_mongodb', None)
+        if session is None:
+            session = backend_sock._mongodb = Session()
+        return session
+
+    def is_idle(self, sock):
+        session = getattr(sock, '_mongodb', None)
+        return (super(MongoDB, self).is_idle(sock) and
+                (session is None or session.idle))
+
+    def may_idle(self, backend_sock, idle):
+        timeout = self.option('idle_timeout')
+        return (self.get_session(backend_sock).idle and
+                (not timeout or idle < timeout))
+
+    def _peek_header(self, source):
+        # the header of the next message of *source*, or None
+        if self._peek(source, HEADER_SIZE) < HEADER_SIZE:
+            return None
+        return HEADER.unpack_from(self._get_buffer(source)[0], 0)
+
+    def get_command(self, source, dest, to_backend):
+        """Returns the name of the command of the next message of
+        *source*, or of the command it answers, or None."""
+        header = self._peek_header(source)
+        if header is None:
+            return None
+        length, request_id, response_to, opcode = header
+        if not to_backend:
+            session = self.get_session(source)
+            return session.pending.get(response_to)
+
+        # kept for the session once the message is forwarded
+        named = getattr(source, '_command', None)
+        if named is not None and named[0] == request_id:
+            return named[1]
+        buffer = self._get_buffer(source)[0]
+        available = self._peek(source, min(length, _PEEK, len(buffer)))
+        name = command_name(buffer, min(length, available))
+        source._command = request_id, name
+        return name
+
+    def describe(self, source, dest, to_backend):
+        header = self._peek_header(source)
+        if header is None:
+            return None
+        return Message(self.get_command(source, dest, to_backend),
+                       header[0], to_backend)
+
+    def __call__(self, source, dest, to_backend, behavior):
+        if self._commands is not None:
+            name = self.get_command(source, dest, to_backend)
+            if name is None or name.lower() not in self._commands:
+                behavior = PASSTHROUGH
+        return super(MongoDB, self).__call__(source, dest, to_backend,
+                                             behavior)
+
+    def inject_error(self, source, dest, to_backend):
+        """Fails the next message of *source*, as the *error* behavior
+        does: a command gets an *error_code* error reply instead of
+        reaching the server, and so does the command of a reply instead
+        of it. The messages without a reply are dropped.
+
+        Returns False, as the message is consumed: it must not be
+        handled. A closed *source* is noticed by the next call.
+        """
+        parser = self._get_parser(source, to_backend)
+        buffer = self._get_buffer(source)[0]
+        while True:
+            size = self._fill(source)
+            if not size:
+                return False
+            try:
+                end = parser.feed(buffer, 0, size)
+            except ValueError, e:
+                if self.logger is not None:
+                    self.logger.error('%s: %s' % (self.name, e))
+                return False
+            if end != -1:
+                break
+        self._keep(source, end, size)
+
+        if to_backend:
+            client_sock, opcode = source, parser.opcode
+            if opcode == OP_COMPRESSED:
+                opcode = parser.flags
+            answered, response_to = parser.answered, parser.request_id
+        else:
+            client_sock, opcode = dest, parser.opcode
+            self.get_session(source).on_reply(parser)
+            answered, response_to = True, parser.response_to
+            if opcode == OP_REPLY:
+                opcode = OP_QUERY
+        if answered:
+            backend_sock = to_backend and dest or source
+            with self.get_session(backend_sock).replying:
+                client_sock.sendall(error_reply(
+                    response_to, opcode, self.option('error_code'),
+                    'Error injected by vaurien'))
+        return False
+
+    def _handle(self, source, dest, to_backend, on_between_handle):
+        parser = self._get_parser(source, to_backend)
+        if to_backend:
+            if not self._forward_message(source, dest, parser):
+                return False
+            named = getattr(source, '_command', None)
+            name = None
+            if named is not None and named[0] == parser.request_id:
+                name = named[1]
+            self.get_session(dest).on_request(parser, name)
+        else:
+            session = self.get_session(source)
+            with session.replying:
+                if not self._forward_message(source, dest, parser):
+                    return False
+            session.on_reply(parser)
+        return on_between_handle()
@@ -1,19 +1,448 @@
+import re
 import copy
-from vaurien.protocols.tcp import TCP
+import struct
 
+from vaurien.protocols.base import BaseProtocol, Message, PASSTHROUGH
 
-class MySql(TCP):
 
+HEADER_SIZE = 4
+# a payload this long continues in the next packet
+MAX_PAYLOAD = 0xffffff
+# the beginning of the payloads kept to follow the dialogue
+_CAPTURE = 256
+
+CLIENT_SSL = 0x00000800
+CLIENT_DEPRECATE_EOF = 0x01000000
+SERVER_MORE_RESULTS_EXISTS = 0x0008
+
+COMMANDS = {
+    0x01: 'COM_QUIT', 0x02: 'COM_INIT_DB', 0x03: 'COM_QUERY',
+    0x04: 'COM_FIELD_LIST', 0x05: 'COM_CREATE_DB', 0x06: 'COM_DROP_DB',
+    0x07: 'COM_REFRESH', 0x08: 'COM_SHUTDOWN', 0x09: 'COM_STATISTICS',
+    0x0a: 'COM_PROCESS_INFO', 0x0c: 'COM_PROCESS_KILL', 0x0d: 'COM_DEBUG',
+    0x0e: 'COM_PING', 0x11: 'COM_CHANGE_USER', 0x12: 'COM_BINLOG_DUMP',
+    0x16: 'COM_STMT_PREPARE', 0x17: 'COM_STMT_EXECUTE',
+    0x18: 'COM_STMT_SEND_LONG_DATA', 0x19: 'COM_STMT_CLOSE',
+    0x1a: 'COM_STMT_RESET', 0x1b: 'COM_SET_OPTION', 0x1c: 'COM_STMT_FETCH',
+    0x1e: 'COM_BINLOG_DUMP_GTID', 0x1f: 'COM_RESET_CONNECTION'}
+
+# the commands with a query, and the ones without a response
+_QUERIES = frozenset(['COM_QUERY', 'COM_STMT_PREPARE'])
+_NO_RESPONSE = frozenset(['COM_QUIT', 'COM_STMT_CLOSE',
+                          'COM_STMT_SEND_LONG_DATA'])
+
+# phases of a connection
+HANDSHAKE, COMMAND, TUNNEL = 'handshake', 'command', 'tunnel'
+
+# what is expected from the server in the command phase
+(_IDLE, _RESPONSE, _COLUMNS, _ROWS, _FIELDS, _PREPARE, _PACKETS,
+ _INFILE) = range(8)
+
+
+def _lenenc(payload, pos):
+    # a length-encoded integer, and the position after it
+    first = payload[pos]
+    if first < 0xfb:
+        return first, pos + 1
+    size = {0xfc: 2, 0xfd: 3, 0xfe: 8}.get(first)
+    if size is None:
+        raise ValueError('Invalid MySQL integer')
+    data = bytes(payload[pos + 1:pos + 1 + size])
+    if len(data) < size:
+        raise ValueError('Truncated MySQL integer')
+    return struct.unpack('<Q', data + '\x00' * (8 - size))[0], pos + 1 + size
+
+
+def _status(payload, eof):
+    # the server status of an OK or EOF packet
+    try:
+        if eof:
+            pos = 3
+        else:
+            pos = _lenenc(payload, _lenenc(payload, 1)[1])[1]
+        return struct.unpack('<H', bytes(payload[pos:pos + 2]))[0]
+    except (ValueError, struct.error):
+        # a truncated packet
+        return 0
+
+
+class PacketParser(object):
+    """Incremental framing of MySQL packets, see
+    https://dev.mysql.com/doc/dev/mysql-server/latest/PAGE_PROTOCOL.html
+
+    Packets are framed with the 3 bytes length of their header, the
+    payloads are skipped over without being reassembled: only their
+    beginning is kept in *payload*, up to 256 bytes.
+
+    *length* and *seq* are the length and the sequence id of the last
+    packet, *continuation* tells if it continues the previous one.
+    """
+
+    def __init__(self, requests=False):
+        self.requests = requests
+        self.length = 0
+        self.seq = 0
+        self.continuation = False
+        self.payload = bytearray()
+        self._header = bytearray()
+        # bytes of the payload left, None between two packets
+        self._skip = None
+
+    def at_boundary(self):
+        """Returns True if the parser is between two packets."""
+        return self._skip is None and not self._header
+
+    def feed(self, buffer, start, end):
+        """Parses *buffer[start:end]*.
+
+        Returns the position right after the first packet that ends in
+        it, or -1 if all the data is part of an unfinished packet.
+        """
+        pos = start
+        while True:
+            if self._skip is not None:
+                count = min(self._skip, end - pos)
+                room = _CAPTURE - len(self.payload)
+                if room > 0:
+                    self.payload.extend(buffer[pos:pos + min(count, room)])
+                pos += count
+                self._skip -= count
+                if self._skip:
+                    return -1
+                self._skip = None
+                return pos
+
+            if pos == end:
+                return -1
+            count = min(HEADER_SIZE - len(self._header), end - pos)
+            self._header.extend(buffer[pos:pos + count])
+            pos += count
+            if len(self._header) < HEADER_SIZE:
+                return -1
+
+            self.continuation = self.length == MAX_PAYLOAD
+            header = self._header
+            self.length = header[0] | header[1] << 8 | header[2] << 16
+            self.seq = header[3]
+            self._header = bytearray()
+            self.payload = bytearray()
+            self._skip = self.length
+
+
+class Session(object):
+    """The dialogue of a MySQL connection, followed packet by packet.
+
+    *phase* is *handshake* until the client is authenticated, then
+    *command*, or *tunnel* when the packets can't be followed anymore,
+    e.g. once TLS is negotiated.
+
+    In the command phase, *command* is the name of the last command,
+    *query* the beginning of its query, and *rows* the number of rows of
+    the result set being sent.
+    """
+
+    def __init__(self):
+        self.phase = HANDSHAKE
+        self.deprecate_eof = False
+        self.command = None
+        self.query = None
+        self.rows = 0
+        # True when the behaviors apply to the last command
+        self.selected = False
+        # True until the first packet of a response
+        self.first = False
+        self._expected = _IDLE
+        self._count = 0
+
+    @property
+    def idle(self):
+        """True between two commands."""
+        return self.phase == COMMAND and self._expected == _IDLE
+
+    @property
+    def in_rows(self):
+        return self.phase == COMMAND and self._expected == _ROWS
+
+    @property
+    def in_infile(self):
+        return self.phase == COMMAND and self._expected == _INFILE
+
+    def on_client_packet(self, parser):
+        if self.phase == TUNNEL or parser.continuation:
+            return
+        payload = parser.payload
+
+        if self.phase == HANDSHAKE:
+            if parser.seq == 1 and len(payload) >= 4:
+                capabilities = struct.unpack('<I', bytes(payload[:4]))[0]
+                self.deprecate_eof = bool(capabilities &
+                                          CLIENT_DEPRECATE_EOF)
+                if capabilities & CLIENT_SSL and parser.length == 32:
+                    # an SSL request, the rest is encrypted
+                    self.phase = TUNNEL
+            return
+
+        if self._expected == _INFILE:
+            # the file ends with an empty packet
+            if not parser.length:
+                self._expected = _PACKETS
+                self._count = 1
+            return
+
+        if not payload:
+            return
+        command = COMMANDS.get(payload[0], '0x%02x' % payload[0])
+        self.command = command
+        self.query = command in _QUERIES and str(payload[1:]) or None
+        self.rows = 0
+        self.first = True
+        self._count = 1
+        if command in _NO_RESPONSE:
+            self._expected = _IDLE
+        elif command in ('COM_BINLOG_DUMP', 'COM_BINLOG_DUMP_GTID'):
+            self.phase = TUNNEL
+        elif command == 'COM_CHANGE_USER':
+            self.phase = HANDSHAKE
+        elif command in ('COM_QUERY', 'COM_STMT_EXECUTE'):
+            self._expected = _RESPONSE
+        elif command == 'COM_STMT_PREPARE':
+            self._expected = _PREPARE
+        elif command == 'COM_FIELD_LIST':
+            self._expected = _FIELDS
+        elif command == 'COM_STMT_FETCH':
+            self._expected = _ROWS
+        else:
+            self._expected = _PACKETS
+
+    def _end(self, status):
+        if status & SERVER_MORE_RESULTS_EXISTS:
+            self._expected = _RESPONSE
+        else:
+            self._expected = _IDLE
+
+    def is_row(self, length, first):
+        """Tells if a packet of the result set being sent is a row,
+        from its *length* and its *first* byte."""
+        return not (first == 0xff or first == 0xfe and length < MAX_PAYLOAD)
+
+    def on_server_packet(self, parser):
+        if self.phase == TUNNEL or parser.continuation:
+            return
+        payload = parser.payload
+        if not payload:
+            if self._expected == _PACKETS:
+                self._expected = _IDLE
+            return
+        first = payload[0]
+        self.first = False
+
+        if self.phase == HANDSHAKE:
+            # the end of the authentication
+            if first == 0x00:
+                self.phase = COMMAND
+                self._expected = _IDLE
+            return
+
+        expected = self._expected
+        if expected == _RESPONSE:
+            if first == 0x00:
+                self._end(_status(payload, False))
+            elif first == 0xff:
+                self._expected = _IDLE
+            elif first == 0xfb:
+                self._expected = _INFILE
+            else:
+                try:
+                    self._count = _lenenc(payload, 0)[0]
+                except ValueError:
+                    self._count = 0
+                if not self.deprecate_eof:
+                    self._count += 1
+                self._expected = self._count and _COLUMNS or _ROWS
+        elif expected == _COLUMNS:
+            self._count -= 1
+            if self._count <= 0:
+                self._expected = _ROWS
+        elif expected == _ROWS:
+            if self.is_row(parser.length, first):
+                self.rows += 1
+            elif first == 0xff:
+                self._expected = _IDLE
+            else:
+                self._end(_status(payload, not self.deprecate_eof))
+        elif expected == _FIELDS:
+            if not self.is_row(parser.length, first):
+                self._expected = _IDLE
+        elif expected == _PREPARE:
+            self._expected = _IDLE
+            if first == 0x00 and len(payload) >= 9:
+                columns, params = struct.unpack('<HH', bytes(payload[5:9]))
+                count = columns + params
+                if not self.deprecate_eof:
+                    count += bool(columns) + bool(params)
+                if count:
+                    self._expected = _PACKETS
+                    self._count = count
+        elif expected == _PACKETS:
+            self._count -= 1
+            if self._count <= 0:
+                self._expected = _IDLE
+
+
+def parse_commands(commands):
+    """Returns the set of command names of a comma-separated list, or
+    None if the list is empty.
+
+    Raises a ValueError for an unknown command.
+    """
+    selected = set()
+    for name in commands.split(','):
+        name = name.strip().upper()
+        if not name:
+            continue
+        if not name.startswith('COM_'):
+            name = 'COM_' + name
+        if name not in COMMANDS.values():
+            raise ValueError('Unknown MySQL command %r' % name)
+        selected.add(name)
+    return selected or None
+
+
+class MySql(BaseProtocol):
+    """MySQL protocol.
+
+    Packets are handled one at a time, in both directions at the same
+    time, and the dialogue is followed so behaviors can target commands:
+
+    - the handshake and the authentication always go through untouched.
+    - *commands* restricts the behaviors to some commands, e.g.
+      *COM_QUERY*, and *query* to the queries starting with what the
+      regular expression matches.
+    - by default the behaviors apply to the commands, and to the first
+      packet of their responses. With *min_rows*, they apply once per
+      response instead, to the row going past *min_rows* rows, e.g. to
+      delay only the large result sets.
+
+    Connections between two commands stay open past the proxy timeout,
+    up to *idle_timeout* seconds, so pooled clients can keep them for
+    hours. Behaviors can get the :class:`Session` of a connection with
+    :meth:`get_session`.
+    """
     name = 'mysql'
-    options = copy.copy(TCP.options)
+    duplex = True
+    options = copy.copy(BaseProtocol.options)
     del options['keep_alive']
+    options['commands'] = ("Comma-separated commands the behaviors apply to."
+                           " All of them if empty.", str, '')
+    options['query'] = ("Regular expression matching the beginning of the "
+                        "queries the behaviors apply to.", str, '')
+    options['min_rows'] = ("Apply the behaviors to the result sets with "
+                           "more rows than this only.", int, 0)
+    options['idle_timeout'] = ("Seconds a connection can stay idle between "
+                               "two commands. 0 for no limit.", float, 0)
+
+    def _compile(self):
+        self._commands = parse_commands(self.option('commands'))
+        query = self.option('query')
+        try:
+            self._query = query and re.compile(query, re.I) or None
+        except re.error, e:
+            raise ValueError('Invalid query expression %r: %s' % (query, e))
+
+    def _create_parser(self, to_backend):
+        return PacketParser(requests=to_backend)
+
+    def get_session(self, backend_sock):
+        """Returns the :class:`Session` of the connection to
+        *backend_sock*."""
+        session = getattr(backend_sock, '_mysql', None)
+        if session is None:
+            session = backend_sock._mysql = Session()
+        return session
+
+    def is_idle(self, sock):
+        session = getattr(sock, '_mysql', None)
+        return (super(MySql, self).is_idle(sock) and
+                (session is None or session.idle))
+
+    def may_idle(self, backend_sock, idle):
+        timeout = self.option('idle_timeout')
+        return (self.get_session(backend_sock).idle and
+                (not timeout or idle < timeout))
+
+    def _selects(self, command, query):
+        if self._commands is not None and command not in self._commands:
+            return False
+        if self._query is not None:
+            return query is not None and bool(self._query.match(query))
+        return True
+
+    def _targeted(self, session, source, to_backend):
+        # tells if the behaviors apply to the next packet of *source*,
+        # once it starts to arrive: the other direction may change the
+        # session meanwhile.
+        parser = self._get_parser(source, to_backend)
+        buffer = self._get_buffer(source)[0]
+        available = self._peek(source, HEADER_SIZE + 1)
+        if (session.phase != COMMAND or available <= HEADER_SIZE or
+                parser.length == MAX_PAYLOAD):
+            return False
+        length = buffer[0] | buffer[1] << 8 | buffer[2] << 16
+
+        if to_backend:
+            if self.option('min_rows') or session.in_infile:
+                return False
+            size = HEADER_SIZE + min(length, _CAPTURE)
+            available = self._peek(source, size)
+            command = COMMANDS.get(buffer[HEADER_SIZE])
+            query = None
+            if command in _QUERIES:
+                query = str(buffer[HEADER_SIZE + 1:min(size, available)])
+            return self._selects(command, query)
+
+        if not session.selected:
+            return False
+        min_rows = self.option('min_rows')
+        if not min_rows:
+            return session.first
+        return (session.in_rows and session.rows == min_rows and
+                session.is_row(length, buffer[HEADER_SIZE]))
+
+    def describe(self, source, dest, to_backend):
+        session = self.get_session(to_backend and dest or source)
+        if session.phase == TUNNEL or \
+                self._peek(source, HEADER_SIZE) < HEADER_SIZE:
+            return None
+        buffer = self._get_buffer(source)[0]
+        length = buffer[0] | buffer[1] << 8 | buffer[2] << 16
+        # the packets are named after the command they belong to
+        name = session.command
+        if session.phase != COMMAND:
+            name = None
+        elif to_backend and session.idle and length and \
+                self._peek(source, HEADER_SIZE + 1) > HEADER_SIZE:
+            name = COMMANDS.get(buffer[HEADER_SIZE])
+        return Message(name, HEADER_SIZE + length, to_backend)
+
+    def __call__(self, source, dest, to_backend, behavior):
+        session = self.get_session(to_backend and dest or source)
+        if not self._targeted(session, source, to_backend):
+            behavior = PASSTHROUGH
+        return super(MySql, self).__call__(source, dest, to_backend,
+                                           behavior)
+
+    def _handle(self, source, dest, to_backend, on_between_handle):
+        parser = self._get_parser(source, to_backend)
+        if not self._forward_message(source, dest, parser):
+            return False
 
-    def update_settings(self, settings):
-        if 'keep_alive' in settings:
-            del settings['keep_alive']
-        super(MySql, self).update_settings(settings)
+        if to_backend:
+            session = self.get_session(dest)
+            session.on_client_packet(parser)
+            if session.first:
+                session.selected = self._selects(session.command,
+                                                 session.query)
+        else:
+            self.get_session(source).on_server_packet(parser)
 
-    def option(self, name):
-        if name == 'keep_alive':
-            return True
-        return super(MySql, self).option(name)
+        return on_between_handle()
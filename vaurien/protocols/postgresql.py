@@ -0,0 +1,412 @@
+import re
+import copy
+import struct
+from collections import deque
+
+from vaurien.protocols.base import BaseProtocol, Message, PASSTHROUGH
+
+
+# the type byte and the length of the messages
+HEADER_SIZE = 5
+# the beginning of the payloads kept to follow the dialogue
+_CAPTURE = 256
+
+# codes of the untyped messages sent by the client first
+SSL_REQUEST = 80877103
+GSSENC_REQUEST = 80877104
+CANCEL_REQUEST = 80877102
+_NEGOTIATIONS = frozenset([SSL_REQUEST, GSSENC_REQUEST])
+
+FRONTEND = {
+    'B': 'Bind', 'C': 'Close', 'd': 'CopyData', 'c': 'CopyDone',
+    'f': 'CopyFail', 'D': 'Describe', 'E': 'Execute', 'H': 'Flush',
+    'F': 'FunctionCall', 'P': 'Parse', 'p': 'PasswordMessage', 'Q': 'Query',
+    'S': 'Sync', 'X': 'Terminate'}
+
+BACKEND = {
+    'R': 'Authentication', 'K': 'BackendKeyData', '2': 'BindComplete',
+    '3': 'CloseComplete', 'C': 'CommandComplete', 'd': 'CopyData',
+    'c': 'CopyDone', 'G': 'CopyInResponse', 'H': 'CopyOutResponse',
+    'W': 'CopyBothResponse', 'D': 'DataRow', 'I': 'EmptyQueryResponse',
+    'E': 'ErrorResponse', 'V': 'FunctionCallResponse',
+    'v': 'NegotiateProtocolVersion', 'n': 'NoData', 'N': 'NoticeResponse',
+    'A': 'NotificationResponse', 't': 'ParameterDescription',
+    'S': 'ParameterStatus', '1': 'ParseComplete', 's': 'PortalSuspended',
+    'Z': 'ReadyForQuery', 'T': 'RowDescription'}
+
+# the messages sent in streams, by direction: rows and COPY data
+_STREAMS = {True: frozenset('d'), False: frozenset('dD')}
+
+# phases of a connection
+STARTUP, COMMAND, TUNNEL = 'startup', 'command', 'tunnel'
+
+
+def _cstrings(payload, count):
+    # the first *count* null-terminated strings of *payload*
+    return str(payload).split('\x00', count)[:count]
+
+
+class MessageParser(object):
+    """Incremental framing of PostgreSQL messages, see
+    https://www.postgresql.org/docs/current/protocol-message-formats.html
+
+    Messages are framed with their type byte and the 4 bytes length that
+    follows, the payloads are skipped over without being reassembled:
+    only their beginning is kept in *payload*, up to 256 bytes.
+
+    The startup messages of the client have no type byte: *untyped* is
+    True until one that is not an encryption request was read. *single*
+    is set when the next message is the one byte answer of the server to
+    such a request.
+
+    *type* and *length* are the type and the length of the last message,
+    *type* is None for an untyped message.
+    """
+
+    def __init__(self, requests=False):
+        self.requests = requests
+        self.untyped = requests
+        self.single = False
+        self.type = None
+        self.length = 0
+        self.payload = bytearray()
+        self._header = bytearray()
+        # bytes of the payload left, None between two messages
+        self._skip = None
+
+    def at_boundary(self):
+        """Returns True if the parser is between two messages."""
+        return self._skip is None and not self._header
+
+    def feed(self, buffer, start, end):
+        """Parses *buffer[start:end]*.
+
+        Returns the position right after the first message that ends in
+        it, or -1 if all the data is part of an unfinished message.
+        """
+        pos = start
+        while True:
+            if self._skip is not None:
+                count = min(self._skip, end - pos)
+                room = _CAPTURE - len(self.payload)
+                if room > 0:
+                    self.payload.extend(buffer[pos:pos + min(count, room)])
+                pos += count
+                self._skip -= count
+                if self._skip:
+                    return -1
+                self._skip = None
+                if self.untyped and len(self.payload) >= 4:
+                    code = struct.unpack('>I', bytes(self.payload[:4]))[0]
+                    self.untyped = code in _NEGOTIATIONS
+                return pos
+
+            if pos == end:
+                return -1
+            if self.single:
+                self.single = False
+                self.type = chr(buffer[pos])
+                self.length = 0
+                self.payload = bytearray()
+                return pos + 1
+
+            size = self.untyped and 4 or HEADER_SIZE
+            count = min(size - len(self._header), end - pos)
+            self._header.extend(buffer[pos:pos + count])
+            pos += count
+            if len(self._header) < size:
+                return -1
+
+            header = bytes(self._header)
+            if self.untyped:
+                self.type = None
+            else:
+                self.type, header = header[0], header[1:]
+            self.length = struct.unpack('>I', header)[0]
+            if self.length < 4:
+                raise ValueError('Invalid PostgreSQL message length %d'
+                                 % self.length)
+            self._header = bytearray()
+            self.payload = bytearray()
+            self._skip = self.length - 4
+
+
+class Session(object):
+    """The dialogue of a PostgreSQL connection, followed message by
+    message.
+
+    *phase* is *startup* until the server is first ready for a query,
+    then *command*, or *tunnel* when the messages can't be followed
+    anymore, once TLS or GSSAPI encryption is negotiated.
+
+    *query* is the beginning of the query the server is answering, when
+    it is known.
+    """
+
+    def __init__(self):
+        self.phase = STARTUP
+        # True when the server is about to answer an encryption request
+        self.negotiating = False
+        # the queries of the prepared statements and portals
+        self._statements = {}
+        self._portals = {}
+        # the queries of the responses expected up to each ReadyForQuery
+        self._groups = deque()
+        self._open = None
+
+    @property
+    def idle(self):
+        """True when no response is expected from the server."""
+        return self.phase == COMMAND and not self._groups
+
+    @property
+    def query(self):
+        if self._groups and self._groups[0]:
+            return self._groups[0][0]
+        return None
+
+    def query_of(self, type_, payload):
+        """Returns the beginning of the query of a client message, from
+        its *type_* and the beginning of its *payload*, or None."""
+        if type_ == 'Q':
+            return _cstrings(payload, 1)[0]
+        elif type_ == 'P':
+            strings = _cstrings(payload, 2)
+            return len(strings) == 2 and strings[1] or None
+        elif type_ == 'E':
+            return self._portals.get(_cstrings(payload, 1)[0])
+        return None
+
+    def on_client_message(self, parser):
+        if self.phase == TUNNEL:
+            return
+        type_, payload = parser.type, parser.payload
+        if type_ is None:
+            if len(payload) >= 4:
+                code = struct.unpack('>I', bytes(payload[:4]))[0]
+                self.negotiating = code in _NEGOTIATIONS
+            return
+
+        if type_ in ('Q', 'F'):
+            self._groups.append([self.query_of(type_, payload)])
+        elif type_ == 'P':
+            name = _cstrings(payload, 1)[0]
+            self._statements[name] = self.query_of(type_, payload)
+        elif type_ == 'B':
+            strings = _cstrings(payload, 2)
+            if len(strings) == 2:
+                self._portals[strings[0]] = self._statements.get(strings[1])
+        elif type_ == 'C' and payload:
+            name = _cstrings(payload[1:], 1)[0]
+            if payload[0] == ord('S'):
+                self._statements.pop(name, None)
+            else:
+                self._portals.pop(name, None)
+        elif type_ == 'E':
+            if self._open is None:
+                self._open = []
+                self._groups.append(self._open)
+            self._open.append(self.query_of(type_, payload))
+        elif type_ == 'S':
+            if self._open is None:
+                self._groups.append([])
+            self._open = None
+
+    def on_server_message(self, parser):
+        if self.phase == TUNNEL:
+            return
+        type_ = parser.type
+        if self.negotiating:
+            self.negotiating = False
+            if type_ in ('S', 'G'):
+                self.phase = TUNNEL
+            return
+
+        if type_ == 'Z':
+            if self.phase == STARTUP:
+                self.phase = COMMAND
+            elif self._groups:
+                if self._groups.popleft() is self._open:
+                    self._open = None
+        elif type_ in ('C', 'I', 's'):
+            # the end of an Execute of a pipeline
+            if self._groups and len(self._groups[0]) > 1:
+                self._groups[0].pop(0)
+
+
+def parse_messages(messages):
+    """Returns the sets of message types of a comma-separated list of
+    message names, for each direction: *(frontend, backend)*, or None if
+    the list is empty.
+
+    Raises a ValueError for an unknown message.
+    """
+    names = {}
+    for types, to_backend in ((FRONTEND, True), (BACKEND, False)):
+        for type_, name in types.items():
+            names.setdefault(name.lower(), []).append((type_, to_backend))
+
+    selected = {True: set(), False: set()}
+    for name in messages.split(','):
+        name = name.strip()
+        if not name:
+            continue
+        if name.lower() not in names:
+            raise ValueError('Unknown PostgreSQL message %r' % name)
+        for type_, to_backend in names[name.lower()]:
+            selected[to_backend].add(type_)
+    if not selected[True] and not selected[False]:
+        return None
+    return selected
+
+
+class PostgreSql(BaseProtocol):
+    """PostgreSQL protocol.
+
+    Messages are handled one at a time, in both directions at the same
+    time, and the dialogue is followed so behaviors can target some of
+    them:
+
+    - the startup, the encryption negotiation and the authentication
+      always go through untouched.
+    - *types* lists the types of the messages the behaviors apply to,
+      e.g. *Query,Execute* or *DataRow*. The rows and the COPY data are
+      streams: the behaviors apply to the first message of a stream
+      only, the rest of it is forwarded as it comes.
+    - *query* restricts the behaviors to the queries starting with what
+      the regular expression matches, and to the responses to them.
+
+    These options apply to every behavior the proxy picks, and know the
+    dialogue: a message of a stream, or the response to a query, isn't
+    told apart by its type. The *messages* option of a behavior then
+    picks among the messages they leave, by type too, for this behavior
+    only.
+
+    Connections with no query running stay open past the proxy timeout,
+    up to *idle_timeout* seconds, so pooled clients can keep them for
+    hours. Behaviors can get the :class:`Session` of a connection with
+    :meth:`get_session`.
+    """
+    name = 'postgresql'
+    duplex = True
+    options = copy.copy(BaseProtocol.options)
+    del options['keep_alive']
+    options['types'] = ("Comma-separated types of the messages the "
+                        "behaviors apply to. All of them if empty.", str,
+                        'Query,Execute')
+    options['query'] = ("Regular expression matching the beginning of the "
+                        "queries the behaviors apply to.", str, '')
+    options['idle_timeout'] = ("Seconds a connection can stay idle between "
+                               "two queries. 0 for no limit.", float, 0)
+
+    def _compile(self):
+        self._types = parse_messages(self.option('types'))
+        query = self.option('query')
+        try:
+            self._query = query and re.compile(query, re.I) or None
+        except re.error, e:
+            raise ValueError('Invalid query expression %r: %s' % (query, e))
+
+    def _create_parser(self, to_backend):
+        return MessageParser(requests=to_backend)
+
+    def get_session(self, backend_sock):
+        """Returns the :class:`Session` of the connection to
+        *backend_sock*."""
+        session = getattr(backend_sock, '_postgresql', None)
+        if session is None:
+            session = backend_sock._postgresql = Session()
+        return session
+
+    def is_idle(self, sock):
+        session = getattr(sock, '_postgresql', None)
+        return (super(PostgreSql, self).is_idle(sock) and
+                (session is None or session.idle))
+
+    def may_idle(self, backend_sock, idle):
+        timeout = self.option('idle_timeout')
+        return (self.get_session(backend_sock).idle and
+                (not timeout or idle < timeout))
+
+    def _targeted(self, session, source, to_backend):
+        # tells if the behaviors apply to the next message of *source*,
+        # once it starts to arrive: the other direction may change the
+        # session meanwhile. A single byte is awaited first, the answer
+        # to an encryption request is not followed by anything.
+        parser = self._get_parser(source, to_backend)
+        buffer = self._get_buffer(source)[0]
+        if not self._peek(source, 1) or session.phase != COMMAND:
+            return False
+        type_ = chr(buffer[0])
+        if self._types is not None and \
+                type_ not in self._types[to_backend]:
+            return False
+        if type_ == parser.type and type_ in _STREAMS[to_backend]:
+            return False
+        if self._query is None:
+            return True
+
+        if to_backend:
+            if self._peek(source, HEADER_SIZE) < HEADER_SIZE:
+                return False
+            length = struct.unpack_from('>I', buffer, 1)[0]
+            available = self._peek(source, 1 + min(length, 4 + _CAPTURE))
+            query = session.query_of(type_, buffer[HEADER_SIZE:available])
+        else:
+            query = session.query
+        return query is not None and bool(self._query.match(query))
+
+    def describe(self, source, dest, to_backend):
+        # only the messages of the command phase are typed for sure, the
+        # answer to an encryption request is a single byte
+        session = self.get_session(to_backend and dest or source)
+        if session.phase != COMMAND:
+            return None
+        if self._peek(source, HEADER_SIZE) < HEADER_SIZE:
+            return None
+        buffer = self._get_buffer(source)[0]
+        type_ = chr(buffer[0])
+        names = to_backend and FRONTEND or BACKEND
+        return Message(names.get(type_),
+                       1 + struct.unpack_from('>I', buffer, 1)[0], to_backend)
+
+    def __call__(self, source, dest, to_backend, behavior):
+        session = self.get_session(to_backend and dest or source)
+        if not self._targeted(session, source, to_backend):
+            behavior = PASSTHROUGH
+        return super(PostgreSql, self).__call__(source, dest, to_backend,
+                                                behavior)
+
+    def _forward_stream(self, source, dest, parser):
+        # forwards the messages of the stream *parser* is in that are
+        # already read, in one go: the behaviors don't apply to them.
+        size = getattr(source, '_kept', 0)
+        buffer, view = self._get_buffer(source)
+        stream = ord(parser.type)
+        pos = 0
+        while size - pos >= HEADER_SIZE and buffer[pos] == stream:
+            length = struct.unpack_from('>I', buffer, pos + 1)[0]
+            if length < 4 or pos + 1 + length > size:
+                break
+            pos = parser.feed(buffer, pos, size)
+        if pos:
+            dest.sendall(view[:pos])
+            source._kept = 0
+            self._keep(source, pos, size)
+
+    def _handle(self, source, dest, to_backend, on_between_handle):
+        parser = self._get_parser(source, to_backend)
+        if not self._forward_message(source, dest, parser):
+            return False
+
+        if to_backend:
+            session = self.get_session(dest)
+            session.on_client_message(parser)
+            if session.negotiating:
+                self._get_parser(dest, False).single = True
+        else:
+            self.get_session(source).on_server_message(parser)
+
+        if parser.type in _STREAMS[to_backend]:
+            self._forward_stream(source, dest, parser)
+        return on_between_handle()
@@ -1,86 +1,246 @@
-import re
+from collections import deque
 
-from vaurien.protocols.base import BaseProtocol
-from vaurien.util import chunked
+from vaurien.protocols.base import BaseProtocol, Message
 
 
-RE_LEN = re.compile('Content-Length: (\d+)', re.M | re.I)
-RE_KEEPALIVE = re.compile('Connection: Keep-Alive')
-RE_MEMCACHE_COMMAND = re.compile('(.*)\r\n')
-
-EOH = '\r\n\r\n'
 CRLF = '\r\n'
 
+# types whose line is the whole value
+_SIMPLE = frozenset('+-:_,#(')
+# types whose line gives the size of the value that follows
+_BULK = frozenset('$!=')
+# aggregates, and the number of values per announced element. An
+# attribute (|) is a map followed by the value it describes.
+_AGGREGATES = {'*': 1, '~': 1, '>': 1, '%': 2, '|': 2}
 
-class Redis(BaseProtocol):
-    """Redis protocol.
-    """
-    name = 'redis'
+# command names longer than this are not recorded
+_MAX_COMMAND = 64
 
-    def _find(self, source, buffer, char, dest):
-        pos = buffer.find(char)
-        while pos == -1:
-            data = self._get_data(source)
-            if data == '':
-                return -1, buffer
-            dest.sendall(data)
-            buffer += data
-            pos = buffer.find(char)
-        return pos, buffer
 
-    def _handle(self, source, dest, to_backend, on_between_handle):
-        """ see http://redis.io/topics/protocol
-        """
-        # grabbing data
-        bytepos, buffer = self._find(source, '', CRLF, dest)
-        on_between_handle()
-        if bytepos == -1:
-            return False
+def _announced(word):
+    # the size or count announced by *word*, -1 if it's invalid
+    try:
+        return int(word[1:])
+    except ValueError:
+        return -1
 
-        num_args = int(buffer[1:bytepos])
 
-        for arg in range(num_args):
-            # next CRLF
-            buffer = buffer[bytepos + len(CRLF):]
-            bytepos, buffer = self._find(source, buffer, CRLF, dest)
+class RespParser(object):
+    """Incremental RESP2/RESP3 parser, see http://redis.io/topics/protocol
 
-            # reading the number of bytes
-            num_bytes = int(buffer[1:bytepos])
-            data_start = bytepos + len(CRLF)
+    Only the framing of the messages is tracked: the lines announcing the
+    types and sizes are parsed, the values are skipped over without being
+    accumulated, so the memory used does not depend on the size of the
+    messages. Arbitrarily nested aggregates, RESP3 streamed strings and
+    aggregates, and, for requests, inline commands are supported.
 
-            # reading the data (next CRLF)
-            buffer = buffer[data_start:]
-            __, buffer = self._find(source, buffer, CRLF, dest)
-            data = buffer[:num_bytes]
-            bytepos = num_bytes
+    The name of the last command is kept in *command* for requests, and
+    *push* tells if the last reply was an out-of-band push.
+    """
 
-        # Getting the answer back and sending it over.
-        buffer = self._get_data(dest)
-        source.sendall(buffer)
+    def __init__(self, requests=False):
+        self.requests = requests
+        self.command = None
+        self.push = False
+        self._line = bytearray()
+        # bytes of a bulk value and its CRLF left to skip
+        self._skip = 0
+        # values left in the open aggregates, None for streamed ones
+        self._stack = []
+        # in a streamed string
+        self._chunks = False
+        self._count = 0
+        self._capture = None
+
+    def at_boundary(self):
+        """Returns True if the parser is between two messages."""
+        return not (self._line or self._skip or self._stack or self._chunks)
+
+    def feed(self, buffer, start, end):
+        """Parses *buffer[start:end]*.
+
+        Returns the position right after the first message that ends in
+        it, or -1 if all the data is part of an unfinished message.
+        Raises a ValueError if the data is not valid RESP.
+        """
+        pos = start
+        while pos < end:
+            if self._skip:
+                count = min(self._skip, end - pos)
+                if self._capture is not None:
+                    self._capture.extend(buffer[pos:pos + count])
+                pos += count
+                self._skip -= count
+                if self._skip:
+                    return -1
+                if self._chunks:
+                    continue
+                if self._capture is not None:
+                    self.command = str(self._capture[:-2]).upper()
+                    self._capture = None
+                if self._value_done():
+                    return pos
+                continue
+
+            eol = buffer.find('\n', pos, end)
+            if eol == -1:
+                self._line.extend(buffer[pos:end])
+                return -1
+
+            if self._line:
+                self._line.extend(buffer[pos:eol + 1])
+                line = str(self._line)
+                self._line = bytearray()
+            else:
+                line = str(buffer[pos:eol + 1])
+            pos = eol + 1
+
+            if self._on_line(line.rstrip(CRLF)):
+                return pos
+
+        return -1
+
+    def _value_done(self):
+        # returns True when the value completes the message
+        stack = self._stack
+        while stack:
+            if stack[-1] is None:
+                return False
+            stack[-1] -= 1
+            if stack[-1] > 0:
+                return False
+            stack.pop()
+        return True
+
+    def _size(self, line):
+        try:
+            return int(line[1:])
+        except ValueError:
+            raise ValueError('Invalid RESP size: %r' % line)
+
+    def _on_line(self, line):
+        if self._chunks:
+            # a streamed string is a series of ;SIZE chunks
+            if line[:1] != ';':
+                raise ValueError('Invalid RESP chunk: %r' % line)
+            size = self._size(line)
+            if size == 0:
+                self._chunks = False
+                return self._value_done()
+            self._skip = size + len(CRLF)
+            return False
 
-        if buffer[0] in ('+', '-', ':'):
-            # simple reply, we're good
-            return False    # disconnect mode ?
+        kind = line[:1]
+        top = not self._stack
+        if top:
+            self.push = kind == '>'
+            if self.requests:
+                self.command = None
+                if kind != '*':
+                    # inline command
+                    words = line.split(None, 1)
+                    if words:
+                        self.command = words[0].upper()
+                    return True
+
+        if kind == '.' and not top and self._stack[-1] is None:
+            # end of a streamed aggregate
+            self._stack.pop()
+            return self._value_done()
+
+        if kind in _SIMPLE:
+            return self._value_done()
+
+        if kind in _BULK:
+            if line[1:] == '?':
+                self._chunks = True
+                return False
+            size = self._size(line)
+            if size < 0:
+                return self._value_done()
+            if (self.requests and len(self._stack) == 1 and
+                    self._stack[0] == self._count and
+                    size <= _MAX_COMMAND):
+                # the first element of a request is the command
+                self._capture = bytearray()
+            self._skip = size + len(CRLF)
+            return False
+
+        if kind in _AGGREGATES:
+            if line[1:] == '?':
+                self._stack.append(None)
+                return False
+            count = self._size(line)
+            if count > 0:
+                count *= _AGGREGATES[kind]
+            if kind == '|':
+                count += 1
+            if count <= 0:
+                return self._value_done()
+            if top:
+                self._count = count
+            self._stack.append(count)
+            return False
 
-        buffer_size = self.option('buffer')
-        bytepos, buffer = self._find(dest, buffer, CRLF, source)
+        raise ValueError('Invalid RESP type: %r' % line)
 
-        if buffer[0] == '$':
-            # bulk reply
-            size = int(buffer[1:bytepos])
-            left_to_read = (size - len(buffer) + len(buffer[:bytepos]) +
-                            len(CRLF) * 2)
 
-            if left_to_read > 0:
-                for chunk in chunked(left_to_read, buffer_size):
-                    data = self._get_data(dest, chunk)
-                    buffer += data
-                    source.sendall(data)
+class Redis(BaseProtocol):
+    """Redis protocol.
+
+    Commands and replies are handled one at a time, in both directions at
+    the same time, so pipelined commands flow through. The replies are
+    matched with their commands in order.
+    """
+    name = 'redis'
+    duplex = True
+
+    def _create_parser(self, to_backend):
+        return RespParser(requests=to_backend)
+
+    def get_pending_commands(self, backend_sock):
+        """Returns the names of the commands sent on *backend_sock* that
+        are waiting for a reply, oldest first."""
+        commands = getattr(backend_sock, '_commands', None)
+        if commands is None:
+            commands = backend_sock._commands = deque()
+        return commands
+
+    def is_idle(self, sock):
+        return (super(Redis, self).is_idle(sock) and
+                not getattr(sock, '_commands', None))
+
+    def describe(self, source, dest, to_backend):
+        if not self._peek(source, 1):
+            return None
+        if not to_backend:
+            # replies are named after their command, pushes are not
+            commands = self.get_pending_commands(source)
+            if not commands or self._get_buffer(source)[0][:1] == '>':
+                return Message(None, to_backend=False)
+            return Message(commands[0], to_backend=False)
+
+        words = self._peek_words(source, 1)
+        if words and words[0][:1] == '*':
+            # an array of bulk strings, the first one is the command
+            if _announced(words[0]) > 0:
+                words = self._peek_words(source, 2)
+            if len(words) == 2 and words[1][:1] == '$' and \
+                    _announced(words[1]) > 0:
+                words = self._peek_words(source, 3)
+            words = words[2:]
+        return Message(words and words[0].upper() or None)
 
-            return False  # disconnect mode ?
+    def _handle(self, source, dest, to_backend, on_between_handle):
+        parser = self._get_parser(source, to_backend)
+        if not self._forward_message(source, dest, parser):
+            return False
 
-        if buffer[0] == '*':
-            # multi-bulk reply
-            raise NotImplementedError()
+        if to_backend:
+            self.get_pending_commands(dest).append(parser.command)
+        elif not parser.push:
+            commands = self.get_pending_commands(source)
+            if commands:
+                commands.popleft()
 
-        raise NotImplementedError()
+        return on_between_handle()
@@ -1,21 +1,462 @@
 import copy
-from vaurien.protocols.tcp import TCP
+import random
+from collections import deque
 
+from vaurien.protocols.base import BaseProtocol, Message, PASSTHROUGH
 
-class SMTP(TCP):
+
+# the longest line kept, commands are at most 512 bytes long
+_MAX_LINE = 2048
+# the most EHLO keywords kept
+_MAX_KEYWORDS = 64
+
+# the line ending the message data
+_EOM = '\r\n.\r\n'
+
+# phases of a connection
+COMMAND, TUNNEL = 'command', 'tunnel'
+
+# the steps without a command: the greeting of the server, and the end
+# of the message data
+CONNECT, EOM = 'CONNECT', 'EOM'
+
+_ERRORS = {
+    421: '4.3.2 Service not available, closing transmission channel',
+    450: '4.2.1 Requested mail action not taken: mailbox unavailable',
+    451: '4.3.0 Requested action aborted: local error in processing',
+    452: '4.3.1 Requested action not taken: insufficient system storage',
+    550: '5.7.1 Requested action not taken: mailbox unavailable',
+    552: '5.3.4 Requested mail action aborted: exceeded storage allocation',
+    553: '5.1.3 Requested action not taken: mailbox name not allowed',
+    554: '5.3.0 Transaction failed'}
+
+# the errors fitting each step
+_STEP_ERRORS = {
+    CONNECT: (421, 554),
+    'MAIL': (451, 452, 550, 553),
+    'RCPT': (450, 451, 452, 550, 553),
+    'DATA': (451, 554),
+    'BDAT': (451, 552, 554),
+    EOM: (451, 452, 552, 554)}
+_DEFAULT_ERRORS = (451, 554)
+
+
+def _line_end(buffer, start, end):
+    # the position after the first line feed of *buffer[start:end]*, or -1
+    pos = buffer.find('\n', start, end)
+    return pos == -1 and -1 or pos + 1
+
+
+class CommandParser(object):
+    """Incremental framing of the SMTP commands of a client, see
+    https://tools.ietf.org/html/rfc5321
+
+    A message is a command line, or the message data following a DATA
+    command, up to the line with a single dot: it is streamed, only the
+    last bytes read are kept to find its end. The chunk following a BDAT
+    command is part of the command.
+
+    *verb* is the upper-cased verb of the last command, None for the
+    message data. *data* is set once the server accepted the DATA
+    command, *tunnel* once STARTTLS succeeded.
+    """
+
+    def __init__(self, requests=True):
+        self.requests = requests
+        self.verb = None
+        self.data = False
+        self.tunnel = False
+        self._line = bytearray()
+        # the end of the data read, to find the end of the message data
+        self._tail = '\r\n'
+        # bytes of a BDAT chunk left, None out of a chunk
+        self._skip = None
+
+    def at_boundary(self):
+        """Returns True if the parser is between two messages."""
+        return (not self._line and self._skip is None and
+                (not self.data or self._tail == '\r\n'))
+
+    def _feed_data(self, buffer, start, end):
+        # the end of the message data may be split between two reads
+        head = bytes(buffer[start:min(end, start + len(_EOM))])
+        pos = (self._tail + head).find(_EOM)
+        if pos != -1:
+            pos += len(_EOM) - len(self._tail) + start
+        else:
+            pos = buffer.find(_EOM, start, end)
+            if pos != -1:
+                pos += len(_EOM)
+        if pos == -1:
+            self._tail = (self._tail + bytes(buffer[max(start, end - 4):
+                                                    end]))[-4:]
+            return -1
+        self.data = False
+        self.verb = None
+        self._tail = '\r\n'
+        return pos
+
+    def feed(self, buffer, start, end):
+        """Parses *buffer[start:end]*.
+
+        Returns the position right after the first message that ends in
+        it, or -1 if all the data is part of an unfinished message.
+        """
+        if start == end:
+            return -1
+        if self.tunnel:
+            return end
+        if self.data:
+            return self._feed_data(buffer, start, end)
+
+        if self._skip is not None:
+            count = min(self._skip, end - start)
+            self._skip -= count
+            if self._skip:
+                return -1
+            self._skip = None
+            return start + count
+
+        pos = _line_end(buffer, start, end)
+        if pos == -1:
+            if len(self._line) + end - start > _MAX_LINE:
+                raise ValueError('SMTP command line too long')
+            self._line.extend(buffer[start:end])
+            return -1
+        line = str(self._line + buffer[start:pos])
+        self._line = bytearray()
+        words = line.split()
+        self.verb = words and words[0].upper() or ''
+        if self.verb == 'BDAT':
+            try:
+                size = int(words[1])
+            except (IndexError, ValueError):
+                raise ValueError('Invalid BDAT command %r' % line.strip())
+            if size:
+                self._skip = size
+                return self.feed(buffer, pos, end)
+        return pos
+
+
+class ReplyParser(object):
+    """Incremental framing of the SMTP replies of a server.
+
+    *code* is the code of the last reply, *keywords* the first word of
+    each of its lines, e.g. the extensions listed in reply to EHLO.
+    """
+
+    def __init__(self, requests=False):
+        self.requests = requests
+        self.code = None
+        self.keywords = []
+        self.tunnel = False
+        self._line = bytearray()
+        self._continued = False
+
+    def at_boundary(self):
+        """Returns True if the parser is between two replies."""
+        return not self._line and not self._continued
+
+    def feed(self, buffer, start, end):
+        """Parses *buffer[start:end]*.
+
+        Returns the position right after the first reply that ends in
+        it, or -1 if all the data is part of an unfinished reply.
+        """
+        if self.tunnel:
+            return start < end and end or -1
+        pos = start
+        while pos < end:
+            next_pos = _line_end(buffer, pos, end)
+            if next_pos == -1:
+                if len(self._line) + end - pos > _MAX_LINE:
+                    raise ValueError('SMTP reply line too long')
+                self._line.extend(buffer[pos:end])
+                return -1
+            line = str(self._line + buffer[pos:next_pos])
+            self._line = bytearray()
+            pos = next_pos
+            try:
+                code = int(line[:3])
+            except ValueError:
+                raise ValueError('Invalid SMTP reply %r' % line.strip())
+            if not self._continued:
+                self.keywords = []
+            words = line[4:].split(None, 1)
+            if words and len(self.keywords) < _MAX_KEYWORDS:
+                self.keywords.append(words[0].upper())
+            self._continued = line[3:4] == '-'
+            if not self._continued:
+                self.code = code
+                return pos
+        return -1
+
+
+class Session(object):
+    """The dialogue of an SMTP connection, followed message by message.
+
+    *phase* is *command*, or *tunnel* once STARTTLS succeeded.
+    *extensions* are the keywords of the last reply to EHLO, e.g.
+    *PIPELINING*. The steps waiting for a reply are queued, several of
+    them when the client pipelines its commands: *step* is the one the
+    server answers next.
+    """
+
+    def __init__(self):
+        self.phase = COMMAND
+        self.extensions = set()
+        # True when the client sends the message data next
+        self.data = False
+        # True when the client answers an AUTH challenge next
+        self.challenge = False
+        # (step, reply) of the steps waiting for a reply, *reply* being
+        # the one injected instead of the server's, if any
+        self._pending = deque([(CONNECT, None)])
+
+    @property
+    def idle(self):
+        """True when no reply is expected from the server."""
+        return self.phase == COMMAND and not self._pending
+
+    @property
+    def step(self):
+        for step, reply in self._pending:
+            if reply is None:
+                return step
+        return None
+
+    def next_step(self, parser, verb):
+        """Returns the step of the next message of the client, from the
+        *verb* it starts with, or None if it is an answer to an AUTH
+        challenge."""
+        if parser.data:
+            return EOM
+        if self.challenge:
+            return None
+        return verb
+
+    def inject(self, step, reply):
+        """Queues *reply* as the answer to *step*, the server won't
+        answer it."""
+        self._pending.append((step, reply))
+
+    def injected(self):
+        """Returns the injected replies due, the server answered what
+        was sent before them."""
+        replies = []
+        while self._pending and self._pending[0][1] is not None:
+            replies.append(self._pending.popleft()[1])
+        return replies
+
+    def on_client_message(self, parser):
+        if self.phase == TUNNEL:
+            return
+        if parser.verb is None:
+            self._pending.append((EOM, None))
+        elif self.challenge:
+            self.challenge = False
+        else:
+            self._pending.append((parser.verb, None))
+
+    def on_server_message(self, parser):
+        if self.phase == TUNNEL:
+            return
+        code = parser.code
+        step = self._pending and self._pending.popleft()[0] or None
+        if code == 334:
+            # the AUTH dialogue goes on
+            self.challenge = True
+            self._pending.appendleft((step, None))
+        elif code == 354:
+            self.data = True
+        elif step == 'EHLO' and code == 250:
+            self.extensions = set(parser.keywords[1:])
+        elif step == 'STARTTLS' and code == 220:
+            self.phase = TUNNEL
+
+
+def parse_steps(steps):
+    """Returns the set of steps of a comma-separated list, or None if
+    the list is empty."""
+    selected = set(step.strip().upper() for step in steps.split(','))
+    selected.discard('')
+    return selected or None
+
+
+def error_reply(step, errors='any'):
+    """Returns an error reply fitting *step*, a transient one if *errors*
+    is '4xx', a permanent one if it is '5xx', any of them otherwise."""
+    codes = _STEP_ERRORS.get(step, _DEFAULT_ERRORS)
+    if errors != 'any':
+        codes = [code for code in codes if str(code)[0] == errors[0]]
+    code = random.choice(codes)
+    return '%d %s\r\n' % (code, _ERRORS[code])
+
+
+class SMTP(BaseProtocol):
     """SMTP Protocol.
 
+    Commands and replies are handled one at a time, in both directions
+    at the same time, and the dialogue is followed so behaviors can
+    target some steps of it:
+
+    - *steps* restricts the behaviors to some commands, e.g.
+      *MAIL,RCPT,DATA*, to the greeting of the server (*CONNECT*) or to
+      the end of the message data (*EOM*). The behaviors apply to the
+      targeted commands and to the replies to them.
+    - the message data is streamed as it comes, whatever its size.
+    - the *error* behavior answers the targeted commands with an error
+      reply fitting the step instead of sending them to the server. The
+      greeting and the reply to the message data, which is sent anyway,
+      are replaced. *errors* picks transient or permanent errors.
+
+    Pipelined commands are followed. Once STARTTLS succeeded, or from the
+    start with *tls* (e.g. on port 465), the connection is encrypted: the
+    behaviors apply to the data as it comes, like with the *tcp*
+    protocol, unless *steps* is set.
     """
     name = 'smtp'
-    options = copy.copy(TCP.options)
+    duplex = True
+    options = copy.copy(BaseProtocol.options)
     del options['keep_alive']
+    options['steps'] = ("Comma-separated commands the behaviors apply to, "
+                        "CONNECT for the greeting and EOM for the end of the "
+                        "message data. All of them if empty.", str, '')
+    options['errors'] = ("The error replies injected: 4xx, 5xx or any.",
+                         str, 'any', ('any', '4xx', '5xx'))
+    options['tls'] = ("If True, the connection is encrypted from the start.",
+                      bool, False)
 
-    def update_settings(self, settings):
-        if 'keep_alive' in settings:
-            del settings['keep_alive']
-        super(SMTP, self).update_settings(settings)
+    def _compile(self):
+        self._steps = parse_steps(self.option('steps'))
 
-    def option(self, name):
-        if name == 'keep_alive':
+    def _create_parser(self, to_backend):
+        if to_backend:
+            parser = CommandParser()
+        else:
+            parser = ReplyParser()
+        parser.tunnel = self.option('tls')
+        return parser
+
+    def get_session(self, backend_sock):
+        """Returns the :class:`Session` of the connection to
+        *backend_sock*."""
+        session = getattr(backend_sock, '_smtp', None)
+        if session is None:
+            session = backend_sock._smtp = Session()
+            if self.option('tls'):
+                session.phase = TUNNEL
+        return session
+
+    def is_idle(self, sock):
+        session = getattr(sock, '_smtp', None)
+        return (super(SMTP, self).is_idle(sock) and
+                (session is None or session.idle))
+
+    def _next_step(self, session, source, to_backend):
+        # the step of the next message of *source*, once it starts to
+        # arrive: the other direction may change the session meanwhile.
+        # Encrypted data is not peeked at, so behaviors can read it.
+        if session.phase != COMMAND:
+            return None
+        buffer = self._get_buffer(source)[0]
+        available = self._peek(source, 1)
+        if not available or session.phase != COMMAND:
+            return None
+        if not to_backend:
+            return session.step
+
+        parser = self._get_parser(source, to_backend)
+        # the verb is complete once 4 bytes or a line are read
+        while (0 < available < 4 and
+               buffer.find('\n', 0, available) == -1):
+            available = self._peek(source, available + 1)
+        words = str(buffer[:min(available, 16)]).split(None, 1)
+        return session.next_step(parser, words and words[0].upper() or '')
+
+    def describe(self, source, dest, to_backend):
+        # the commands and replies are named after their step, the
+        # encrypted data is forwarded in chunks
+        session = self.get_session(to_backend and dest or source)
+        if session.phase != COMMAND or not self._peek(source, 1):
+            return None
+        return Message(self._next_step(session, source, to_backend),
+                       to_backend=to_backend)
+
+    def __call__(self, source, dest, to_backend, behavior):
+        session = self.get_session(to_backend and dest or source)
+        step = self._next_step(session, source, to_backend)
+        if session.phase == TUNNEL:
+            targeted = self._steps is None
+        else:
+            targeted = step is not None and (self._steps is None or
+                                             step in self._steps)
+        if not targeted:
+            behavior = PASSTHROUGH
+        return super(SMTP, self).__call__(source, dest, to_backend,
+                                          behavior)
+
+    def _send_injected(self, session, client_sock):
+        for reply in session.injected():
+            client_sock.sendall(reply)
+
+    def inject_error(self, source, dest, to_backend):
+        """Answers the next message of *source* with an error reply, as
+        the *error* behavior does.
+
+        Returns False when the message was answered, True when it must
+        still be handled: the message data is sent to the server anyway,
+        and the reply to it is replaced. Returns None when the connection
+        is encrypted.
+        """
+        parser = self._get_parser(source, to_backend)
+        session = self.get_session(to_backend and dest or source)
+        step = self._next_step(session, source, to_backend)
+        if session.phase == TUNNEL:
+            # what was read when STARTTLS succeeded is forwarded as is
+            return self.has_pending(source) or None
+        if step is None or (to_backend and step == EOM):
+            return True
+        buffer = self._get_buffer(source)[0]
+        if not to_backend and self._peek(source, 3) == 3 and \
+                buffer[:3] in ('334', '354'):
+            # the server waits for more, answering would break the dialogue
             return True
-        return super(SMTP, self).option(name)
+
+        while True:
+            size = self._fill(source)
+            if not size:
+                return False
+            end = parser.feed(buffer, 0, size)
+            if end != -1:
+                self._keep(source, end, size)
+                break
+
+        reply = error_reply(step, self.option('errors'))
+        if to_backend:
+            session.inject(step, reply)
+            self._send_injected(session, source)
+        else:
+            session.on_server_message(parser)
+            dest.sendall(reply)
+            self._send_injected(session, dest)
+        return False
+
+    def _handle(self, source, dest, to_backend, on_between_handle):
+        parser = self._get_parser(source, to_backend)
+        if not self._forward_message(source, dest, parser):
+            return False
+
+        if to_backend:
+            self.get_session(dest).on_client_message(parser)
+        else:
+            session = self.get_session(source)
+            session.on_server_message(parser)
+            if session.data:
+                session.data = False
+                self._get_parser(dest, True).data = True
+            if session.phase == TUNNEL:
+                parser.tunnel = self._get_parser(dest, True).tunnel = True
+            self._send_injected(session, dest)
+
+        return on_between_handle()
@@ -1,6 +1,8 @@
 import re
+import copy
 
 from vaurien.protocols.base import BaseProtocol
+from vaurien import _splice
 
 
 RE_LEN = re.compile('Content-Length: (\d+)', re.M | re.I)
@@ -15,10 +17,23 @@ class TCP(BaseProtocol):
     """TCP handler.
     """
     name = 'tcp'
+    options = copy.copy(BaseProtocol.options)
+    options['splice'] = ("If True, the data is forwarded by the kernel with "
+                         "splice(2) while the dummy behavior is active "
+                         "(Linux only, requires keep_alive)", bool, False)
+
+    @property
+    def duplex(self):
+        # without keep-alive the answer is sucked right after the query
+        return self.option('keep_alive')
+
+    def can_splice(self, behavior):
+        return (behavior.name == 'dummy' and self.duplex and
+                self.option('splice') and _splice.available())
 
     def _handle(self, source, dest, to_backend, on_between_handle):
         # default TCP behavior
-        data = self._get_data(source)
+        data = self._get_view(source)
         if data:
             dest.sendall(data)
 
@@ -29,10 +44,9 @@ class TCP(BaseProtocol):
             # we can suck the answer back and close the socket
             if not self.option('keep_alive'):
                 # just suck it until it's empty
-                data = ''
                 while True:
-                    data = self._get_data(dest)
-                    if data == '':
+                    data = self._get_view(dest)
+                    if not data:
                         break
                     source.sendall(data)
 
@@ -43,4 +57,4 @@ class TCP(BaseProtocol):
                 # we're done - False means we'll disconnect the client
                 return False
 
-        return data != ''
+        return len(data) > 0
@@ -0,0 +1,233 @@
+"""WebSocket framing, see RFC 6455.
+
+Once the handshake of a connection is done, the *http* protocol hands it
+to a :class:`Framer`, that forwards the frames of both directions as
+they are read, one frame per call. Only their headers are parsed: the
+payloads are streamed through the read buffers, without being unmasked.
+
+A connection keeps a :class:`WebSocket` of a few slots, and gives its
+read buffers back while it waits for a frame, so idle connections cost
+little.
+"""
+import os
+import random
+import struct
+from socket import error
+
+from gevent.socket import wait_read
+
+from vaurien._tls import buffered
+
+
+CONTINUATION, TEXT, BINARY, CLOSE, PING, PONG = 0x0, 0x1, 0x2, 0x8, 0x9, 0xa
+OPCODES = {CONTINUATION: 'CONTINUATION', TEXT: 'TEXT', BINARY: 'BINARY',
+           CLOSE: 'CLOSE', PING: 'PING', PONG: 'PONG'}
+FIN = 0x80
+MASKED = 0x80
+
+# the faults of the behaviors
+DROP, CORRUPT = 'drop', 'corrupt'
+
+# the size of the extended length of a frame, by its 7 bits length
+_EXTENDED = {126: 2, 127: 8}
+# bytes changed in a corrupted frame, at most
+_CORRUPTED = 8
+
+
+def header_size(second):
+    """Returns the size of a frame header, from its second byte."""
+    size = 2 + _EXTENDED.get(second & 0x7f, 0)
+    if second & MASKED:
+        size += 4
+    return size
+
+
+def parse_header(data):
+    """Returns the *(fin, opcode, length)* of the frame header at the
+    start of *data*, which holds all of it."""
+    first, second = data[0], data[1]
+    length = second & 0x7f
+    if length == 126:
+        length = struct.unpack_from('>H', data, 2)[0]
+    elif length == 127:
+        length = struct.unpack_from('>Q', data, 2)[0]
+    return bool(first & FIN), first & 0x0f, length
+
+
+def frame(opcode, payload='', masked=False, fin=True):
+    """Returns a frame. The frames of the clients are *masked*."""
+    length = len(payload)
+    second = masked and MASKED or 0
+    if length < 126:
+        header = struct.pack('>BB', fin and FIN | opcode or opcode,
+                             second | length)
+    elif length < 0x10000:
+        header = struct.pack('>BBH', fin and FIN | opcode or opcode,
+                             second | 126, length)
+    else:
+        header = struct.pack('>BBQ', fin and FIN | opcode or opcode,
+                             second | 127, length)
+    if not masked:
+        return header + payload
+    mask = bytearray(os.urandom(4))
+    data = bytearray(payload)
+    for index in range(length):
+        data[index] ^= mask[index % 4]
+    return header + str(mask) + str(data)
+
+
+def close_frame(code, masked=False):
+    """Returns a close frame with the status *code*."""
+    return frame(CLOSE, struct.pack('>H', code), masked)
+
+
+def parse_opcodes(names):
+    """Returns the set of the opcodes of the comma-separated *names*.
+
+    Raises a ValueError if one of them is unknown.
+    """
+    opcodes = dict((name, opcode) for opcode, name in OPCODES.items())
+    found = set()
+    for name in names.split(','):
+        name = name.strip().upper()
+        if not name:
+            continue
+        if name not in opcodes:
+            raise ValueError('Unknown WebSocket frame %r' % name)
+        found.add(opcodes[name])
+    return frozenset(found)
+
+
+class WebSocket(object):
+    """The state of a WebSocket connection. Its lists are indexed by
+    *to_backend*.
+
+    - *opcodes*: the opcode of the fragmented message going on in each
+      direction, None between two messages.
+    - *faults*: the fault of the behaviors applied to the message going
+      on in each direction, or None.
+    """
+    __slots__ = ('opcodes', 'faults')
+
+    def __init__(self):
+        self.opcodes = [None, None]
+        self.faults = [None, None]
+
+
+class Framer(object):
+    """Forwards the frames of the WebSocket connections of *protocol*.
+
+    The behaviors apply to the messages starting with one of the
+    *opcodes*, see :meth:`targeted`. The frames of a message follow the
+    fault of its first one, the control frames in between go through.
+    """
+
+    def __init__(self, protocol, opcodes=frozenset([TEXT, BINARY]),
+                 close_code=1001):
+        self.protocol = protocol
+        self.opcodes = opcodes
+        self.close_code = close_code
+
+    def wait(self, source):
+        """Waits for the next frame of *source* without holding a read
+        buffer."""
+        protocol = self.protocol
+        if protocol.has_pending(source) or buffered(source):
+            return
+        protocol.release_buffer(source)
+        wait_read(source.fileno(), timeout=source.gettimeout())
+
+    def next_frame(self, source):
+        """Returns the *(fin, opcode, length, size)* of the next frame of
+        *source*, *size* being the size of its header, or None if
+        *source* is closed first."""
+        protocol = self.protocol
+        if protocol._peek(source, 2) < 2:
+            return None
+        buffer = protocol._get_buffer(source)[0]
+        size = header_size(buffer[1])
+        if protocol._peek(source, size) < size:
+            return None
+        return parse_header(buffer) + (size,)
+
+    def describe(self, websocket, source, to_backend):
+        header = self.next_frame(source)
+        if header is None:
+            return None
+        fin, opcode, length, size = header
+        size += length
+        if opcode == CONTINUATION:
+            opcode = websocket.opcodes[to_backend]
+            size = None
+        elif not fin:
+            # the size of the whole message isn't known
+            size = None
+        return OPCODES.get(opcode), size
+
+    def targeted(self, websocket, source, to_backend):
+        """Tells if the behaviors apply to the next frame of *source*: the
+        first one of a message, not failed yet."""
+        header = self.next_frame(source)
+        return (header is not None and header[1] in self.opcodes and
+                websocket.faults[to_backend] is None)
+
+    def fault(self, websocket, source, to_backend, fault):
+        """Applies *fault* to the message starting with the next frame
+        of *source*."""
+        header = self.next_frame(source)
+        if header is not None and header[1] < CLOSE:
+            websocket.faults[to_backend] = fault
+        return True
+
+    def close(self, source, dest, to_backend):
+        """Sends a close frame with *close_code* to both peers instead of
+        the next frame of *source*, and closes the connection."""
+        client_sock, backend_sock = to_backend and (source, dest) or \
+            (dest, source)
+        for sock, masked in ((client_sock, False), (backend_sock, True)):
+            try:
+                sock.sendall(close_frame(self.close_code, masked))
+            except error:
+                # the peer is gone already
+                pass
+        return self.protocol._close_both(source, dest)
+
+    def handle(self, websocket, source, dest, to_backend, on_between_handle):
+        protocol = self.protocol
+        header = self.next_frame(source)
+        if header is None:
+            return protocol._close_both(source, dest)
+        fin, opcode, length, size = header
+
+        fault = None
+        if opcode < CLOSE:
+            if opcode != CONTINUATION:
+                websocket.opcodes[to_backend] = opcode
+            fault = websocket.faults[to_backend]
+            if fin:
+                websocket.opcodes[to_backend] = None
+                websocket.faults[to_backend] = None
+
+        buffer, view = protocol._get_buffer(source)
+        available = protocol._fill(source)
+        if fault == CORRUPT and length:
+            # a few bytes of the payload read with the header
+            end = min(available, size + length)
+            for i in range(min(_CORRUPTED, end - size)):
+                pos = random.randrange(size, end)
+                buffer[pos] ^= random.randint(1, 255)
+
+        left = size + length
+        while True:
+            count = min(left, available)
+            if fault != DROP:
+                dest.sendall(view[:count])
+            left -= count
+            if not left:
+                break
+            available = protocol._fill(source)
+            if not available:
+                return protocol._close_both(source, dest)
+
+        protocol._keep(source, count, available)
+        return on_between_handle()
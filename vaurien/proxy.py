@@ -1,23 +1,186 @@
 import gevent
-import random
-from uuid import uuid4
+from inspect import isclass
+import time
 from socket import error
 
 from gevent.server import StreamServer
-from gevent.socket import create_connection
+from gevent.socket import create_connection, timeout, wait_read
 from gevent.select import select, error as gerror
+from gevent.lock import Semaphore
 
-from vaurien.util import parse_address, get_prefixed_sections, extract_settings
+from vaurien.util import (parse_address, get_prefixed_sections,
+                          extract_settings, is_readable, is_closed, is_alive,
+                          get_reuse_port_listener)
 from vaurien.protocols import get_protocols
+from vaurien.protocols.auto import parse_routes
 from vaurien.behaviors import get_behaviors
+from vaurien.metrics import Metrics, StatsdFlusher
 
+from vaurien.backends import BackendGroup, parse_backends
 from vaurien._pool import FactoryPool
+from vaurien._splice import Splicer
+from vaurien._sampler import AliasSampler
+from vaurien._tls import (create_server_context, create_client_context,
+                          buffered)
+
+
+ENGINES = ('pump', 'select')
+GRANULARITIES = ('connection', 'message', 'chunk')
+
+
+class _Choice(object):
+    """The behavior applied to a connection, see
+    :meth:`DefaultProxy._pick_behavior`."""
+
+    def __init__(self, behavior, name):
+        self.behavior = behavior
+        self.name = name
+
+
+class _Pumps(object):
+    """State shared by the two pump loops of a proxied connection."""
+
+    def __init__(self, client_sock, backend_sock, handler):
+        self.client_sock = client_sock
+        self.backend_sock = backend_sock
+        self.handler = handler
+        # half-duplex handlers read the answer themselves, so only one
+        # of them can run at a time.
+        self.lock = None if handler.duplex else Semaphore()
+        self.last_activity = time.time()
+
+    def touch(self):
+        self.last_activity = time.time()
+
+    def idle(self):
+        return time.time() - self.last_activity
+
+
+class BaseProxy(object):
+    """What the TCP and UDP proxies share: the behaviors, the groups of
+    backends and the metrics. Subclasses are gevent servers.
+    """
+
+    def _configure_behaviors(self):
+        # the settings are compiled once here, and on every change made
+        # with set_behavior(), instead of on every chunk.
+        args = self.settings['args']
+        for name, behavior in self.behaviors.items():
+            if isclass(behavior):
+                continue
+            behavior.update_settings(extract_settings(args, 'behavior', name))
+            section = self.settings.getsection('behavior.%s' % name)
+            if section:
+                behavior.update_settings(section)
+
+    def _init_metrics(self, metrics):
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        self._active = 0
+        self._connection_names = dict(
+            (name, '%s.%s' % (self.protocol, name))
+            for name in ('start', 'end', 'active', 'duration'))
+        self._chunk_names = {}
+
+        cfg = self.settings.getsection('statsd')
+        if cfg.get('enabled', False):
+            self._flusher = StatsdFlusher(
+                self.metrics, host=cfg.get('host', 'localhost'),
+                port=cfg.get('port', 8125),
+                prefix=cfg.get('prefix', 'vaurien'),
+                interval=cfg.get('flush_interval', 1.))
+        else:
+            self._flusher = None
+
+    def get_behavior(self):
+        return self.behavior, self.behavior_name
+
+    def set_backend(self, backend, strategy=None):
+        """Sends the new connections to *backend*, one or several
+        backends balanced with *strategy*, see :mod:`vaurien.backends`.
+
+        The connections to the previous backends are drained: the idle
+        ones are closed, the ones in use when their client is done.
+
+        Raises a ValueError if a backend or the strategy is invalid.
+        """
+        if strategy is None:
+            strategy = self.balance
+        group = self._create_group(backend, strategy)
+        if self.pool_min_size:
+            group.prewarm()
+
+        old = self.generation, self._group
+        self._group = group
+        self.backend = str(group)
+        self.balance = strategy
+        self.generation += 1
+        self._logger.info('Backend changed to %s' % self.backend)
+
+        old[1].drain()
+        self._draining.append(old)
+        # the protocols picked by auto without a route follow the backend
+        for name in [name for name in self._groups
+                     if name not in self._routes]:
+            group = self._groups.pop(name)
+            group.drain()
+            self._draining.append((old[0], group))
+        self._prune_drained()
+
+    def _prune_drained(self):
+        self._draining = [(generation, group)
+                          for generation, group in self._draining
+                          if not group.drained]
+
+    def get_backend_status(self):
+        """Returns the backends, their generation, and the connections
+        still in use for the previous backends."""
+        self._prune_drained()
+        draining = [{'backend': str(group), 'generation': generation,
+                     'in_use': group.in_use}
+                    for generation, group in self._draining]
+        return {'backend': self.backend, 'generation': self.generation,
+                'strategy': self.balance,
+                'backends': self._group.get_status(),
+                'draining': draining}
+
+    def get_stats(self):
+        """Returns the totals of the metrics, see :mod:`vaurien.metrics`."""
+        return self.metrics.get_stats()
+
+    def get_gauges(self):
+        """Returns the current values of the gauges among the metrics."""
+        return dict(self.metrics.gauges)
+
+    def get_behavior_names(self):
+        keys = get_behaviors().keys()
+        keys.sort()
+        return keys
 
+    def _count_chunk(self, behavior_name, to_backend):
+        key = behavior_name, to_backend
+        name = self._chunk_names.get(key)
+        if name is None:
+            direction = to_backend and 'to_backend' or 'to_client'
+            name = '%s.%s.%s' % (self.protocol, behavior_name, direction)
+            self._chunk_names[key] = name
+        self.metrics.incr(name)
+
+    def _pick_behavior(self, choice, to_backend):
+        """Returns the behavior and its name for the next chunk of a
+        connection.
+
+        *choice* is the behavior picked when the connection started, it
+        can be updated to change the behavior of the next chunks too.
+        """
+        return choice.behavior, choice.name
 
-class DefaultProxy(StreamServer):
+
+class DefaultProxy(BaseProxy, StreamServer):
 
     def __init__(self, proxy, backend, protocol='tcp', behaviors=None,
-                 settings=None, statsd=None, logger=None, **kwargs):
+                 settings=None, metrics=None, logger=None, **kwargs):
         self.settings = settings
         cfg = self.settings.getsection('vaurien')
 
@@ -25,47 +188,82 @@ class DefaultProxy(StreamServer):
             behaviors = get_behaviors()
 
         logger.info('Starting the Chaos TCP Server')
+        self.protocol = cfg.get('protocol', protocol)
+        protocols = get_protocols()
+        protocols.update(get_prefixed_sections(self.settings, 'protocol',
+                                               logger))
+        alpn = getattr(protocols.get(self.protocol), 'alpn', None)
+
         parsed_proxy = parse_address(proxy)
-        self.backend = backend
-        dest = parse_address(backend)
         backlog = cfg.get('backlog', 8192)
-        StreamServer.__init__(self, parsed_proxy, backlog=backlog, **kwargs)
+        certfile = cfg.get('tls_certfile')
+        if certfile:
+            # the handshake is done by handle(), with the proxy timeout
+            kwargs['ssl_context'] = create_server_context(
+                certfile, cfg.get('tls_keyfile'), alpn)
+            kwargs['do_handshake_on_connect'] = False
+        if cfg.get('reuse_port', False):
+            # several processes can listen on the same address
+            listener = get_reuse_port_listener(parsed_proxy, backlog)
+            StreamServer.__init__(self, listener, **kwargs)
+        else:
+            StreamServer.__init__(self, parsed_proxy, backlog=backlog,
+                                  **kwargs)
         self.max_accept = 2000  # XXX option ?
         self.pool_max_size = cfg.get('pool_max_size', 1000)
         self.pool_timeout = cfg.get('pool_timeout', 30)
+        self.pool_min_size = cfg.get('pool_min_size', 0)
         self.async_mode = not cfg.get('sync', False)
-        self._pool = FactoryPool(self._create_connection, self.pool_max_size,
-                                 self.pool_timeout)
-        self.dest = dest
         self.running = True
-        self._statsd = statsd
         self._logger = logger
         self.behaviors = behaviors
         self.behaviors.update(get_prefixed_sections(self.settings, 'behavior',
                                                     logger))
+        self._configure_behaviors()
         self.behavior = get_behaviors()['dummy']
         self.behavior_name = 'dummy'
         self.stay_connected = cfg.get('stay_connected', False)
         self.timeout = cfg.get('timeout', 30)
-        self.protocol = cfg.get('protocol', protocol)
+        if cfg.get('backend_tls', False):
+            self._backend_tls = create_client_context(
+                cfg.get('backend_tls_cafile'),
+                cfg.get('backend_tls_insecure', False), alpn)
+        else:
+            self._backend_tls = None
+        # the kernel can't move data it would have to encrypt or decrypt
+        self._can_splice = not (self.ssl_enabled or self._backend_tls)
+        self.engine = cfg.get('engine', 'pump')
+        if self.engine not in ENGINES:
+            raise ValueError('Unknown engine %r. Pick one of: %s.'
+                             % (self.engine, ', '.join(ENGINES)))
+
+        self._init_metrics(metrics)
+        self.balance = cfg.get('balance', 'round-robin')
+        self.generation = 1
+        self._group = self._create_group(backend, self.balance)
+        self.backend = str(self._group)
+        # (generation, group) of the previous backends
+        self._draining = []
 
         # creating the handler with the passed options
-        protocols = get_protocols()
-        protocols.update(get_prefixed_sections(self.settings, 'protocol',
-                                               logger))
-
         self.handler = protocols[self.protocol]
+        # with the auto protocol, the handler of each connection is picked
+        # among all of them, see _detect()
+        if self.protocol == 'auto':
+            if self.ssl_enabled:
+                raise ValueError("The auto protocol can't sniff the "
+                                 "connections the proxy decrypts")
+            self._handlers = protocols
+        else:
+            self._handlers = {self.protocol: self.handler}
+        for name, handler in self._handlers.items():
+            self._configure_handler(name, handler)
 
-        # updating the handler settings
-        args = settings['args']
-        self.handler.update_settings(extract_settings(args, 'protocol',
-                                                      self.protocol))
-
-        protocol_specific_settings = self.settings.getsection('protocol.%s' % self.protocol)
-        if protocol_specific_settings:
-            self.handler.update_settings(protocol_specific_settings)
-
-        self.handler.proxy = self
+        # the backends of the protocols picked by auto
+        self._routes = {}
+        self._groups = {}
+        if self.protocol == 'auto':
+            self._init_routes()
 
         logger.info('Options:')
         logger.info('* proxies from %s to %s' % (proxy, backend))
@@ -73,76 +271,286 @@ class DefaultProxy(StreamServer):
         logger.info('* stay_connected: %d' % self.stay_connected)
         logger.info('* pool_max_size: %d' % self.pool_max_size)
         logger.info('* pool_timeout: %d' % self.pool_timeout)
+        logger.info('* pool_min_size: %d' % self.pool_min_size)
         logger.info('* async_mode: %d' % self.async_mode)
-
-    def _create_connection(self):
-        conn = create_connection(self.dest, timeout=self.timeout)
+        logger.info('* engine: %s' % self.engine)
+        logger.info('* tls: %d' % self.ssl_enabled)
+        logger.info('* backend_tls: %d' % (self._backend_tls is not None))
+        for protocol, handler in sorted(self._handlers.items()):
+            for name, value in sorted(handler.get_details().items()):
+                logger.info('* %s %s: %s' % (protocol, name, value))
+                self.metrics.gauge('%s.%s.%s' % (protocol, name, value), 1)
+        for protocol, backend in sorted(self._routes.items()):
+            logger.info('* routes %s to %s' % (protocol, backend))
+
+    def _configure_handler(self, name, handler):
+        # updating the handler settings
+        handler.update_settings(extract_settings(self.settings['args'],
+                                                 'protocol', name))
+        section = self.settings.getsection('protocol.%s' % name)
+        if section:
+            handler.update_settings(section)
+        handler.proxy = self
+
+    def _init_routes(self):
+        fallback = self.handler.option('fallback')
+        if fallback not in self._handlers or fallback == 'auto':
+            raise ValueError('Unknown fallback protocol %r' % fallback)
+        host = parse_backends(self.backend)[0][0].rsplit(':', 1)[0]
+        self._routes = parse_routes(self.handler.option('routes'), host)
+        for name, backend in self._routes.items():
+            if name not in self._handlers or name == 'auto':
+                raise ValueError('Unknown protocol %r in the routes' % name)
+            parse_backends(backend)
+
+    def start(self):
+        # with auto, the pools are created with the first connections
+        if self.pool_min_size and self.protocol != 'auto':
+            opened = self._group.prewarm()
+            self._logger.info('Opened %d backend connections' % opened)
+        StreamServer.start(self)
+        if self._flusher is not None:
+            self._flusher.start()
+
+    def stop(self, *args, **kwargs):
+        try:
+            StreamServer.stop(self, *args, **kwargs)
+        finally:
+            if self._flusher is not None:
+                self._flusher.stop()
+
+    def _create_group(self, backends, strategy, protocol=None):
+        # each backend gets its own pool metrics when there are several
+        several = len(parse_backends(backends)) > 1
+
+        def create_pool(address, dest):
+            prefix = '%s.pool' % (protocol or self.protocol)
+            if several:
+                prefix += '.' + address.replace('.', '_').replace(':', '_')
+            return FactoryPool(lambda: self._create_connection(dest,
+                                                               address),
+                               self.pool_max_size, self.pool_timeout,
+                               min_size=self.pool_min_size, check=is_alive,
+                               metrics=self.metrics, prefix=prefix)
+
+        return BackendGroup(backends, create_pool, strategy)
+
+    def _create_connection(self, dest, address=None):
+        conn = create_connection(dest, timeout=self.timeout)
+        if self._backend_tls is not None:
+            # pooled, so the handshake is done once per backend connection
+            host = address and address.rsplit(':', 1)[0] or dest[0]
+            try:
+                conn = self._backend_tls.wrap_socket(conn,
+                                                     server_hostname=host)
+            except Exception:
+                conn.close()
+                raise
+        # the backend, as configured, for the protocols that need it
+        conn._backend = address
         if self.async_mode:
             conn.setblocking(0)
             conn.settimeout(self.timeout)
         return conn
 
-    def get_behavior(self):
-        return self.behavior, self.behavior_name
-
-    def get_behavior_names(self):
-        keys = get_behaviors().keys()
-        keys.sort()
-        return keys
+    def _detect(self, client_sock):
+        """Returns the handler of the connection of *client_sock* and the
+        backends it goes to, picked from its first bytes with the auto
+        protocol."""
+        name = self.handler.sniff(client_sock)
+        self.metrics.incr('auto.detected.%s' % name)
+        group = self._groups.get(name)
+        if group is None:
+            backend = self._routes.get(name, self.backend)
+            group = self._groups[name] = self._create_group(
+                backend, self.balance, name)
+        return self._handlers[name], group
+
+    def _handshake(self, client_sock):
+        try:
+            client_sock.do_handshake()
+        except (error, ValueError), e:
+            self.metrics.incr('tls.handshake_errors')
+            self._logger.debug('TLS handshake failed: %s' % e)
+            return False
+        return True
 
     def handle(self, client_sock, address):
         client_sock.setblocking(0)
         client_sock.settimeout(self.timeout)
-        behavior, behavior_name = self.get_behavior()
+        if self.ssl_enabled and not self._handshake(client_sock):
+            return
+        choice = _Choice(*self.get_behavior())
 
-        statsd_prefix = '%s.%s.' % (self.protocol, uuid4())
-        self.statsd_incr(statsd_prefix + 'start')
+        names = self._connection_names
+        started = time.time()
+        self._active += 1
+        self.metrics.incr(names['start'])
+        self.metrics.gauge(names['active'], self._active)
+        handler, group = self.handler, self._group
 
         try:
-            with self._pool.reserve() as backend_sock:
-                while True:
-                    try:
-                        res = select([client_sock, backend_sock], [], [],
-                                     timeout=self.timeout)
-                        rlist = res[0]
-                    except (error, gerror):
-                        backend_sock.close()
-                        backend_sock._closed = True
-                        break
-
-                    # gevent 1.x introduced 'closed'
-                    if hasattr(client_sock, 'closed') and client_sock.closed:
-                        raise ValueError("Client is gone")
-
-                    greens = [gevent.spawn(self._weirdify,
-                                           client_sock, backend_sock,
-                                           sock is not backend_sock,
-                                           statsd_prefix,
-                                           behavior, behavior_name)
-                              for sock in rlist]
-
-                    res = [green.get() for green in greens]
-
-                    got_data = all(res) and len(res) > 0
-
-                    if not got_data and not self.stay_connected:
-                        break
-
-                if not self.handler.settings['reuse_socket']:
+            if self.protocol == 'auto':
+                handler, group = self._detect(client_sock)
+
+            # the connection sticks to the pool it started with, even if
+            # the backend changes meanwhile
+            with group.pick().pool.reserve() as backend_sock:
+                if self.engine == 'pump':
+                    self._run_pumps(client_sock, backend_sock, choice,
+                                    handler)
+                else:
+                    self._run_select(client_sock, backend_sock, choice,
+                                     handler)
+
+                if (not handler.option('reuse_socket') or
+                        not handler.is_idle(backend_sock)):
                     backend_sock.close()
                     backend_sock._closed = True
+                if is_closed(backend_sock):
+                    handler.release_buffer(backend_sock)
         finally:
-            self.statsd_incr(statsd_prefix + 'end')
+            self._active -= 1
+            self.metrics.incr(names['end'])
+            self.metrics.gauge(names['active'], self._active)
+            self.metrics.observe(names['duration'],
+                                 (time.time() - started) * 1000)
             client_sock.close()
+            handler.release_buffer(client_sock)
+
+    def _run_pumps(self, client_sock, backend_sock, choice, handler):
+        """Proxies a connection with two long-lived pump loops.
+
+        One loop moves data from the client to the backend, the other one
+        from the backend to the client. Each of them blocks on its own
+        source socket, so nothing is selected or spawned per chunk.
+        """
+        pumps = _Pumps(client_sock, backend_sock, handler)
+        greens = [gevent.spawn(self._pump, pumps, to_backend, choice)
+                  for to_backend in (True, False)]
+        try:
+            # the connection is over as soon as one of the directions is
+            gevent.wait(greens, count=1)
+        finally:
+            gevent.killall(greens)
 
-    def statsd_incr(self, counter):
-        if self._statsd:
-            self._statsd.incr(counter)
-        elif self._logger:
-            self._logger.debug(counter)
+        for green in greens:
+            green.get()
+
+    def _pump(self, pumps, to_backend, choice):
+        client_sock, backend_sock = pumps.client_sock, pumps.backend_sock
+        handler = pumps.handler
+        if to_backend:
+            source, dest = client_sock, backend_sock
+        else:
+            source, dest = backend_sock, client_sock
+        splicer = None
+
+        try:
+            while True:
+                if is_closed(source) or is_closed(client_sock):
+                    return False
+                try:
+                    # the behavior is picked once the data is there: a
+                    # response gets the one of the request it answers. An
+                    # idle connection gives its read buffer back meanwhile.
+                    if not (handler.has_pending(source) or
+                            buffered(source)):
+                        if handler.duplex:
+                            handler.release_buffer(source)
+                        wait_read(source.fileno(), timeout=self.timeout)
+                    chunk_behavior = self._pick_behavior(choice, to_backend)
+                    if pumps.lock is None:
+                        if (self._can_splice and
+                                handler.can_splice(chunk_behavior[0])):
+                            if splicer is None:
+                                size = handler.option('buffer')
+                                splicer = Splicer(size)
+                            self._count_chunk(chunk_behavior[1], to_backend)
+                            got_data = splicer.forward(source, dest,
+                                                       self.timeout) > 0
+                        else:
+                            got_data = self._weirdify(client_sock,
+                                                      backend_sock,
+                                                      to_backend,
+                                                      *chunk_behavior,
+                                                      handler=handler)
+                    else:
+                        # checking the source is still readable once the
+                        # other direction is done with the sockets, as its
+                        # handler may have consumed the data.
+                        with pumps.lock:
+                            if is_closed(source) or not (
+                                    handler.has_pending(source) or
+                                    is_readable(source)):
+                                continue
+                            got_data = self._weirdify(client_sock,
+                                                      backend_sock,
+                                                      to_backend,
+                                                      *chunk_behavior,
+                                                      handler=handler)
+                except timeout:
+                    # the other direction may still be busy
+                    if (pumps.idle() < self.timeout or
+                            handler.may_idle(backend_sock, pumps.idle())):
+                        continue
+                    return False
+                except (error, OSError):
+                    return False
+
+                pumps.touch()
+                if not got_data and not self.stay_connected:
+                    return False
+        finally:
+            if splicer is not None:
+                splicer.close()
+
+    def _run_select(self, client_sock, backend_sock, choice, handler):
+        socks = client_sock, backend_sock
+        last_activity = time.time()
+        while True:
+            # data may already wait in the buffers of the handler, or
+            # decrypted in the ones of TLS
+            pending = [sock for sock in socks
+                       if handler.has_pending(sock) or buffered(sock)]
+            try:
+                res = select(socks, [], [],
+                             timeout=pending and 0 or self.timeout)
+                rlist = pending + [sock for sock in res[0]
+                                   if sock not in pending]
+            except (error, gerror):
+                backend_sock.close()
+                backend_sock._closed = True
+                break
+
+            # gevent 1.x introduced 'closed'
+            if hasattr(client_sock, 'closed') and client_sock.closed:
+                raise ValueError("Client is gone")
+
+            if not rlist:
+                if handler.may_idle(backend_sock,
+                                    time.time() - last_activity):
+                    continue
+            else:
+                last_activity = time.time()
+
+            greens = [gevent.spawn(self._weirdify,
+                                   client_sock, backend_sock,
+                                   sock is not backend_sock,
+                                   *self._pick_behavior(
+                                       choice, sock is not backend_sock),
+                                   handler=handler)
+                      for sock in rlist]
+
+            res = [green.get() for green in greens]
+
+            got_data = all(res) and len(res) > 0
+
+            if not got_data and not self.stay_connected:
+                break
 
     def _weirdify(self, client_sock, backend_sock, to_backend,
-                  statsd_prefix, behavior, behavior_name):
+                  behavior, behavior_name, handler=None):
         """This is where all the magic happens.
 
         Depending upon the configuration, we will chose to either drop packets,
@@ -151,46 +559,64 @@ class DefaultProxy(StreamServer):
         if hasattr(client_sock, 'closed') and client_sock.closed:
             raise ValueError("Client is gone")
 
+        self._count_chunk(behavior_name, to_backend)
         if to_backend:
-            self.statsd_incr(statsd_prefix + 'to_backend')
             dest = backend_sock
             source = client_sock
         else:
-            self.statsd_incr(statsd_prefix + 'to_client')
             source = backend_sock
             dest = client_sock
 
         self._logger.debug('starting weirdify %s' % to_backend)
         try:
-            # XXX cache this ?
-            args = self.settings['args']
-            behavior.update_settings(extract_settings(args, 'behavior',
-                                                      behavior_name))
             # calling the handler
-            return self.handler(source, dest, to_backend, behavior)
+            if handler is None:
+                handler = self.handler
+            return handler(source, dest, to_backend, behavior)
         finally:
             self._logger.debug('exiting weirdify %s' % to_backend)
 
 
-class RandomProxy(DefaultProxy):
+class RandomBehaviors(object):
+    """Picks the behaviors at random, with the weights of the *behavior*
+    setting. Mixed in the TCP and UDP proxies."""
 
     def __init__(self, *args, **kwargs):
-        super(RandomProxy, self).__init__(*args, **kwargs)
-        self.choices = []
+        super(RandomBehaviors, self).__init__(*args, **kwargs)
+        cfg = self.settings.getsection('vaurien')
+        self.granularity = cfg.get('granularity', 'chunk')
+        if self.granularity not in GRANULARITIES:
+            raise ValueError('Unknown granularity %r. Pick one of: %s.'
+                             % (self.granularity, ', '.join(GRANULARITIES)))
+        self.weights = {}
+        self._sampler = None
         self.initialize_choices()
 
     def initialize_choices(self):
-        total = 0
-        behavior = self.settings.getsection('vaurien')['behavior']
-        choices = {}
+        self.set_weights(self.settings.getsection('vaurien')['behavior'])
+
+    def set_weights(self, behavior):
+        """Sets the behaviors weights from a *weight:name,...* string.
+
+        The weights are percents and can be floats, e.g. *0.01:error*.
+        Whatever is left to reach 100 goes to the dummy behavior. The
+        new weights are used at once, for all connections.
+        """
+        weights = {}
 
-        for behavior in behavior.split(','):
-            choice = behavior.split(':')
+        for choice in behavior.split(','):
+            choice = choice.split(':')
             if len(choice) != 2:
                 raise ValueError('You need to use percentage:name')
 
             percent, behavior_name = choice
-            percent = int(percent)
+            try:
+                percent = float(percent)
+            except ValueError:
+                raise ValueError('%r is not a percentage' % percent)
+            if percent < 0:
+                raise ValueError('%r is not a percentage' % percent)
+
             if behavior_name not in self.behaviors:
                 choices = self.behaviors.keys()
                 msg = "%r is an unknown behavior. Pick one of: %s."
@@ -198,39 +624,54 @@ class RandomProxy(DefaultProxy):
                                         ', '.join(['%r' % choice
                                                    for choice in choices])))
 
-            choices[behavior_name] = self.behaviors[behavior_name], percent
-            total += percent
+            weights[behavior_name] = weights.get(behavior_name, 0) + percent
 
-        if total > 100:
+        total = sum(weights.values())
+        # leaving room for rounding errors, e.g. 33.3 + 33.3 + 33.4
+        if total > 100 + 1e-9:
             raise ValueError('The behavior total needs to be 100 or less')
-        elif total < 100:
-            missing = 100 - total
-            if 'dummy' in choices:
-                choices['dummy'][1] += missing
-            else:
-                choices['dummy'] = get_behaviors()['dummy'], missing
+        elif total < 100 - 1e-9:
+            weights['dummy'] = weights.get('dummy', 0) + 100 - total
+
+        # the sampler is built before being swapped in, so a connection
+        # never sees a partial update.
+        self._sampler = AliasSampler(
+            [((self.behaviors[name], name), weight)
+             for name, weight in weights.items()])
+        self.weights = weights
+
+    def _pick_behavior(self, choice, to_backend):
+        if self.granularity == 'chunk':
+            return self.get_behavior()
+        if self.granularity == 'message' and to_backend:
+            # a new message starts, its response gets the same behavior
+            choice.behavior, choice.name = self.get_behavior()
+        return choice.behavior, choice.name
 
-        for name, (behavior, percent) in choices.items():
-            self.choices.extend(
-                [(self.behaviors[name], name) for i in range(percent)])
+    def get_behavior(self):
+        return self._sampler.pick()
 
-    def _weirdify(self, client_sock, backend_sock, to_backend,
-                  statsd_prefix, behavior, behavior_name):
-        behavior, behavior_name = self.get_behavior()
-        return super(RandomProxy, self)._weirdify(client_sock, backend_sock,
-                                                  to_backend, statsd_prefix,
-                                                  behavior, behavior_name)
+    def get_weights(self):
+        return dict(self.weights)
 
-    def get_behavior(self):
-        return random.choice(self.choices)
+
+class RandomProxy(RandomBehaviors, DefaultProxy):
+    pass
 
 
-class OnTheFlyProxy(DefaultProxy):
+class OnTheFlyBehaviors(RandomBehaviors):
+    """Applies the behavior set through the HTTP API, or the behaviors
+    picked at random with the weights set through it. Mixed in the TCP
+    and UDP proxies."""
 
     def set_behavior(self, **options):
         behavior_name = options.pop('name')
-        self.behavior = self.behaviors[behavior_name]
-        self.behavior_name = behavior_name
-        for name, value in options.items():
-            self.behavior.settings[name] = value
+        behavior = self.behaviors[behavior_name]
+        # recompiles the behavior options, raises ValueError on bad values
+        behavior.update_settings(options)
+        self.set_weights('100:%s' % behavior_name)
         self._logger.info('Handler changed to "%s"' % behavior_name)
+
+
+class OnTheFlyProxy(OnTheFlyBehaviors, DefaultProxy):
+    pass
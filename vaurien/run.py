@@ -3,6 +3,8 @@ import sys
 import logging
 
 from vaurien.proxy import OnTheFlyProxy, RandomProxy
+from vaurien.datagram import OnTheFlyDatagramProxy, RandomDatagramProxy
+from vaurien.workers import Workers
 from vaurien.config import load_into_settings, DEFAULT_SETTINGS
 from vaurien import __version__, logger
 from vaurien.behaviors import get_behaviors
@@ -49,18 +51,6 @@ def configure_logger(logger, level='INFO', output="-"):
     logger.addHandler(h)
 
 
-def get_statsd_from_settings(settings):
-    if settings['enabled']:
-        from statsd import StatsdClient
-        statsd = StatsdClient(host=settings['host'],
-                              port=settings['port'],
-                              prefix=settings['prefix'],
-                              sample_rate=settings['sample_rate'])
-    else:
-        statsd = None
-    return statsd
-
-
 def build_args(parser, items, prefix):
     for name, klass in items:
         for option_name, option in klass.options.items():
@@ -84,7 +74,7 @@ def build_args(parser, items, prefix):
                                 help=description, **kws)
 
 
-def main():
+def build_parser():
     # get the values from the default config
     defaults = DEFAULT_SETTINGS.items()
     defaults.sort()
@@ -103,6 +93,8 @@ def main():
                         help='Port of the http server, if any')
     parser.add_argument('--protocol', default='tcp', choices=get_protocols(),
                         help='Protocol used')
+    parser.add_argument('--workers', default=1, type=int,
+                        help='Number of processes running the proxy')
 
     for key, default in defaults:
         if key.startswith('vaurien'):
@@ -128,6 +120,11 @@ def main():
 
     # same thing for the protocols
     build_args(parser, get_protocols().items(), 'protocol')
+    return parser
+
+
+def main():
+    parser = build_parser()
 
     # parsing the provided args
     args = parser.parse_args()
@@ -167,18 +164,38 @@ def main():
 
     # pass the args in the settings
     settings['args'] = args
-    statsd = get_statsd_from_settings(settings.getsection('statsd'))
 
     # creating the proxy
     proxy_args = dict(proxy=settings['vaurien.proxy'],
                       backend=settings['vaurien.backend'],
-                      settings=settings, statsd=statsd, logger=logger,
+                      settings=settings, logger=logger,
                       protocol=args.protocol)
 
-    if args.http:
+    if settings['vaurien.udp']:
+        # datagrams have no protocol of their own
+        proxy_args['protocol'] = 'udp'
+        if args.http:
+            proxy_class = OnTheFlyDatagramProxy
+        else:
+            proxy_class = RandomDatagramProxy
+    elif args.http:
         # if we are using the http server, then we want to use the OnTheFly
         # proxy
-        proxy = OnTheFlyProxy(**proxy_args)
+        proxy_class = OnTheFlyProxy
+    else:
+        # per default, we want to randomize
+        proxy_class = RandomProxy
+
+    if args.workers > 1:
+        # every worker listens on the proxy address
+        settings['vaurien.reuse_port'] = True
+        proxy = Workers(args.workers, lambda: proxy_class(**proxy_args),
+                        backend=settings['vaurien.backend'], logger=logger)
+        proxy.start()
+    else:
+        proxy = proxy_class(**proxy_args)
+
+    if args.http:
         from vaurien.webserver import get_config
         from gevent.pywsgi import WSGIServer
 
@@ -196,9 +213,6 @@ def main():
         http_server.start()
         logger.info('Started the HTTP server: http://%s:%s' %
                     (args.http_host, args.http_port))
-    else:
-        # per default, we want to randomize
-        proxy = RandomProxy(**proxy_args)
 
     try:
         proxy.serve_forever()
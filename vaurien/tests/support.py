@@ -1,9 +1,17 @@
 import sys
 import subprocess
 
+from vaurien import logger
+from vaurien.behaviors import get_behaviors
+from vaurien.config import DEFAULT_SETTINGS
+from vaurien.protocols.memcache_binary import (HEADER, HEADER_SIZE, QUIET,
+                                               OPCODES, RESPONSE_MAGIC)
+from vaurien.proxy import DefaultProxy
+from vaurien.run import build_parser
 from vaurien.webserver import get_config
 
 from gevent.pywsgi import WSGIServer
+from gevent.server import StreamServer
 
 
 class FakeProxy(object):
@@ -13,6 +21,7 @@ class FakeProxy(object):
         self.behaviors = behaviors or ['default', 'blackout']
         self.behavior = 'default'
         self.behavior_options = {}
+        self.weights = {'default': 100.}
         self.backend = backend or '0.0.0.0:80'
 
     def get_behavior(self):
@@ -28,6 +37,29 @@ class FakeProxy(object):
     def get_behavior_names(self):
         return self.behaviors
 
+    def set_weights(self, behavior):
+        weights = {}
+        for choice in behavior.split(','):
+            percent, name = choice.split(':')
+            if name not in self.behaviors:
+                raise ValueError('%r is an unknown behavior' % name)
+            weights[name] = float(percent)
+        self.weights = weights
+
+    def get_weights(self):
+        return self.weights
+
+    def set_backend(self, backend, strategy=None):
+        if not backend:
+            raise ValueError('No backend')
+        self.backend = backend
+
+    def get_backend_status(self):
+        return {'backend': self.backend, 'generation': 1, 'draining': []}
+
+    def get_stats(self):
+        return {'tcp.start': 1, 'tcp.end': 1}
+
 
 def start_vaurien_httpserver(port):
     """Start a vaurien httpserver, controlling a fake proxy"""
@@ -39,6 +71,115 @@ def start_vaurien_httpserver(port):
     server.serve_forever()
 
 
+def start_inprocess_proxy(backend_port, protocol='tcp', options=(),
+                          proxy_class=DefaultProxy, **settings):
+    """Starts a proxy of *proxy_class* in this process, on a free port.
+
+    *options* are command-line options, *settings* vaurien settings,
+    without the *vaurien.* prefix.
+    """
+    proxy_settings = DEFAULT_SETTINGS.copy()
+    for key, value in settings.items():
+        proxy_settings['vaurien.' + key] = value
+    proxy_settings['args'] = build_parser().parse_args(list(options))
+
+    proxy = proxy_class(proxy='localhost:0',
+                        backend='localhost:%d' % backend_port,
+                        protocol=protocol, settings=proxy_settings,
+                        logger=logger)
+    proxy.start()
+    return proxy
+
+
+def use_behavior(proxy, name, **options):
+    """Makes *proxy* use a new *name* behavior with *options*, and
+    returns it. The registered behaviors are shared by all the proxies,
+    so their settings are left alone."""
+    behavior = get_behaviors()[name].__class__()
+    behavior.update_settings(options)
+    proxy.behavior, proxy.behavior_name = behavior, name
+    return behavior
+
+
+def _recv_exactly(sock, size):
+    data = ''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+class MemcacheBinaryServer(StreamServer):
+    """A small in-process memcached stand-in speaking the binary protocol.
+
+    Supports get, getk, set, delete, their quiet versions, noop, version
+    and quit. The values are kept in *data*, and the opcodes received in
+    *opcodes*.
+    """
+
+    def __init__(self, address=('localhost', 0)):
+        StreamServer.__init__(self, address, self._serve)
+        self.data = {}
+        self.opcodes = []
+
+    def _response(self, opcode, opaque, status=0, key='', extras='',
+                  value=''):
+        body = extras + key + value
+        return HEADER.pack(RESPONSE_MAGIC, opcode, len(key), len(extras), 0,
+                           status, len(body), opaque, 0) + body
+
+    def _answer(self, opcode, key, extras, value, opaque):
+        name = OPCODES.get(opcode, '').rstrip('q')
+        if name in ('get', 'getk'):
+            if key not in self.data:
+                if opcode in QUIET:
+                    return ''
+                return self._response(opcode, opaque, 1, value='Not found')
+            flags, stored = self.data[key]
+            if name == 'getk':
+                return self._response(opcode, opaque, key=key, extras=flags,
+                                      value=stored)
+            return self._response(opcode, opaque, extras=flags,
+                                  value=stored)
+        if name == 'set':
+            self.data[key] = extras[:4], value
+        elif name == 'delete':
+            if self.data.pop(key, None) is None:
+                return self._response(opcode, opaque, 1, value='Not found')
+        elif name == 'version':
+            return self._response(opcode, opaque, value='1.6.0')
+        elif name not in ('noop', 'quit'):
+            return self._response(opcode, opaque, 0x81,
+                                  value='Unknown command')
+        if opcode in QUIET:
+            return ''
+        return self._response(opcode, opaque)
+
+    def _serve(self, sock, address):
+        try:
+            while True:
+                header = _recv_exactly(sock, HEADER_SIZE)
+                if header is None:
+                    break
+                (magic, opcode, key_length, extras_length, data_type,
+                 vbucket, body_length, opaque, cas) = HEADER.unpack(header)
+                body = _recv_exactly(sock, body_length)
+                if body is None:
+                    break
+                self.opcodes.append(opcode)
+                extras = body[:extras_length]
+                key = body[extras_length:extras_length + key_length]
+                value = body[extras_length + key_length:]
+                sock.sendall(self._answer(opcode, key, extras, value,
+                                          opaque))
+                if OPCODES.get(opcode) in ('quit', 'quitq'):
+                    break
+        finally:
+            sock.close()
+
+
 def start_simplehttp_server(port=8888):
     cmd = [sys.executable, '-m', 'SimpleHTTPServer', str(port)]
     server = subprocess.Popen(cmd, stdout=subprocess.PIPE,
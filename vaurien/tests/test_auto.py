@@ -0,0 +1,113 @@
+import struct
+import unittest
+
+import gevent
+from gevent.server import StreamServer
+from gevent.socket import create_connection
+
+from vaurien.protocols.auto import detect, parse_routes
+from vaurien.tests.support import start_inprocess_proxy, _recv_exactly
+from vaurien.tests.test_http import _Backend
+
+
+class TestDetect(unittest.TestCase):
+
+    def test_detect(self):
+        for data, name in [
+                ('GET / HTTP/1.1\r\n', 'http'),
+                ('OPTIONS * HTTP/1.1\r\n', 'http'),
+                ('PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n', 'http2'),
+                ('*1\r\n$4\r\nPING\r\n', 'redis'),
+                ('get key\r\n', 'memcache'),
+                ('stats\r\n', 'memcache'),
+                ('\x80\x00\x00\x00', 'memcache_binary'),
+                ('\x16\x03\x01\x02\x00', 'tcp'),
+                (struct.pack('>II', 8, 80877103), 'postgresql'),
+                (struct.pack('>II', 40, 196608), 'postgresql'),
+                ('\x00\x00\x00\x08\x00\x00\x00\x01', ''),
+                ('HELLO there\r\n', ''),
+                ('\x16\x01', ''),
+                ('G', None), ('GE', None), ('se', None), ('\x00\x00', None),
+                ('', None)]:
+            self.assertEqual(detect(data), name, repr(data))
+
+    def test_parse_routes(self):
+        self.assertEqual(parse_routes('', 'localhost'), {})
+        self.assertEqual(parse_routes('http=8080, redis=cache:6379',
+                                      'localhost'),
+                         {'http': 'localhost:8080', 'redis': 'cache:6379'})
+        self.assertRaises(ValueError, parse_routes, 'http', 'localhost')
+
+
+def _greeter(sock, address):
+    # a server speaking first, then echoing
+    try:
+        sock.sendall('hello\r\n')
+        while True:
+            data = sock.recv(1024)
+            if not data:
+                break
+            sock.sendall(data)
+    finally:
+        sock.close()
+
+
+class TestAutoProxy(unittest.TestCase):
+
+    def setUp(self):
+        self.http = _Backend()
+        self.http.start()
+        self.greeter = StreamServer(('localhost', 0), _greeter)
+        self.greeter.start()
+        self.proxy = start_inprocess_proxy(
+            self.greeter.server_port, protocol='auto',
+            options=['--protocol-auto-routes',
+                     'http=%d' % self.http.server_port,
+                     '--protocol-auto-sniff-timeout', '0.2',
+                     '--protocol-tcp-keep-alive'])
+
+    def tearDown(self):
+        self.proxy.stop()
+        self.http.stop()
+        self.greeter.stop()
+
+    def test_http(self):
+        for i in range(3):
+            sock = create_connection(('localhost', self.proxy.server_port))
+            with gevent.Timeout(5):
+                # the first bytes arrive in pieces
+                sock.sendall('GE')
+                gevent.sleep(0.05)
+                sock.sendall('T /a HTTP/1.1\r\nConnection: close\r\n\r\n')
+                response = ''
+                while True:
+                    data = sock.recv(1024)
+                    if not data:
+                        break
+                    response += data
+                self.assertTrue(response.startswith('HTTP/1.1 200 OK'))
+                self.assertTrue('/a' in response)
+            sock.close()
+
+        stats = self.proxy.get_stats()
+        self.assertEqual(stats['auto.detected.http'], 3)
+        # the http handler kept the backend connection
+        self.assertEqual(self.http.connections, 1)
+
+    def test_fallback(self):
+        sock = create_connection(('localhost', self.proxy.server_port))
+        with gevent.Timeout(5):
+            # the client waits for the server to speak first
+            self.assertEqual(_recv_exactly(sock, 7), 'hello\r\n')
+            sock.sendall('HELO\r\n')
+            self.assertEqual(_recv_exactly(sock, 6), 'HELO\r\n')
+        sock.close()
+        self.assertEqual(self.proxy.get_stats()['auto.detected.tcp'], 1)
+
+    def test_invalid_routes(self):
+        self.assertRaises(ValueError, start_inprocess_proxy,
+                          self.greeter.server_port, protocol='auto',
+                          options=['--protocol-auto-routes', 'what=80'])
+        self.assertRaises(ValueError, start_inprocess_proxy,
+                          self.greeter.server_port, protocol='auto',
+                          options=['--protocol-auto-fallback', 'auto'])
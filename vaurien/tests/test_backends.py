@@ -0,0 +1,71 @@
+import unittest
+
+from vaurien.backends import BackendGroup, parse_backends
+
+
+class FakePool(object):
+
+    def __init__(self, address, dest):
+        self.address = address
+        self.dest = dest
+        self.in_use = 0
+        self.draining = False
+
+    def drain(self):
+        self.draining = True
+
+    @property
+    def drained(self):
+        return self.draining and self.in_use == 0
+
+
+class TestBackends(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(parse_backends('localhost:80'),
+                         [('localhost:80', 1.)])
+        self.assertEqual(parse_backends('a:80=3, b:81'),
+                         [('a:80', 3.), ('b:81', 1.)])
+        self.assertEqual(parse_backends(['a:80', 'b:81=0.5']),
+                         [('a:80', 1.), ('b:81', .5)])
+
+        for invalid in ('', 'localhost', 'a:http', 'a:80=0', 'a:80=x',
+                        'a:0', []):
+            self.assertRaises(ValueError, parse_backends, invalid)
+
+    def test_round_robin(self):
+        group = BackendGroup('127.0.0.1:81,127.0.0.1:82', FakePool)
+        self.assertEqual(str(group), '127.0.0.1:81,127.0.0.1:82')
+        self.assertEqual(group.backends[0].pool.dest, ('127.0.0.1', 81))
+        picked = [group.pick().address for i in range(4)]
+        self.assertEqual(picked, ['127.0.0.1:81', '127.0.0.1:82'] * 2)
+
+    def test_least_connections(self):
+        group = BackendGroup('127.0.0.1:81,127.0.0.1:82=2', FakePool,
+                             'least-connections')
+        self.assertEqual(str(group), '127.0.0.1:81,127.0.0.1:82=2')
+        first, second = group.backends
+        first.pool.in_use = 2
+        second.pool.in_use = 3
+        self.assertTrue(group.pick() is second)
+        second.pool.in_use = 5
+        self.assertTrue(group.pick() is first)
+
+    def test_weighted(self):
+        group = BackendGroup('127.0.0.1:81=99,127.0.0.1:82=1', FakePool,
+                             'weighted')
+        picked = [group.pick().address for i in range(1000)]
+        self.assertTrue(picked.count('127.0.0.1:81') > 900)
+
+    def test_drain(self):
+        group = BackendGroup('127.0.0.1:81,127.0.0.1:82', FakePool)
+        group.backends[0].pool.in_use = 1
+        group.drain()
+        self.assertFalse(group.drained)
+        self.assertEqual(group.in_use, 1)
+        group.backends[0].pool.in_use = 0
+        self.assertTrue(group.drained)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, BackendGroup, '127.0.0.1:81',
+                          FakePool, 'random')
@@ -0,0 +1,146 @@
+import unittest
+
+import gevent
+from gevent.server import DatagramServer
+from gevent.socket import socket, timeout, AF_INET, SOCK_DGRAM
+
+from vaurien import _recvmmsg
+from vaurien.datagram import DatagramProxy
+from vaurien.tests.support import start_inprocess_proxy, use_behavior
+
+
+class _Echo(DatagramServer):
+    # echoes the datagrams, and keeps them
+
+    def __init__(self):
+        DatagramServer.__init__(self, ('127.0.0.1', 0))
+        self.received = []
+
+    def handle(self, data, address):
+        self.received.append(data)
+        self.socket.sendto(data, address)
+
+
+def _client():
+    sock = socket(AF_INET, SOCK_DGRAM)
+    sock.settimeout(0.5)
+    return sock
+
+
+def _recv_all(sock):
+    datagrams = []
+    while True:
+        try:
+            datagrams.append(sock.recv(1024))
+        except timeout:
+            return datagrams
+
+
+class TestDatagramProxy(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = _Echo()
+        self.backend.start()
+        self.proxy = start_inprocess_proxy(self.backend.server_port,
+                                           protocol='udp',
+                                           proxy_class=DatagramProxy,
+                                           timeout=1)
+        self.address = '127.0.0.1', self.proxy.server_port
+
+    def tearDown(self):
+        self.proxy.stop()
+        self.backend.stop()
+
+    def test_flows(self):
+        clients = [_client() for i in range(2)]
+        for i in range(3):
+            for index, sock in enumerate(clients):
+                sock.sendto('ping %d' % index, self.address)
+                self.assertEqual(sock.recv(1024), 'ping %d' % index)
+
+        # a flow per client address
+        self.assertEqual(len(self.proxy.flows), 2)
+        stats = self.proxy.get_stats()
+        self.assertEqual(stats['udp.start'], 2)
+        self.assertEqual(stats['udp.dummy.to_backend'], 6)
+        self.assertEqual(stats['udp.dummy.to_client'], 6)
+        self.assertEqual(self.proxy.get_backend_status()['backends'],
+                         [{'backend': 'localhost:%d'
+                           % self.backend.server_port,
+                           'weight': 1., 'in_use': 2}])
+
+        # the idle flows expire
+        gevent.sleep(2.5)
+        self.assertEqual(self.proxy.flows, {})
+        self.assertEqual(self.proxy.get_stats()['udp.end'], 2)
+        for sock in clients:
+            sock.close()
+
+    def test_resolved_once(self):
+        # the flows connect to the address resolved with the group
+        destination = self.proxy._group.backends[0].pool
+        self.assertEqual(destination.dest,
+                         ('127.0.0.1', self.backend.server_port))
+
+    def test_drop(self):
+        use_behavior(self.proxy, 'drop')
+        sock = _client()
+        sock.sendto('ping', self.address)
+        self.assertEqual(_recv_all(sock), [])
+        self.assertEqual(self.backend.received, [])
+        sock.close()
+
+    def test_duplicate(self):
+        use_behavior(self.proxy, 'duplicate', copies=1)
+        sock = _client()
+        sock.sendto('ping', self.address)
+        # twice to the backend, each echo twice to the client
+        self.assertEqual(_recv_all(sock), ['ping'] * 4)
+        self.assertEqual(self.backend.received, ['ping'] * 2)
+        sock.close()
+
+    def test_reorder(self):
+        use_behavior(self.proxy, 'reorder', hold=0.2)
+        sock = _client()
+        sock.sendto('a', self.address)
+        sock.sendto('b', self.address)
+        sock.sendto('c', self.address)
+        received = _recv_all(sock)
+        self.assertEqual(self.backend.received, ['b', 'a', 'c'])
+        self.assertEqual(sorted(received), ['a', 'b', 'c'])
+        sock.close()
+
+    def test_delay(self):
+        use_behavior(self.proxy, 'delay', sleep=0.1, jitter=0.1)
+        sock = _client()
+        sock.sendto('ping', self.address)
+        with gevent.Timeout(0.15, False):
+            sock.recv(1024)
+            self.fail('Not delayed')
+        self.assertEqual(sock.recv(1024), 'ping')
+        sock.close()
+
+
+class TestRecvmmsg(unittest.TestCase):
+
+    def test_receive(self):
+        if not _recvmmsg.available():
+            return
+        server = socket(AF_INET, SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        client = _client()
+        client.bind(('127.0.0.1', 0))
+        try:
+            receiver = _recvmmsg.Receiver(count=4, size=8)
+            self.assertEqual(receiver.receive(server.fileno()), [])
+            for i in range(6):
+                client.sendto('datagram %d' % i, server.getsockname())
+            gevent.sleep(0.05)
+            address = client.getsockname()
+            self.assertEqual(receiver.receive(server.fileno()),
+                             [('datagram', address)] * 4)
+            self.assertEqual(receiver.receive(server.fileno()),
+                             [('datagram', address)] * 2)
+        finally:
+            client.close()
+            server.close()
@@ -0,0 +1,263 @@
+import random
+import unittest
+
+import gevent
+from gevent.server import StreamServer
+from gevent.socket import create_connection
+
+import os
+
+from vaurien.protocols.http import (MessageParser, parse_head, HEAD_PARSERS,
+                                    get_head_parser)
+from vaurien.tests.support import start_inprocess_proxy, use_behavior
+
+
+class _Reader(object):
+    """Splits the data fed to *parser* in messages."""
+
+    def __init__(self, parser, method=None):
+        self.parser = parser
+        self.method = method
+        self.current = ''
+
+    def feed(self, data):
+        parser = self.parser
+        messages = []
+        buffer = bytearray(data)
+        start = 0
+        while start < len(buffer):
+            if parser.in_head:
+                end = parser.feed_head(buffer, start, len(buffer))
+                if end == -1:
+                    break
+                self.current += str(parser.head)
+                parser.parse(self.method)
+                start = end
+            end = parser.feed_body(buffer, start, len(buffer))
+            if end == -1:
+                self.current += str(buffer[start:])
+                break
+            messages.append(self.current + str(buffer[start:end]))
+            self.current = ''
+            parser.reset()
+            start = end
+        return messages
+
+
+def _split(parser, data, chunk, method=None):
+    """Feeds *data* to *parser* in chunks of *chunk* bytes, returns the
+    messages found."""
+    reader = _Reader(parser, method)
+    messages = []
+    for pos in range(0, len(data), chunk):
+        messages.extend(reader.feed(data[pos:pos + chunk]))
+    return messages
+
+
+REQUESTS = [
+    'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n',
+    'POST /form HTTP/1.1\r\nHost: example.com\r\nContent-Length: 5'
+    '\r\n\r\nhello',
+    'PUT /file HTTP/1.1\r\ntransfer-encoding: chunked\r\n\r\n'
+    '5;ext=1\r\nhello\r\n6\r\n world\r\n0\r\nTrailer: yes\r\n\r\n',
+    'POST /big HTTP/1.1\r\nContent-Length: 100000\r\n\r\n%s' % ('x' * 100000),
+    'DELETE /thing HTTP/1.0\r\n\r\n',
+]
+
+RESPONSES = [
+    'HTTP/1.1 100 Continue\r\n\r\n',
+    'HTTP/1.1 200 OK\r\nContent-Length: 3\r\n\r\nabc',
+    'HTTP/1.1 204 No Content\r\n\r\n',
+    'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+    '3\r\nabc\r\n0\r\n\r\n',
+    'HTTP/1.1 304 Not Modified\r\nContent-Length: 10\r\n\r\n',
+]
+
+
+class TestMessageParser(unittest.TestCase):
+
+    def test_requests(self):
+        data = ''.join(REQUESTS)
+        for chunk in (1, 2, 3, 7, 64, 8192, len(data)):
+            parser = MessageParser(requests=True)
+            self.assertEqual(_split(parser, data, chunk), REQUESTS)
+            self.assertTrue(parser.at_boundary())
+            self.assertEqual(parser.method, 'DELETE')
+            self.assertFalse(parser.keep_alive)
+
+    def test_responses(self):
+        data = ''.join(RESPONSES)
+        for chunk in (1, 2, 3, 7, 64, len(data)):
+            parser = MessageParser()
+            self.assertEqual(_split(parser, data, chunk), RESPONSES)
+            self.assertTrue(parser.at_boundary())
+
+    def test_head_response(self):
+        parser = MessageParser()
+        response = 'HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\n'
+        self.assertEqual(_split(parser, response * 2, 5, method='HEAD'),
+                         [response, response])
+
+    def test_parse_head(self):
+        start, headers = parse_head('GET / HTTP/1.1\r\nA: 1\r\nB:2\r\n'
+                                    'a: 3\r\n\r\n')
+        self.assertEqual(start, ['GET', '/', 'HTTP/1.1'])
+        self.assertEqual(headers, {'a': '1, 3', 'b': '2'})
+        self.assertRaises(ValueError, parse_head, 'GET\r\n\r\n')
+        self.assertRaises(ValueError, parse_head,
+                          'GET / HTTP/1.1\r\nnocolon\r\n\r\n')
+
+    def test_head_parsers(self):
+        # all the parsers agree on the recorded messages
+        corpus = os.path.join(os.path.dirname(__file__), '..', '..',
+                              'loadtest', 'corpus')
+        for kind in ('requests', 'responses'):
+            with open(os.path.join(corpus, 'http-%s.txt' % kind)) as f:
+                data = f.read()
+            heads = [message[:message.index('\r\n\r\n') + 4]
+                     for message in _split(MessageParser(kind == 'requests'),
+                                           data, len(data))]
+            self.assertEqual(len(heads), 4)
+            for name, func in HEAD_PARSERS:
+                for head in heads:
+                    start, headers = parse_head(head)
+                    parsed_start, parsed_headers = func(head)
+                    if kind == 'responses':
+                        # the reason phrase is optional
+                        start, parsed_start = start[:2], parsed_start[:2]
+                    self.assertEqual((parsed_start, parsed_headers),
+                                     (start, headers), name)
+                    self.assertRaises(ValueError, func, 'GET\r\n\r\n')
+
+        self.assertEqual(get_head_parser('python'), ('python', parse_head))
+        self.assertEqual(get_head_parser()[0], HEAD_PARSERS[0][0])
+        self.assertRaises(ValueError, get_head_parser, 'what')
+
+    def test_invalid(self):
+        parser = MessageParser()
+        parser.feed_head(bytearray('HTTP/1.1 200 OK\r\n'
+                                   'Content-Length: 1, 2\r\n\r\n'), 0, 43)
+        self.assertRaises(ValueError, parser.parse)
+
+        parser = MessageParser()
+        parser.feed_head(bytearray('HTTP/1.1 200 OK\r\n'
+                                   'Transfer-Encoding: chunked\r\n\r\n'), 0,
+                         47)
+        parser.parse()
+        self.assertRaises(ValueError, parser.feed_body,
+                          bytearray('zz\r\n'), 0, 4)
+
+
+class _Backend(StreamServer):
+    # answers the requests in order, without waiting for the next one,
+    # alternating chunked and Content-Length bodies.
+
+    def __init__(self):
+        StreamServer.__init__(self, ('localhost', 0), self._serve)
+        self.connections = 0
+        self.hosts = []
+
+    def _serve(self, sock, address):
+        self.connections += 1
+        reader = _Reader(MessageParser(requests=True))
+        count = 0
+        try:
+            while True:
+                data = sock.recv(4096)
+                if not data:
+                    break
+                for request in reader.feed(data):
+                    path = request.split()[1]
+                    self.hosts.append(reader.parser.headers.get('host'))
+                    count += 1
+                    if count % 2:
+                        sock.sendall('HTTP/1.1 200 OK\r\nContent-Length: '
+                                     '%d\r\n\r\n%s' % (len(path), path))
+                    else:
+                        sock.sendall('HTTP/1.1 200 OK\r\nTransfer-Encoding:'
+                                     ' chunked\r\n\r\n%x\r\n%s\r\n0\r\n\r\n'
+                                     % (len(path), path))
+        finally:
+            sock.close()
+
+
+class TestHttpProxy(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = _Backend()
+        self.backend.start()
+        self.proxy = start_inprocess_proxy(self.backend.server_port,
+                                           protocol='http')
+
+    def tearDown(self):
+        self.proxy.stop()
+        self.backend.stop()
+
+    def _request(self, paths, close=False):
+        sock = create_connection(('localhost', self.proxy.server_port))
+        data = ''.join('GET %s HTTP/1.1\r\nHost: localhost\r\n\r\n' % path
+                       for path in paths)
+        if close:
+            data += 'GET /last HTTP/1.1\r\nConnection: close\r\n\r\n'
+        pos = 0
+        while pos < len(data):
+            size = random.randint(1, 50)
+            sock.sendall(data[pos:pos + size])
+            pos += size
+
+        reader = _Reader(MessageParser(), 'GET')
+        responses = []
+        with gevent.Timeout(5):
+            while len(responses) < len(paths) + close:
+                data = sock.recv(65536)
+                self.assertTrue(data)
+                responses.extend(reader.feed(data))
+            if close:
+                self.assertEqual(sock.recv(1024), '')
+        sock.close()
+        # the path is the last word of the bodies
+        return [response.split()[-1 - ('chunked' in response)]
+                for response in responses]
+
+    def test_pipelining(self):
+        paths = ['/%d' % i for i in range(100)]
+        self.assertEqual(self._request(paths), paths)
+
+    def test_backend_reuse(self):
+        for i in range(5):
+            self.assertEqual(self._request(['/a', '/b'], close=True),
+                             ['/a', '/b', '/last'])
+        # the backend connection was pooled between the clients
+        self.assertEqual(self.backend.connections, 1)
+
+    def test_backend_reuse_on_close(self):
+        # the clients close their connection between two requests
+        for i in range(5):
+            self.assertEqual(self._request(['/a', '/b']), ['/a', '/b'])
+            # the proxy sees the client gone
+            gevent.sleep(0.05)
+        self.assertEqual(self.backend.connections, 1)
+
+    def test_error(self):
+        # the request peeked at by the protocol is answered at once
+        use_behavior(self.proxy, 'error')
+        sock = create_connection(('localhost', self.proxy.server_port))
+        with gevent.Timeout(2):
+            sock.sendall('GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+            self.assertTrue(sock.recv(1024).startswith('HTTP/1.1 50'))
+        sock.close()
+        self.assertEqual(self.backend.hosts, [])
+
+    def test_overwrite_host_header(self):
+        self.proxy.stop()
+        self.proxy = start_inprocess_proxy(
+            self.backend.server_port, protocol='http',
+            options=['--protocol-http-overwrite-host-header'])
+        self.assertEqual(self._request(['/a', '/b']), ['/a', '/b'])
+        self.assertEqual(self.backend.hosts,
+                         ['localhost:%d' % self.backend.server_port] * 2)
+
+    def test_parser_metric(self):
+        parser = self.proxy.handler.parser
+        self.assertEqual(parser, HEAD_PARSERS[0][0])
+        self.assertEqual(self.proxy.get_stats()['http.parser.' + parser], 1)
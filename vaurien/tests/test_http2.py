@@ -0,0 +1,193 @@
+import unittest
+
+import gevent
+from gevent.server import StreamServer
+from gevent.socket import create_connection
+
+from vaurien import _hpack
+from vaurien.protocols.http2 import (Http2, FrameParser, frame, _unpack,
+                                     PREFACE, HEADER_SIZE, DATA, HEADERS,
+                                     RST_STREAM, SETTINGS, END_STREAM,
+                                     END_HEADERS, ERRORS)
+from vaurien.tests.support import (start_inprocess_proxy, use_behavior,
+                                   _recv_exactly)
+from vaurien.tests.test_redis import _split
+
+
+def _read_frame(sock):
+    # the (type, flags, stream, payload) of the next frame of *sock*
+    header = _recv_exactly(sock, HEADER_SIZE)
+    if header is None:
+        return None
+    length, type_, flags, stream = _unpack(header)
+    return type_, flags, stream, _recv_exactly(sock, length)
+
+
+def _request(stream, path):
+    return frame(HEADERS, END_STREAM | END_HEADERS, stream,
+                 _hpack.encode([(':method', 'GET'), (':scheme', 'http'),
+                                (':path', path),
+                                (':authority', 'localhost')]))
+
+
+class Http2Server(StreamServer):
+    """Answers every request with its path, and keeps the paths."""
+
+    def __init__(self, address=('localhost', 0)):
+        StreamServer.__init__(self, address, self._serve)
+        self.paths = []
+
+    def _serve(self, sock, address):
+        try:
+            if _recv_exactly(sock, len(PREFACE)) != PREFACE:
+                return
+            sock.sendall(frame(SETTINGS, 0, 0))
+            decoder = _hpack.Decoder()
+            while True:
+                received = _read_frame(sock)
+                if received is None:
+                    return
+                type_, flags, stream, payload = received
+                if type_ == HEADERS:
+                    path = dict(decoder.decode(payload))[':path']
+                    self.paths.append(path)
+                    sock.sendall(frame(HEADERS, END_HEADERS, stream,
+                                       _hpack.encode([(':status', '200')])) +
+                                 frame(DATA, END_STREAM, stream, path))
+        finally:
+            sock.close()
+
+
+class TestHpack(unittest.TestCase):
+
+    def test_decode(self):
+        # RFC 7541, C.4
+        decoder = _hpack.Decoder()
+        self.assertEqual(
+            decoder.decode('828684418cf1e3c2e5f23a6ba0ab90f4ff'
+                           .decode('hex')),
+            [(':method', 'GET'), (':scheme', 'http'), (':path', '/'),
+             (':authority', 'www.example.com')])
+        self.assertEqual(
+            decoder.decode('828684be5886a8eb10649cbf'.decode('hex')),
+            [(':method', 'GET'), (':scheme', 'http'), (':path', '/'),
+             (':authority', 'www.example.com'),
+             ('cache-control', 'no-cache')])
+        self.assertEqual(
+            decoder.decode('828785bf408825a849e95ba97d7f8925a849e95bb8e8b4bf'
+                           .decode('hex')),
+            [(':method', 'GET'), (':scheme', 'https'),
+             (':path', '/index.html'), (':authority', 'www.example.com'),
+             ('custom-key', 'custom-value')])
+        self.assertEqual(decoder.size, 164)
+
+    def test_invalid(self):
+        decoder = _hpack.Decoder()
+        self.assertRaises(ValueError, decoder.decode, '\xff')
+        self.assertRaises(ValueError, decoder.decode, '\x04\x06/inde')
+        self.assertRaises(ValueError, _hpack.huffman_decode, '\x00')
+
+    def test_encode(self):
+        headers = [(':status', '200'), (':status', '599'),
+                   ('x-long', 'x' * 1000)]
+        decoder = _hpack.Decoder()
+        self.assertEqual(decoder.decode(_hpack.encode(headers, [0, 4096])),
+                         headers)
+        self.assertEqual(decoder.updates, [0, 4096])
+        # nothing was added to the table
+        self.assertEqual(decoder.size, 0)
+
+
+class TestFrameParser(unittest.TestCase):
+
+    def test_frames(self):
+        frames = [PREFACE, frame(SETTINGS, 0, 0, '\x00' * 6),
+                  _request(1, '/'), frame(DATA, END_STREAM, 1, 'x' * 70000)]
+        data = ''.join(frames)
+        for chunk in (1, 5, 9, 8192, len(data)):
+            parser = FrameParser(requests=True)
+            self.assertEqual(_split(parser, data, chunk), frames)
+            self.assertTrue(parser.at_boundary())
+            self.assertEqual((parser.type, parser.flags, parser.stream,
+                              parser.length), (DATA, END_STREAM, 1, 70000))
+
+    def test_invalid(self):
+        parser = FrameParser(requests=True)
+        self.assertRaises(ValueError, parser.feed,
+                          bytearray('GET / HTTP/1.1\r\n'), 0, 16)
+
+    def test_options(self):
+        protocol = Http2()
+        self.assertRaises(ValueError, protocol.update_settings,
+                          {'frames': 'HEADERS,What'})
+        self.assertRaises(ValueError, protocol.update_settings,
+                          {'reset_code': 'What'})
+        self.assertEqual(protocol.option('frames'), 'HEADERS')
+
+
+class TestHttp2Proxy(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = Http2Server()
+        self.backend.start()
+        self.proxy = start_inprocess_proxy(self.backend.server_port,
+                                           protocol='http2')
+
+    def tearDown(self):
+        self.proxy.stop()
+        self.backend.stop()
+
+    def _get(self, *paths):
+        # requests *paths* on streams 1, 3... and returns the (stream,
+        # status, body) of the responses as they end, the error code of
+        # the streams reset instead of their body
+        sock = create_connection(('localhost', self.proxy.server_port))
+        responses = []
+        with gevent.Timeout(5):
+            sock.sendall(PREFACE + frame(SETTINGS, 0, 0) +
+                         ''.join(_request(index * 2 + 1, path)
+                                 for index, path in enumerate(paths)))
+            self.assertEqual(_read_frame(sock)[0], SETTINGS)
+            decoder = _hpack.Decoder()
+            statuses = {}
+            while len(responses) < len(paths):
+                type_, flags, stream, payload = _read_frame(sock)
+                if type_ == HEADERS:
+                    statuses[stream] = dict(decoder.decode(payload))[
+                        ':status']
+                    body = ''
+                elif type_ == DATA:
+                    body = payload
+                elif type_ == RST_STREAM:
+                    if stream not in statuses:
+                        responses.append((stream, None, payload))
+                    continue
+                if flags & END_STREAM:
+                    responses.append((stream, statuses.get(stream), body))
+        sock.close()
+        return responses
+
+    def test_streams(self):
+        self.assertEqual(self._get('/a', '/b'),
+                         [(1, '200', '/a'), (3, '200', '/b')])
+
+    def test_error(self):
+        use_behavior(self.proxy, 'error', messages='/fail')
+        responses = self._get('/fail', '/ok')
+        self.assertEqual(sorted(responses),
+                         [(1, '503', ''), (3, '200', '/ok')])
+        self.assertEqual(self.backend.paths, ['/ok'])
+
+    def test_abort(self):
+        use_behavior(self.proxy, 'abort', messages='/a')
+        cancel = '\x00\x00\x00%s' % chr(ERRORS['CANCEL'])
+        self.assertEqual(sorted(self._get('/a', '/b')),
+                         [(1, None, cancel), (3, '200', '/b')])
+        self.assertEqual(self.backend.paths, ['/b'])
+
+    def test_delay(self):
+        use_behavior(self.proxy, 'delay', sleep=0.2, messages='/slow')
+        # the other stream isn't held back
+        self.assertEqual(self._get('/slow', '/fast'),
+                         [(3, '200', '/fast'), (1, '200', '/slow')])
+        self.assertEqual(self.backend.paths, ['/slow', '/fast'])
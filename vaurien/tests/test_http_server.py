@@ -57,14 +57,32 @@ class TestHTTPServer(TestCase):
         self.assertEquals(self.proxy.behavior, behavior_name)
         self.assertEquals(self.proxy.behavior_options, behavior_options)
 
+    def test_weights(self):
+        res = self.client.put_json('/weights',
+                                   {'behavior': '10:blackout,90:default'})
+        self.assertEquals(res.json, {'status': 'ok'})
+        res = self.client.get('/weights')
+        self.assertEquals(res.json, {'weights': {'blackout': 10.,
+                                                 'default': 90.}})
+
+        res = self.client.put_json('/weights', {'behavior': '10:unknown'},
+                                   status=400)
+        self.assertEquals(res.json['errors'][0]['name'], 'behavior')
+        self.client.put_json('/weights', {}, status=400)
+
     def test_get_backend_name(self):
         # it is possible to get the configured backend
         res = self.client.get('/backend')
-        self.assertEquals(res.json, {'backend':  self.proxy.backend})
+        self.assertEquals(res.json, self.proxy.get_backend_status())
+        self.assertEquals(res.json['backend'], self.proxy.backend)
 
     def test_set_backend_name(self):
         # it is possible to reconfigure the backend
         new_backend = 'example.com:80'
         self.client.put_json('/backend', {'backend': new_backend})
         res = self.client.get('/backend')
-        self.assertEquals(res.json, {'backend':  new_backend})
+        self.assertEquals(res.json['backend'], new_backend)
+
+    def test_get_stats(self):
+        res = self.client.get('/stats')
+        self.assertEquals(res.json, {'stats': self.proxy.get_stats()})
@@ -0,0 +1,224 @@
+import random
+import unittest
+
+import gevent
+from gevent import socket
+from gevent.server import StreamServer
+from gevent.socket import create_connection
+
+from vaurien.protocols.memcache import Memcache, MemcacheParser
+from vaurien.tests.support import start_inprocess_proxy
+from vaurien.tests.test_redis import _split
+
+
+REQUESTS = [
+    'get foo\r\n',
+    'gets foo bar baz\r\n',
+    'get %s\r\n' % ' '.join('key%d' % i for i in range(1000)),
+    'set foo 0 0 3\r\nbar\r\n',
+    'set foo 0 0 3 noreply\r\nbar\r\n',
+    'cas foo 0 0 5 12345\r\nhe\r\nl\r\n',
+    'append foo 0 0 0\r\n\r\n',
+    'incr counter 10\r\n',
+    'decr counter 1 noreply\r\n',
+    'delete foo\r\n',
+    'touch foo 10\r\n',
+    'stats\r\n',
+    'mg foo v t\r\n',
+    'ms foo 4 T0\r\ndata\r\n',
+    'ms foo S4 q\r\ndata\r\n',
+    'md foo q\r\n',
+    'mn\r\n',
+    'set big 0 0 100000\r\n%s\r\n' % ('x' * 100000),
+]
+
+RESPONSES = [
+    'END\r\n',
+    'VALUE foo 0 3\r\nbar\r\nEND\r\n',
+    'VALUE foo 0 3 1\r\nbar\r\nVALUE baz 5 4 2\r\nEND\r\r\nEND\r\n',
+    'STORED\r\n',
+    'NOT_STORED\r\n',
+    'EXISTS\r\n',
+    'NOT_FOUND\r\n',
+    '11\r\n',
+    'DELETED\r\n',
+    'TOUCHED\r\n',
+    'STAT pid 1\r\nSTAT uptime 2\r\nEND\r\n',
+    'VALUE foo 0 3\r\nbar\r\nSERVER_ERROR out of memory\r\n',
+    'CLIENT_ERROR bad data chunk\r\n',
+    'VA 3 t-1\r\nbar\r\n',
+    'VA 0\r\n\r\n',
+    'HD\r\n',
+    'EN\r\n',
+    'MN\r\n',
+    'VALUE big 0 100000\r\n%s\r\nEND\r\n' % ('x' * 100000),
+]
+
+
+class TestMemcacheParser(unittest.TestCase):
+
+    def test_requests(self):
+        data = ''.join(REQUESTS)
+        for chunk in (1, 2, 3, 7, 64, 8192, len(data)):
+            parser = MemcacheParser(requests=True)
+            self.assertEqual(_split(parser, data, chunk), REQUESTS)
+            self.assertTrue(parser.at_boundary())
+
+    def test_responses(self):
+        data = ''.join(RESPONSES)
+        for chunk in (1, 2, 3, 7, 64, 8192, len(data)):
+            parser = MemcacheParser()
+            self.assertEqual(_split(parser, data, chunk), RESPONSES)
+            self.assertTrue(parser.at_boundary())
+
+    def test_reply(self):
+        parser = MemcacheParser(requests=True)
+        replies = []
+        for request in REQUESTS:
+            _split(parser, request, 5)
+            replies.append(parser.reply)
+        self.assertEqual([request for request, reply in zip(REQUESTS,
+                                                            replies)
+                          if not reply],
+                         [REQUESTS[4], REQUESTS[8], REQUESTS[14],
+                          REQUESTS[15]])
+
+    def test_quiet(self):
+        parser = MemcacheParser(requests=True)
+        quiet = []
+        for request in REQUESTS:
+            _split(parser, request, 5)
+            quiet.append(parser.quiet)
+        self.assertEqual([request for request, flag in zip(REQUESTS, quiet)
+                          if flag], [REQUESTS[14], REQUESTS[15]])
+
+    def test_long_line(self):
+        # only the beginning of a long line is kept
+        parser = MemcacheParser(requests=True)
+        request = REQUESTS[2]
+        for pos in range(len(request) - 1):
+            self.assertEqual(parser.feed(bytearray(request[pos]), 0, 1), -1)
+        self.assertTrue(len(parser._line) <= 2048)
+        self.assertEqual(parser.feed(bytearray('\n'), 0, 1), 1)
+        self.assertEqual(parser.command, 'get')
+
+    def test_invalid(self):
+        parser = MemcacheParser(requests=True)
+        self.assertRaises(ValueError, parser.feed,
+                          bytearray('set foo 0 0 x\r\n'), 0, 15)
+        parser = MemcacheParser()
+        self.assertRaises(ValueError, parser.feed, bytearray('\r\n'), 0, 2)
+
+
+class TestMemcache(unittest.TestCase):
+
+    def setUp(self):
+        self.protocol = Memcache()
+        self.client, self.client_end = socket.socketpair()
+        self.backend, self.backend_end = socket.socketpair()
+
+    def tearDown(self):
+        for sock in (self.client, self.client_end, self.backend,
+                     self.backend_end):
+            sock.close()
+
+    def _send(self, requests, replies):
+        # forwards the *requests*, then the *replies*, one at a time
+        for request in requests:
+            self.client_end.sendall(request)
+            self.protocol._handle(self.client, self.backend, True,
+                                  lambda: True)
+        for reply in replies:
+            self.backend_end.sendall(reply)
+            self.protocol._handle(self.backend, self.client, False,
+                                  lambda: True)
+        return [name for name, quiet
+                in self.protocol.get_pending_commands(self.backend)]
+
+    def test_quiet_replies(self):
+        # the hit of a quiet mg isn't the reply of the get
+        self.assertEqual(self._send(['mg a v q\r\n', 'get b\r\n'],
+                                    ['VA 1\r\na\r\n']), ['get'])
+        self.assertFalse(self.protocol.is_idle(self.backend))
+        self.assertEqual(self._send([], ['END\r\n']), [])
+        self.assertTrue(self.protocol.is_idle(self.backend))
+
+        # the misses get no reply, the ones of later commands end them
+        self.assertEqual(self._send(['mg a v q\r\n', 'ms b S1 q\r\n1\r\n',
+                                     'get c\r\n'], ['END\r\n']), [])
+        self.assertEqual(self._send(['mg a v q\r\n', 'mg b v\r\n',
+                                     'mn\r\n'],
+                                    ['VA 1\r\nb\r\n', 'MN\r\n']), [])
+
+
+def _memcached(sock, address):
+    # answers every get with one value per key, without waiting for the
+    # next command, so pipelined commands pile up.
+    parser = MemcacheParser(requests=True)
+    buffer = bytearray(4096)
+    line = ''
+    try:
+        while True:
+            size = sock.recv_into(buffer)
+            if not size:
+                break
+            start = 0
+            while start < size:
+                end = parser.feed(buffer, start, size)
+                if end == -1:
+                    line += str(buffer[start:size])
+                    break
+                line += str(buffer[start:end])
+                start = end
+                if parser.command == 'set':
+                    if parser.reply:
+                        sock.sendall('STORED\r\n')
+                else:
+                    sock.sendall(''.join('VALUE %s 0 %d\r\n%s\r\n'
+                                         % (key, len(key), key)
+                                         for key in line.split()[1:]) +
+                                 'END\r\n')
+                line = ''
+    finally:
+        sock.close()
+
+
+class TestMemcacheProxy(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = StreamServer(('localhost', 0), _memcached)
+        self.backend.start()
+        self.proxy = start_inprocess_proxy(self.backend.server_port,
+                                           protocol='memcache')
+
+    def tearDown(self):
+        self.proxy.stop()
+        self.backend.stop()
+
+    def test_pipelining(self):
+        sock = create_connection(('localhost', self.proxy.server_port))
+        data = []
+        expected = []
+        for i in range(200):
+            keys = ['key%d.%d' % (i, j) for j in range(i % 5 + 1)]
+            data.append('get %s\r\n' % ' '.join(keys))
+            expected.append(''.join('VALUE %s 0 %d\r\n%s\r\n'
+                                    % (key, len(key), key) for key in keys))
+            expected.append('END\r\n')
+            data.append('set key%d 0 0 5 noreply\r\nvalue\r\n' % i)
+        data = ''.join(data)
+        expected = ''.join(expected)
+
+        # sent in random pieces
+        pos = 0
+        while pos < len(data):
+            size = random.randint(1, 50)
+            sock.sendall(data[pos:pos + size])
+            pos += size
+
+        received = ''
+        with gevent.Timeout(5):
+            while len(received) < len(expected):
+                received += sock.recv(65536)
+        sock.close()
+        self.assertEqual(received, expected)
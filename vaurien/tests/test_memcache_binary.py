@@ -0,0 +1,188 @@
+import unittest
+
+import gevent
+from gevent.socket import create_connection, socketpair
+
+from vaurien.behaviors.dummy import Dummy
+from vaurien.protocols.memcache_binary import (BinaryParser, MemcacheBinary,
+                                               HEADER, OPCODE_NAMES,
+                                               REQUEST_MAGIC, RESPONSE_MAGIC,
+                                               parse_opcodes)
+from vaurien.tests.support import (MemcacheBinaryServer,
+                                   start_inprocess_proxy, use_behavior,
+                                   _recv_exactly)
+from vaurien.tests.test_redis import _split
+
+
+def _request(name, key='', extras='', value='', opaque=0):
+    body = extras + key + value
+    return HEADER.pack(REQUEST_MAGIC, OPCODE_NAMES[name], len(key),
+                       len(extras), 0, 0, len(body), opaque, 0) + body
+
+
+def _response(name, key='', value=''):
+    body = key + value
+    return HEADER.pack(RESPONSE_MAGIC, OPCODE_NAMES[name], len(key), 0, 0,
+                       0, len(body), 0, 0) + body
+
+
+def _read_response(sock):
+    header = _recv_exactly(sock, HEADER.size)
+    (magic, opcode, key_length, extras_length, data_type, status,
+     body_length, opaque, cas) = HEADER.unpack(header)
+    body = _recv_exactly(sock, body_length)
+    key = body[extras_length:extras_length + key_length]
+    return opcode, status, key, body[extras_length + key_length:], opaque
+
+
+REQUESTS = [
+    _request('get', 'foo'),
+    _request('set', 'foo', '\x00' * 8, 'bar'),
+    _request('getkq', 'foo', opaque=7),
+    _request('noop'),
+    _request('set', 'big', '\x00' * 8, 'x' * 100000),
+]
+
+
+class TestBinaryParser(unittest.TestCase):
+
+    def test_packets(self):
+        data = ''.join(REQUESTS)
+        for chunk in (1, 2, 3, 7, 23, 24, 25, 8192, len(data)):
+            parser = BinaryParser(requests=True)
+            self.assertEqual(_split(parser, data, chunk), REQUESTS)
+            self.assertTrue(parser.at_boundary())
+            self.assertEqual(parser.opcode, OPCODE_NAMES['set'])
+
+    def test_invalid(self):
+        parser = BinaryParser()
+        self.assertRaises(ValueError, parser.feed, bytearray(REQUESTS[0]),
+                          0, len(REQUESTS[0]))
+
+    def test_parse_opcodes(self):
+        self.assertEqual(parse_opcodes(''), None)
+        self.assertEqual(parse_opcodes('getq, GetKQ,0x0a'),
+                         set([0x09, 0x0d, 0x0a]))
+        self.assertRaises(ValueError, parse_opcodes, 'getx')
+
+
+class _Recorder(Dummy):
+    name = 'recorder'
+
+    def __init__(self):
+        super(_Recorder, self).__init__()
+        self.opcodes = []
+
+    def on_before_handle(self, protocol, source, dest, to_backend):
+        self.opcodes.append(protocol.get_opcode(source))
+        return True
+
+
+class TestMemcacheBinary(unittest.TestCase):
+
+    def test_opcodes_option(self):
+        protocol = MemcacheBinary(settings={'opcodes': 'getq'})
+        self.assertRaises(ValueError, protocol.update_settings,
+                          {'opcodes': 'what'})
+        self.assertEqual(protocol.option('opcodes'), 'getq')
+
+        client, source = socketpair()
+        dest, backend = socketpair()
+        behavior = _Recorder()
+        client.sendall(_request('get', 'foo') + _request('getq', 'foo'))
+        for _ in range(2):
+            self.assertTrue(protocol(source, dest, True, behavior))
+        self.assertEqual(behavior.opcodes, ['getq'])
+        self.assertEqual(len(_recv_exactly(backend, 54)), 54)
+        self.assertEqual(protocol.get_expected_replies(dest), 1)
+        for sock in (client, source, dest, backend):
+            sock.close()
+
+    def test_quiet_replies(self):
+        # the hits of quiet gets don't count as the reply of the noop
+        protocol = MemcacheBinary()
+        behavior = Dummy()
+        client, source = socketpair()
+        dest, backend = socketpair()
+        client.sendall(_request('getkq', 'a') + _request('getkq', 'b') +
+                       _request('noop'))
+        for _ in range(3):
+            self.assertTrue(protocol(source, dest, True, behavior))
+        self.assertEqual(protocol.get_expected_replies(dest), 1)
+
+        for name, key in (('getkq', 'a'), ('getkq', 'b'), ('noop', '')):
+            backend.sendall(_response(name, key))
+            self.assertFalse(protocol.is_idle(dest))
+            self.assertTrue(protocol(dest, source, False, behavior))
+        self.assertTrue(protocol.is_idle(dest))
+        for sock in (client, source, dest, backend):
+            sock.close()
+
+    def test_describe(self):
+        protocol = MemcacheBinary()
+        client, source = socketpair()
+        dest, backend = socketpair()
+        request = REQUESTS[-1]
+        client.sendall(request)
+        message = protocol.describe(source, dest, True)
+        self.assertEqual((message.name, message.size, message.to_backend),
+                         ('set', len(request), True))
+
+        # the behaviors apply to the messages they pick
+        behavior = _Recorder()
+        behavior.update_settings({'messages': 'get'})
+        self.assertTrue(protocol(source, dest, True, behavior))
+        client.sendall(REQUESTS[0])
+        self.assertTrue(protocol(source, dest, True, behavior))
+        self.assertEqual(behavior.opcodes, ['get'])
+        self.assertEqual(len(_recv_exactly(backend, len(request) + 27)),
+                         len(request) + 27)
+        for sock in (client, source, dest, backend):
+            sock.close()
+
+
+class TestMemcacheBinaryProxy(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = MemcacheBinaryServer()
+        self.backend.start()
+        self.proxy = start_inprocess_proxy(self.backend.server_port,
+                                           protocol='memcache_binary')
+
+    def tearDown(self):
+        self.proxy.stop()
+        self.backend.stop()
+
+    def test_error(self):
+        # the reply peeked at to read its opcode is replaced at once
+        use_behavior(self.proxy, 'error', messages='noop')
+        sock = create_connection(('localhost', self.proxy.server_port))
+        with gevent.Timeout(2):
+            sock.sendall(_request('noop'))
+            received = ''
+            while len(received) < 1000:
+                received += sock.recv(65536)
+        sock.close()
+        self.assertEqual(self.backend.opcodes, [OPCODE_NAMES['noop']])
+
+    def test_quiet_batch(self):
+        sock = create_connection(('localhost', self.proxy.server_port))
+        flags = '\x00\x00\x00\x01'
+        batch = [_request('setq', 'key%d' % i, flags + '\x00' * 4,
+                          'value%d' % i) for i in range(0, 100, 2)]
+        batch += [_request('getkq', 'key%d' % i, opaque=i)
+                  for i in range(100)]
+        batch.append(_request('noop', opaque=1000))
+        sock.sendall(''.join(batch))
+
+        with gevent.Timeout(5):
+            responses = [_read_response(sock) for _ in range(51)]
+        sock.close()
+
+        # only the hits and the noop are answered
+        self.assertEqual(responses[-1][0], OPCODE_NAMES['noop'])
+        self.assertEqual([(key, value, opaque)
+                          for opcode, status, key, value, opaque
+                          in responses[:-1]],
+                         [('key%d' % i, 'value%d' % i, i)
+                          for i in range(0, 100, 2)])
@@ -0,0 +1,48 @@
+import unittest
+
+from vaurien.metrics import Metrics, StatsdFlusher
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_collect(self):
+        metrics = Metrics()
+        metrics.incr('tcp.start')
+        metrics.incr('tcp.start')
+        metrics.gauge('tcp.active', 2)
+        metrics.observe('tcp.duration', 10)
+        metrics.observe('tcp.duration', 30)
+
+        lines = sorted(metrics.collect())
+        self.assertEqual(lines, ['tcp.active:2|g',
+                                 'tcp.duration.count:2|c',
+                                 'tcp.duration.max:30.000|g',
+                                 'tcp.duration.mean:20.000|g',
+                                 'tcp.duration.min:10.000|g',
+                                 'tcp.start:2|c'])
+
+        # only what changed since the previous flush is sent
+        metrics.incr('tcp.start')
+        self.assertEqual(sorted(metrics.collect()),
+                         ['tcp.active:2|g', 'tcp.start:1|c'])
+
+        # the totals are kept
+        stats = metrics.get_stats()
+        self.assertEqual(stats['tcp.start'], 3)
+        self.assertEqual(stats['tcp.duration.count'], 2)
+        self.assertEqual(stats['tcp.duration.sum'], 40)
+
+    def test_packets(self):
+        metrics = Metrics()
+        for i in range(100):
+            metrics.incr('tcp.behavior%d.to_backend' % i)
+
+        flusher = StatsdFlusher(metrics, packet_size=512)
+        packets = flusher.get_packets()
+        self.assertTrue(1 < len(packets) < 100)
+        lines = []
+        for packet in packets:
+            self.assertTrue(len(packet) <= 512)
+            lines.extend(packet.split('\n'))
+        self.assertEqual(len(lines), 100)
+        self.assertTrue(lines[0].startswith('vaurien.tcp.behavior'))
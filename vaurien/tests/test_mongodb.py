@@ -0,0 +1,246 @@
+import struct
+import time
+import unittest
+
+import gevent
+from gevent.server import StreamServer
+from gevent.socket import create_connection
+
+from vaurien.behaviors.dummy import Dummy
+from vaurien.protocols.mongodb import (MessageParser, Session, HEADER,
+                                       HEADER_SIZE, OP_MSG, OP_QUERY,
+                                       OP_INSERT, OP_COMPRESSED, OP_REPLY,
+                                       MORE_TO_COME, QUERY_FAILURE,
+                                       command_name, parse_commands,
+                                       error_reply, _bson)
+from vaurien.tests.support import (start_inprocess_proxy, use_behavior,
+                                   _recv_exactly)
+from vaurien.tests.test_redis import _split
+
+
+def _message(request_id, opcode, payload, response_to=0):
+    return HEADER.pack(HEADER_SIZE + len(payload), request_id, response_to,
+                       opcode) + payload
+
+
+def _op_msg(request_id, command, flags=0, response_to=0, sequence=None):
+    # an OP_MSG of the *command* elements, after a document sequence
+    payload = struct.pack('<I', flags)
+    if sequence is not None:
+        section = 'documents\x00' + sequence
+        payload += '\x01' + struct.pack('<i', len(section) + 4) + section
+    payload += '\x00' + _bson(command)
+    return _message(request_id, OP_MSG, payload, response_to)
+
+
+def _read_message(sock):
+    # the (request_id, response_to, opcode, payload) of the next message
+    header = _recv_exactly(sock, HEADER_SIZE)
+    if header is None:
+        return None
+    length, request_id, response_to, opcode = HEADER.unpack(header)
+    return (request_id, response_to, opcode,
+            _recv_exactly(sock, length - HEADER_SIZE))
+
+
+class MongoServer(StreamServer):
+    """Answers every OP_MSG with an *ok* reply, and keeps the names of
+    their commands."""
+
+    def __init__(self, address=('localhost', 0)):
+        StreamServer.__init__(self, address, self._serve)
+        self.commands = []
+
+    def _serve(self, sock, address):
+        try:
+            while True:
+                received = _read_message(sock)
+                if received is None:
+                    return
+                request_id, response_to, opcode, payload = received
+                data = HEADER.pack(HEADER_SIZE + len(payload), request_id,
+                                   0, opcode) + payload
+                self.commands.append(command_name(bytearray(data)))
+                sock.sendall(_op_msg(request_id + 1000, [('ok', 1.)],
+                                     response_to=request_id))
+        finally:
+            sock.close()
+
+
+FIND = [('find', 'users'), ('$db', 'test')]
+INSERT = [('insert', 'users'), ('$db', 'test')]
+
+
+class TestMessageParser(unittest.TestCase):
+
+    def test_messages(self):
+        messages = [_op_msg(1, FIND), _op_msg(2, INSERT, sequence='x' * 70000),
+                    _message(3, OP_INSERT, '\x00' * 4)]
+        data = ''.join(messages)
+        for chunk in (1, 5, 16, 8192, len(data)):
+            parser = MessageParser(requests=True)
+            self.assertEqual(_split(parser, data, chunk), messages)
+            self.assertTrue(parser.at_boundary())
+            self.assertEqual((parser.request_id, parser.opcode),
+                             (3, OP_INSERT))
+            # the legacy writes get no reply
+            self.assertFalse(parser.answered)
+
+    def test_flags(self):
+        parser = MessageParser(requests=True)
+        for flags, answered in ((0, True), (MORE_TO_COME, False)):
+            data = bytearray(_op_msg(1, INSERT, flags))
+            parser.feed(data, 0, len(data))
+            self.assertEqual(parser.flags, flags)
+            self.assertEqual(parser.answered, answered)
+
+    def test_invalid(self):
+        parser = MessageParser(requests=True)
+        self.assertRaises(ValueError, parser.feed,
+                          bytearray('GET / HTTP/1.1\r\n'), 0, 16)
+
+
+class TestCommands(unittest.TestCase):
+
+    def test_names(self):
+        for data, name in (
+                (_op_msg(1, FIND), 'find'),
+                (_op_msg(1, INSERT, sequence='x' * 100), 'insert'),
+                (_op_msg(1, []), None),
+                (_message(1, OP_QUERY, '\x00' * 4 + 'admin.$cmd\x00' +
+                          '\x00' * 8 + _bson([('isMaster', 1)])),
+                 'isMaster'),
+                (_message(1, OP_QUERY, '\x00' * 4 + 'test.users\x00' +
+                          '\x00' * 8 + _bson([('name', 'x')])), 'query'),
+                (_message(1, OP_INSERT, '\x00' * 4), 'insert'),
+                (_message(1, OP_COMPRESSED, struct.pack('<ii', OP_MSG, 0)),
+                 None)):
+            self.assertEqual(command_name(bytearray(data)), name)
+        # the name isn't within the data
+        self.assertEqual(command_name(bytearray(_op_msg(1, FIND)), 25), None)
+
+    def test_parse(self):
+        self.assertEqual(parse_commands(' Find, insert,'),
+                         frozenset(['find', 'insert']))
+        self.assertEqual(parse_commands(''), None)
+
+    def test_exhaust(self):
+        # the replies of an exhaust cursor answer each other
+        session = Session()
+        parser = MessageParser(requests=True)
+        data = bytearray(_op_msg(1, FIND))
+        parser.feed(data, 0, len(data))
+        session.on_request(parser, 'find')
+        parser = MessageParser()
+        for request_id, response_to, flags in ((10, 1, MORE_TO_COME),
+                                               (11, 10, 0)):
+            self.assertFalse(session.idle)
+            self.assertEqual(session.pending, {response_to: 'find'})
+            data = bytearray(_op_msg(request_id, [('ok', 1.)], flags,
+                                     response_to))
+            parser.feed(data, 0, len(data))
+            session.on_reply(parser)
+        self.assertTrue(session.idle)
+
+    def test_error_reply(self):
+        request_id, response_to, opcode, payload = _read_message_from(
+            error_reply(7, OP_QUERY, 11600, 'down'))
+        self.assertEqual((response_to, opcode), (7, OP_REPLY))
+        self.assertEqual(struct.unpack_from('<i', payload)[0], QUERY_FAILURE)
+        request_id, response_to, opcode, payload = _read_message_from(
+            error_reply(7, OP_MSG, 11600, 'down'))
+        self.assertEqual((response_to, opcode), (7, OP_MSG))
+        self.assertEqual(payload[5:], _bson([('ok', 0.), ('errmsg', 'down'),
+                                             ('code', 11600)]))
+
+
+def _read_message_from(data):
+    length, request_id, response_to, opcode = HEADER.unpack_from(data)
+    assert length == len(data)
+    return request_id, response_to, opcode, data[HEADER_SIZE:]
+
+
+class _Recorder(Dummy):
+    name = 'recorder'
+
+    def __init__(self):
+        super(_Recorder, self).__init__()
+        self.calls = []
+
+    def on_message(self, protocol, message):
+        self.calls.append((message.name, message.to_backend))
+        return True
+
+
+class TestMongoDBProxy(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = MongoServer()
+        self.backend.start()
+        self.proxy = None
+
+    def tearDown(self):
+        if self.proxy is not None:
+            self.proxy.stop()
+        self.backend.stop()
+
+    def _start(self, *options):
+        self.proxy = start_inprocess_proxy(self.backend.server_port,
+                                           protocol='mongodb',
+                                           options=options)
+
+    def _run(self, *commands):
+        # sends the *commands* together, returns the (response_to, ok)
+        # of the replies
+        sock = create_connection(('localhost', self.proxy.server_port))
+        replies = []
+        with gevent.Timeout(5):
+            sock.sendall(''.join(_op_msg(index + 1, command)
+                                 for index, command in enumerate(commands)))
+            while len(replies) < len(commands):
+                request_id, response_to, opcode, payload = \
+                    _read_message(sock)
+                ok = struct.unpack_from('<d', payload, 9 + len('\x01ok\x00'))
+                replies.append((response_to, ok[0]))
+        sock.close()
+        return replies
+
+    def test_commands(self):
+        self._start()
+        self.assertEqual(self._run(FIND, INSERT), [(1, 1.), (2, 1.)])
+        self.assertEqual(self.backend.commands, ['find', 'insert'])
+
+    def test_describe(self):
+        self._start()
+        recorder = _Recorder()
+        self.proxy.behavior, self.proxy.behavior_name = recorder, 'recorder'
+        self._run(FIND)
+        # the reply is named after its command
+        self.assertEqual(recorder.calls, [('find', True), ('find', False)])
+
+    def test_error(self):
+        self._start('--protocol-mongodb-commands', 'insert')
+        use_behavior(self.proxy, 'error')
+        # the error doesn't wait for the server
+        self.assertEqual(sorted(self._run(FIND, INSERT, FIND)),
+                         [(1, 1.), (2, 0.), (3, 1.)])
+        self.assertEqual(self.backend.commands, ['find', 'find'])
+
+    def test_errors(self):
+        # every targeted command fails, not every other one
+        self._start('--protocol-mongodb-commands', 'insert')
+        use_behavior(self.proxy, 'error')
+        self.assertEqual(sorted(self._run(INSERT, INSERT, FIND, INSERT)),
+                         [(1, 0.), (2, 0.), (3, 1.), (4, 0.)])
+        self.assertEqual(self.backend.commands, ['find'])
+
+    def test_delay(self):
+        self._start()
+        use_behavior(self.proxy, 'delay', sleep=0.2, messages='find')
+        start = time.time()
+        self._run(INSERT)
+        self.assertTrue(time.time() - start < 0.2)
+        start = time.time()
+        self._run(FIND)
+        # the command and its reply
+        self.assertTrue(time.time() - start >= 0.4)
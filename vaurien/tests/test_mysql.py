@@ -0,0 +1,276 @@
+import struct
+import unittest
+
+import gevent
+from gevent.server import StreamServer
+from gevent.socket import create_connection
+
+from vaurien.behaviors.dummy import Dummy
+from vaurien.protocols.mysql import (MySql, PacketParser, Session,
+                                     parse_commands,
+                                     CLIENT_DEPRECATE_EOF, CLIENT_SSL,
+                                     SERVER_MORE_RESULTS_EXISTS, HANDSHAKE,
+                                     COMMAND, TUNNEL)
+from vaurien.tests.support import start_inprocess_proxy, _recv_exactly
+from vaurien.tests.test_redis import _split
+
+
+def _packet(seq, payload):
+    return struct.pack('<I', len(payload))[:3] + chr(seq) + payload
+
+
+def _greeting():
+    return _packet(0, '\x0a5.7.0\x00' + '\x01\x00\x00\x00' + 'x' * 8 +
+                   '\x00\xff\xf7\x21\x02\x00\xff\x81' + '\x00' * 11)
+
+
+def _handshake_response(capabilities=0):
+    return _packet(1, struct.pack('<I', capabilities | 0x200) + '\x00' * 28 +
+                   'root\x00')
+
+
+OK = '\x00\x00\x00\x02\x00\x00\x00'
+
+
+def _result_set(rows, deprecate_eof=False, status=2):
+    packets = ['\x01', '\x03def\x00\x00\x00\x01n\x00']
+    if not deprecate_eof:
+        packets.append('\xfe\x00\x00\x02\x00')
+    packets.extend('\x01%d' % (i % 10) for i in range(rows))
+    if deprecate_eof:
+        packets.append('\xfe\x00\x00' + struct.pack('<H', status) +
+                       '\x00\x00')
+    else:
+        packets.append('\xfe\x00\x00' + struct.pack('<H', status))
+    return ''.join(_packet(seq + 1, payload)
+                   for seq, payload in enumerate(packets))
+
+
+def _feed(session, parser, data, client):
+    # feeds *data* to *parser* and the packets found to *session*
+    buffer = bytearray(data)
+    start = 0
+    while start < len(buffer):
+        end = parser.feed(buffer, start, len(buffer))
+        if end == -1:
+            break
+        if client:
+            session.on_client_packet(parser)
+        else:
+            session.on_server_packet(parser)
+        start = end
+
+
+class TestPacketParser(unittest.TestCase):
+
+    def test_packets(self):
+        packets = [_greeting(), _packet(0, ''), _packet(3, 'x' * 100000),
+                   _result_set(3)]
+        data = ''.join(packets)
+        for chunk in (1, 3, 4, 5, 7, 8192, len(data)):
+            parser = PacketParser()
+            found = _split(parser, data, chunk)
+            self.assertEqual(''.join(found), data)
+            self.assertEqual(len(found), 3 + 7)
+            self.assertTrue(parser.at_boundary())
+
+    def test_continuation(self):
+        parser = PacketParser()
+        data = _packet(0, 'x' * 0xffffff) + _packet(1, 'y')
+        self.assertEqual(len(_split(parser, data, 1 << 20)), 2)
+        self.assertTrue(parser.continuation)
+        self.assertEqual(str(parser.payload), 'y')
+
+    def test_parse_commands(self):
+        self.assertEqual(parse_commands(''), None)
+        self.assertEqual(parse_commands('com_query, stmt_execute'),
+                         set(['COM_QUERY', 'COM_STMT_EXECUTE']))
+        self.assertRaises(ValueError, parse_commands, 'COM_WHAT')
+
+
+class _Sock(object):
+    pass
+
+
+class TestMySql(unittest.TestCase):
+
+    def test_may_idle(self):
+        protocol = MySql(settings={'idle_timeout': 3600})
+        sock = _Sock()
+        self.assertFalse(protocol.may_idle(sock, 10))
+        protocol.get_session(sock).phase = COMMAND
+        self.assertTrue(protocol.may_idle(sock, 10))
+        self.assertFalse(protocol.may_idle(sock, 3601))
+        self.assertRaises(ValueError, protocol.update_settings,
+                          {'query': '('})
+        self.assertEqual(protocol.option('query'), '')
+
+
+class TestSession(unittest.TestCase):
+
+    def _connect(self, capabilities=0):
+        session = Session()
+        client, server = PacketParser(True), PacketParser()
+        _feed(session, server, _greeting(), False)
+        _feed(session, client, _handshake_response(capabilities), True)
+        self.assertEqual(session.phase, HANDSHAKE)
+        _feed(session, server, _packet(2, OK), False)
+        self.assertEqual(session.phase, COMMAND)
+        self.assertTrue(session.idle)
+        return session, client, server
+
+    def _query(self, session, client, server, response, query='SELECT 1'):
+        _feed(session, client, _packet(0, '\x03' + query), True)
+        self.assertEqual(session.command, 'COM_QUERY')
+        self.assertEqual(session.query, query)
+        self.assertFalse(session.idle)
+        _feed(session, server, response, False)
+
+    def test_result_set(self):
+        for capabilities in (0, CLIENT_DEPRECATE_EOF):
+            session, client, server = self._connect(capabilities)
+            deprecate_eof = bool(capabilities)
+            self._query(session, client, server,
+                        _result_set(5, deprecate_eof))
+            self.assertEqual(session.rows, 5)
+            self.assertTrue(session.idle)
+
+            # several result sets
+            self._query(session, client, server,
+                        _result_set(2, deprecate_eof,
+                                    2 | SERVER_MORE_RESULTS_EXISTS))
+            self.assertFalse(session.idle)
+            _feed(session, server, _result_set(1, deprecate_eof), False)
+            self.assertTrue(session.idle)
+
+            self._query(session, client, server, _packet(1, OK))
+            self.assertTrue(session.idle)
+            self._query(session, client, server,
+                        _packet(1, '\xff\x00\x00#HY000oops'))
+            self.assertTrue(session.idle)
+
+    def test_prepare(self):
+        session, client, server = self._connect()
+        _feed(session, client, _packet(0, '\x16SELECT ?'), True)
+        _feed(session, server, _packet(1, '\x00\x01\x00\x00\x00\x01\x00'
+                                          '\x01\x00\x00\x00\x00'), False)
+        self.assertFalse(session.idle)
+        # a parameter and a column, each followed by an EOF
+        _feed(session, server, ''.join(_packet(i, '\x03def') for i in
+                                       range(2, 6)), False)
+        self.assertTrue(session.idle)
+
+        # no response to a statement close
+        _feed(session, client, _packet(0, '\x19\x01\x00\x00\x00'), True)
+        self.assertTrue(session.idle)
+
+    def test_ssl(self):
+        session = Session()
+        client, server = PacketParser(True), PacketParser()
+        _feed(session, server, _greeting(), False)
+        _feed(session, client,
+              _packet(1, struct.pack('<I', CLIENT_SSL) + '\x00' * 28), True)
+        self.assertEqual(session.phase, TUNNEL)
+
+
+def _mysql(sock, address):
+    # a server answering SELECT N with N rows
+    try:
+        sock.sendall(_greeting())
+        parser = PacketParser(requests=True)
+        buffer = bytearray(4096)
+        authenticated = False
+        while True:
+            size = sock.recv_into(buffer)
+            if not size:
+                break
+            start = 0
+            while start < size:
+                end = parser.feed(buffer, start, size)
+                if end == -1:
+                    break
+                start = end
+                if not authenticated:
+                    sock.sendall(_packet(2, OK))
+                    authenticated = True
+                elif parser.payload[0] == 0x03:
+                    rows = int(str(parser.payload).split()[-1])
+                    sock.sendall(_result_set(rows))
+                elif parser.payload[0] == 0x01:
+                    return
+                else:
+                    sock.sendall(_packet(1, OK))
+    finally:
+        sock.close()
+
+
+class _Recorder(Dummy):
+    name = 'recorder'
+
+    def __init__(self):
+        super(_Recorder, self).__init__()
+        self.calls = []
+
+    def on_before_handle(self, protocol, source, dest, to_backend):
+        session = protocol.get_session(to_backend and dest or source)
+        self.calls.append((to_backend, session.query, session.rows))
+        return True
+
+
+class TestMySqlProxy(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = StreamServer(('localhost', 0), _mysql)
+        self.backend.start()
+        self.proxy = None
+
+    def tearDown(self):
+        if self.proxy is not None:
+            self.proxy.stop()
+        self.backend.stop()
+
+    def _run(self, options, queries):
+        self.proxy = start_inprocess_proxy(self.backend.server_port,
+                                           protocol='mysql', options=options)
+        recorder = _Recorder()
+        self.proxy.behavior = recorder
+        self.proxy.behavior_name = 'recorder'
+
+        sock = create_connection(('localhost', self.proxy.server_port))
+        with gevent.Timeout(5):
+            self.assertEqual(_recv_exactly(sock, len(_greeting())),
+                             _greeting())
+            sock.sendall(_handshake_response())
+            self.assertEqual(_recv_exactly(sock, 11), _packet(2, OK))
+            for query in queries:
+                sock.sendall(_packet(0, '\x03' + query))
+                expected = _result_set(int(query.split()[-1]))
+                self.assertEqual(_recv_exactly(sock, len(expected)),
+                                 expected)
+            sock.sendall(_packet(0, '\x01'))
+            self.assertEqual(sock.recv(10), '')
+        sock.close()
+        return recorder.calls
+
+    def test_commands(self):
+        calls = self._run([], ['SELECT 3', 'SELECT 10'])
+        # the commands, and the first packet of their responses. The
+        # session is recorded before the command packets are read.
+        self.assertEqual(calls, [(True, None, 0), (False, 'SELECT 3', 0),
+                                 (True, 'SELECT 3', 3),
+                                 (False, 'SELECT 10', 0),
+                                 (True, 'SELECT 10', 10)])
+
+    def test_min_rows(self):
+        calls = self._run(['--protocol-mysql-min-rows', '5'],
+                          ['SELECT 3', 'SELECT 10', 'SELECT 6'])
+        self.assertEqual(calls, [(False, 'SELECT 10', 5),
+                                 (False, 'SELECT 6', 5)])
+
+    def test_query(self):
+        calls = self._run(['--protocol-mysql-query', 'select 1'],
+                          ['SELECT 3', 'SELECT 10', 'SELECT 1'])
+        self.assertEqual(calls, [(True, 'SELECT 3', 3),
+                                 (False, 'SELECT 10', 0),
+                                 (True, 'SELECT 10', 10),
+                                 (False, 'SELECT 1', 0)])
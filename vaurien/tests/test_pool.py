@@ -0,0 +1,109 @@
+import unittest
+
+from vaurien.metrics import Metrics
+from vaurien._pool import FactoryPool
+
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.alive = True
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class TestFactoryPool(unittest.TestCase):
+
+    def setUp(self):
+        self.created = []
+        self.metrics = Metrics()
+
+    def _create(self):
+        conn = FakeConnection()
+        self.created.append(conn)
+        return conn
+
+    def _get_pool(self, **kw):
+        return FactoryPool(self._create, maxsize=5, timeout=60,
+                           check=lambda conn: conn.alive,
+                           metrics=self.metrics, **kw)
+
+    def test_prewarm(self):
+        pool = self._get_pool(min_size=3)
+        self.assertEqual(pool.prewarm(), 3)
+        self.assertEqual(len(self.created), 3)
+
+        with pool.reserve() as conn:
+            self.assertTrue(conn in self.created)
+        self.assertEqual(len(self.created), 3)
+
+        stats = self.metrics.get_stats()
+        self.assertEqual(stats['pool.size'], 3)
+        self.assertEqual(stats['pool.created'], 3)
+        self.assertEqual(stats['pool.reused'], 1)
+        self.assertEqual(stats['pool.checkout.count'], 1)
+
+    def test_prewarm_all_used(self):
+        # every connection opened ahead is handed out before a new one
+        pool = self._get_pool(min_size=3)
+        pool.prewarm()
+        with pool.reserve() as one:
+            with pool.reserve() as two:
+                with pool.reserve() as three:
+                    self.assertEqual(set([one, two, three]),
+                                     set(self.created))
+        self.assertEqual(len(self.created), 3)
+
+    def test_check(self):
+        pool = self._get_pool()
+        with pool.reserve() as conn:
+            pass
+        conn.alive = False
+
+        with pool.reserve() as other:
+            self.assertFalse(other is conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(pool.size, 1)
+        self.assertEqual(self.metrics.get_stats()['pool.discarded'], 1)
+
+    def test_stale(self):
+        pool = self._get_pool()
+        pool.timeout = 0
+        with pool.reserve() as conn:
+            pass
+        self.assertTrue(conn.closed)
+        self.assertEqual(pool.size, 0)
+
+    def test_factory_error(self):
+        pool = FactoryPool(self._fail, maxsize=1)
+        for i in range(2):
+            # the slot is given back
+            try:
+                with pool.reserve():
+                    pass
+            except ValueError:
+                pass
+        self.assertEqual(pool.clients.qsize(), 1)
+
+    def _fail(self):
+        raise ValueError()
+
+    def test_drain(self):
+        pool = self._get_pool(min_size=2)
+        pool.prewarm()
+        idle = list(self.created)
+
+        with pool.reserve() as conn:
+            pool.drain()
+            self.assertTrue(pool.draining)
+            self.assertFalse(pool.drained)
+            # the idle connection is closed at once
+            self.assertEqual(len([c for c in idle if c.closed]), 1)
+            self.assertFalse(conn.closed)
+
+        # the one in use when it is given back
+        self.assertTrue(conn.closed)
+        self.assertTrue(pool.drained)
+        self.assertEqual(pool.size, 0)
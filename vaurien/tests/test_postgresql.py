@@ -0,0 +1,249 @@
+import struct
+import unittest
+
+import gevent
+from gevent.server import StreamServer
+from gevent.socket import create_connection
+
+from vaurien.behaviors.dummy import Dummy
+from vaurien.protocols.postgresql import (PostgreSql, MessageParser, Session,
+                                          parse_messages, SSL_REQUEST,
+                                          STARTUP, COMMAND, TUNNEL)
+from vaurien.tests.support import start_inprocess_proxy, _recv_exactly
+from vaurien.tests.test_redis import _split
+
+
+def _message(type_, payload=''):
+    return type_ + struct.pack('>I', len(payload) + 4) + payload
+
+
+def _untyped(code, payload=''):
+    return struct.pack('>II', len(payload) + 8, code) + payload
+
+
+STARTUP_MESSAGE = _untyped(196608, 'user\x00postgres\x00\x00')
+SSL = _untyped(SSL_REQUEST)
+READY = _message('R', '\x00' * 4) + _message('Z', 'I')
+
+
+def _response(rows):
+    return (_message('T', '\x00\x01n\x00' + '\x00' * 18) +
+            ''.join(_message('D', '\x00\x01\x00\x00\x00\x01%d' % (i % 10))
+                    for i in range(rows)) +
+            _message('C', 'SELECT %d\x00' % rows) + _message('Z', 'I'))
+
+
+def _feed(session, parser, data, client):
+    # feeds *data* to *parser* and the messages found to *session*
+    buffer = bytearray(data)
+    start = 0
+    while start < len(buffer):
+        end = parser.feed(buffer, start, len(buffer))
+        if end == -1:
+            break
+        if client:
+            session.on_client_message(parser)
+        else:
+            session.on_server_message(parser)
+        start = end
+
+
+class TestMessageParser(unittest.TestCase):
+
+    def test_messages(self):
+        client = [SSL, STARTUP_MESSAGE, _message('Q', 'SELECT 1\x00'),
+                  _message('d', 'x' * 100000), _message('X')]
+        data = ''.join(client)
+        for chunk in (1, 3, 5, 7, 8192, len(data)):
+            parser = MessageParser(requests=True)
+            self.assertEqual(_split(parser, data, chunk), client)
+            self.assertTrue(parser.at_boundary())
+            self.assertEqual(parser.type, 'X')
+
+        server = ['N', READY, _response(3)]
+        parser = MessageParser()
+        parser.single = True
+        self.assertEqual(len(_split(parser, ''.join(server), 2)), 1 + 2 + 6)
+
+    def test_invalid(self):
+        parser = MessageParser()
+        self.assertRaises(ValueError, parser.feed,
+                          bytearray('Q\x00\x00\x00\x02'), 0, 5)
+
+    def test_parse_messages(self):
+        self.assertEqual(parse_messages(''), None)
+        self.assertEqual(parse_messages('query, DataRow, copydata'),
+                         {True: set(['Q', 'd']), False: set(['D', 'd'])})
+        self.assertRaises(ValueError, parse_messages, 'What')
+
+
+class _Sock(object):
+    pass
+
+
+class TestPostgreSql(unittest.TestCase):
+
+    def test_may_idle(self):
+        protocol = PostgreSql(settings={'idle_timeout': 3600})
+        sock = _Sock()
+        self.assertFalse(protocol.may_idle(sock, 10))
+        protocol.get_session(sock).phase = COMMAND
+        self.assertTrue(protocol.may_idle(sock, 10))
+        self.assertFalse(protocol.may_idle(sock, 3601))
+        self.assertRaises(ValueError, protocol.update_settings,
+                          {'types': 'What'})
+        self.assertEqual(protocol.option('types'), 'Query,Execute')
+
+
+class TestSession(unittest.TestCase):
+
+    def _connect(self):
+        session = Session()
+        client, server = MessageParser(True), MessageParser()
+        _feed(session, client, STARTUP_MESSAGE, True)
+        self.assertEqual(session.phase, STARTUP)
+        _feed(session, server, READY, False)
+        self.assertEqual(session.phase, COMMAND)
+        self.assertTrue(session.idle)
+        return session, client, server
+
+    def test_simple_query(self):
+        session, client, server = self._connect()
+        _feed(session, client, _message('Q', 'SELECT 3\x00'), True)
+        self.assertFalse(session.idle)
+        self.assertEqual(session.query, 'SELECT 3')
+        _feed(session, server, _response(3), False)
+        self.assertTrue(session.idle)
+
+    def test_extended_query(self):
+        session, client, server = self._connect()
+        _feed(session, client, _message('P', 's1\x00SELECT 1\x00\x00\x00') +
+              _message('P', '\x00SELECT 2\x00\x00\x00') +
+              _message('B', 'p1\x00s1\x00' + '\x00' * 6) +
+              _message('B', '\x00\x00' + '\x00' * 6) +
+              _message('E', 'p1\x00\x00\x00\x00\x00') +
+              _message('E', '\x00\x00\x00\x00\x00') +
+              _message('S'), True)
+        self.assertEqual(session.query, 'SELECT 1')
+        _feed(session, server, _message('1') * 2 + _message('2') * 2 +
+              _message('D', 'x') + _message('C', 'SELECT 1\x00'), False)
+        self.assertEqual(session.query, 'SELECT 2')
+        _feed(session, server, _message('C', 'SELECT 1\x00') +
+              _message('Z', 'I'), False)
+        self.assertTrue(session.idle)
+
+        # the statement outlives the portal
+        _feed(session, client, _message('C', 'Pp1\x00') +
+              _message('B', 'p2\x00s1\x00' + '\x00' * 6) + _message('S'),
+              True)
+        self.assertEqual(session.query_of('E', bytearray('p2\x00')),
+                         'SELECT 1')
+        self.assertEqual(session.query_of('E', bytearray('p1\x00')), None)
+
+    def test_ssl(self):
+        session = Session()
+        client, server = MessageParser(True), MessageParser()
+        _feed(session, client, SSL, True)
+        self.assertTrue(session.negotiating)
+        server.single = True
+        _feed(session, server, 'S', False)
+        self.assertEqual(session.phase, TUNNEL)
+
+
+def _postgresql(sock, address):
+    # a server answering SELECT N with N rows, after an optional SSL
+    # request refused
+    try:
+        parser = MessageParser(requests=True)
+        buffer = bytearray(4096)
+        while True:
+            size = sock.recv_into(buffer)
+            if not size:
+                break
+            start = 0
+            while start < size:
+                end = parser.feed(buffer, start, size)
+                if end == -1:
+                    break
+                start = end
+                if parser.type is None:
+                    if parser.untyped:
+                        sock.sendall('N')
+                    else:
+                        sock.sendall(READY)
+                elif parser.type == 'Q':
+                    query = str(parser.payload).rstrip('\x00')
+                    sock.sendall(_response(int(query.split()[-1])))
+                elif parser.type == 'X':
+                    return
+    finally:
+        sock.close()
+
+
+class _Recorder(Dummy):
+    name = 'recorder'
+
+    def __init__(self):
+        super(_Recorder, self).__init__()
+        self.calls = []
+
+    def on_before_handle(self, protocol, source, dest, to_backend):
+        session = protocol.get_session(to_backend and dest or source)
+        self.calls.append((to_backend, session.query))
+        return True
+
+
+class TestPostgreSqlProxy(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = StreamServer(('localhost', 0), _postgresql)
+        self.backend.start()
+        self.proxy = None
+
+    def tearDown(self):
+        if self.proxy is not None:
+            self.proxy.stop()
+        self.backend.stop()
+
+    def _run(self, options, queries):
+        self.proxy = start_inprocess_proxy(self.backend.server_port,
+                                           protocol='postgresql',
+                                           options=options)
+        recorder = _Recorder()
+        self.proxy.behavior = recorder
+        self.proxy.behavior_name = 'recorder'
+
+        sock = create_connection(('localhost', self.proxy.server_port))
+        with gevent.Timeout(5):
+            sock.sendall(SSL)
+            self.assertEqual(_recv_exactly(sock, 1), 'N')
+            sock.sendall(STARTUP_MESSAGE)
+            self.assertEqual(_recv_exactly(sock, len(READY)), READY)
+            for query in queries:
+                sock.sendall(_message('Q', query + '\x00'))
+                expected = _response(int(query.split()[-1]))
+                self.assertEqual(_recv_exactly(sock, len(expected)),
+                                 expected)
+            sock.sendall(_message('X'))
+            self.assertEqual(sock.recv(10), '')
+        sock.close()
+        return recorder.calls
+
+    def test_queries(self):
+        calls = self._run([], ['SELECT 3', 'SELECT 1000'])
+        # the session is recorded before the messages are read
+        self.assertEqual(calls, [(True, None), (True, None)])
+
+    def test_rows(self):
+        calls = self._run(['--protocol-postgresql-types', 'DataRow'],
+                          ['SELECT 3', 'SELECT 0', 'SELECT 1000'])
+        # once per result set
+        self.assertEqual(calls, [(False, 'SELECT 3'), (False, 'SELECT 1000')])
+
+    def test_query(self):
+        calls = self._run(['--protocol-postgresql-types', '',
+                           '--protocol-postgresql-query', 'select 1$'],
+                          ['SELECT 3', 'SELECT 1', 'SELECT 10'])
+        # the query, and all the messages of its response
+        self.assertEqual(calls, [(True, None)] +
+                         [(False, 'SELECT 1')] * 4)
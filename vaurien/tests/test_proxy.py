@@ -32,7 +32,8 @@ class TestSimpleProxy(unittest.TestCase):
         self._web.terminate()
 
     def test_existing_behaviors(self):
-        wanted = ['blackout', 'delay', 'dummy', 'error', 'hang', 'transient', 'abort']
+        wanted = ['blackout', 'delay', 'dummy', 'error', 'hang', 'transient',
+                  'abort', 'drop', 'duplicate', 'reorder']
         self.assertEqual(set(self.client.list_behaviors()), set(wanted))
 
     def test_proxy(self):
@@ -57,3 +58,57 @@ class TestSimpleProxy(unittest.TestCase):
         self.assertEqual(self.client.get_behavior(), 'dummy')
         res = requests.get(_PROXY)
         self.assertEqual(res.status_code, 200)
+
+
+class TestKeepAliveProxy(unittest.TestCase):
+
+    options = ['--protocol-tcp-keep-alive']
+
+    def setUp(self):
+        self._proxy_pid = start_proxy(log_output='/dev/null',
+                                      log_level='error',
+                                      options=self.options)
+        self._web = start_simplehttp_server()
+        time.sleep(.2)
+        if self._web.poll():
+            self.tearDown()
+            raise ValueError("Could not start the proxy")
+
+    def tearDown(self):
+        stop_proxy(self._proxy_pid)
+        self._web.terminate()
+
+    def test_proxy(self):
+        # both directions are pumped at the same time
+        for i in range(10):
+            res = requests.get(_PROXY)
+            self.assertEqual(res.status_code, 200)
+
+
+class TestSelectEngineProxy(TestKeepAliveProxy):
+
+    options = ['--protocol-tcp-keep-alive', '--engine', 'select']
+
+
+class TestSpliceProxy(TestKeepAliveProxy):
+
+    options = ['--protocol-tcp-keep-alive', '--protocol-tcp-splice']
+
+
+class TestWorkersProxy(TestKeepAliveProxy):
+
+    options = ['--protocol-tcp-keep-alive', '--workers', '2']
+
+    def test_control(self):
+        # behavior changes reach every worker
+        client = Client()
+        with client.with_behavior('blackout'):
+            for i in range(4):
+                self.assertRaises(requests.ConnectionError, requests.get,
+                                  _PROXY)
+        res = requests.get(_PROXY)
+        self.assertEqual(res.status_code, 200)
+
+        stats = requests.get('http://localhost:8080/stats').json()['stats']
+        self.assertEqual(stats['tcp.start'], 5)
+        self.assertEqual(stats['tcp.active'], 0)
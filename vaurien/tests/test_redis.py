@@ -0,0 +1,194 @@
+import random
+import unittest
+
+import gevent
+from gevent.server import StreamServer
+from gevent.socket import create_connection
+
+from vaurien.behaviors.dummy import Dummy
+from vaurien.protocols.redis import RespParser
+from vaurien.tests.support import start_inprocess_proxy, use_behavior
+
+
+def _split(parser, data, chunk):
+    """Feeds *data* to *parser* in chunks of *chunk* bytes, returns the
+    messages found."""
+    messages = []
+    current = ''
+    for pos in range(0, len(data), chunk):
+        buffer = bytearray(data[pos:pos + chunk])
+        start = 0
+        while start < len(buffer):
+            end = parser.feed(buffer, start, len(buffer))
+            if end == -1:
+                current += str(buffer[start:])
+                break
+            messages.append(current + str(buffer[start:end]))
+            current = ''
+            start = end
+    return messages
+
+
+REPLIES = [
+    '+OK\r\n',
+    '-ERR unknown command\r\n',
+    ':1000\r\n',
+    '$5\r\nhello\r\n',
+    '$-1\r\n',
+    '*-1\r\n',
+    '*0\r\n',
+    '*3\r\n$3\r\nfoo\r\n$-1\r\n$3\r\nbar\r\n',
+    '*2\r\n*3\r\n:1\r\n:2\r\n:3\r\n*2\r\n+Foo\r\n-Bar\r\n',
+    # RESP3
+    '_\r\n',
+    ',3.14\r\n',
+    '#t\r\n',
+    '(3492890328409238509324850943850943825024385\r\n',
+    '!21\r\nSYNTAX invalid syntax\r\n',
+    '=15\r\ntxt:Some string\r\n',
+    '%2\r\n+first\r\n:1\r\n+second\r\n:2\r\n',
+    '~2\r\n+orange\r\n+apple\r\n',
+    '|1\r\n+ttl\r\n:3600\r\n$2\r\nok\r\n',
+    '$?\r\n;4\r\nHell\r\n;5\r\no wor\r\n;0\r\n',
+    '*?\r\n:1\r\n*?\r\n:2\r\n.\r\n.\r\n',
+    '$%d\r\n%s\r\n' % (100000, 'x' * 100000),
+]
+
+
+class TestRespParser(unittest.TestCase):
+
+    def test_replies(self):
+        data = ''.join(REPLIES)
+        for chunk in (1, 2, 3, 7, 64, 8192, len(data)):
+            parser = RespParser()
+            self.assertEqual(_split(parser, data, chunk), REPLIES)
+            self.assertTrue(parser.at_boundary())
+
+    def test_requests(self):
+        requests = ['*3\r\n$3\r\nSET\r\n$3\r\nkey\r\n$5\r\nvalue\r\n',
+                    '*2\r\n$3\r\nget\r\n$3\r\nkey\r\n',
+                    'PING\r\n']
+        parser = RespParser(requests=True)
+        commands = []
+        for request in requests:
+            self.assertEqual(_split(parser, request, 2), [request])
+            commands.append(parser.command)
+        self.assertEqual(commands, ['SET', 'GET', 'PING'])
+
+    def test_invalid(self):
+        parser = RespParser()
+        self.assertRaises(ValueError, parser.feed, bytearray('?what\r\n'),
+                          0, 7)
+        self.assertRaises(ValueError, parser.feed, bytearray('$x\r\n'), 0, 4)
+
+
+def _redis(sock, address):
+    # answers every GET with a multi-bulk reply, without waiting for the
+    # next command, so pipelined commands pile up.
+    parser = RespParser(requests=True)
+    buffer = bytearray(4096)
+    try:
+        while True:
+            size = sock.recv_into(buffer)
+            if not size:
+                break
+            start = 0
+            while start < size:
+                end = parser.feed(buffer, start, size)
+                if end == -1:
+                    break
+                sock.sendall('*2\r\n$%d\r\n%s\r\n$-1\r\n'
+                             % (len(parser.command), parser.command))
+                start = end
+    finally:
+        sock.close()
+
+
+class _Recorder(Dummy):
+    name = 'recorder'
+
+    def __init__(self):
+        super(_Recorder, self).__init__()
+        self.messages = []
+        self.handled = []
+
+    def on_message(self, protocol, message):
+        self.messages.append((message.name, message.to_backend))
+        return super(_Recorder, self).on_message(protocol, message)
+
+    def on_before_handle(self, protocol, source, dest, to_backend):
+        self.handled.append(to_backend)
+        return True
+
+
+class TestRedisProxy(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = StreamServer(('localhost', 0), _redis)
+        self.backend.start()
+        self.proxy = start_inprocess_proxy(self.backend.server_port,
+                                           protocol='redis')
+
+    def tearDown(self):
+        self.proxy.stop()
+        self.backend.stop()
+
+    def test_pipelining(self):
+        sock = create_connection(('localhost', self.proxy.server_port))
+        commands = ['GET%d' % i for i in range(200)]
+        data = ''.join('*2\r\n$%d\r\n%s\r\n$1\r\nx\r\n' % (len(name), name)
+                       for name in commands)
+        expected = ''.join('*2\r\n$%d\r\n%s\r\n$-1\r\n' % (len(name), name)
+                           for name in commands)
+        # sent in random pieces
+        pos = 0
+        while pos < len(data):
+            size = random.randint(1, 50)
+            sock.sendall(data[pos:pos + size])
+            pos += size
+
+        received = ''
+        with gevent.Timeout(5):
+            while len(received) < len(expected):
+                received += sock.recv(65536)
+        sock.close()
+        self.assertEqual(received, expected)
+
+    def test_error(self):
+        # the command peeked at by the protocol goes to the server, and
+        # its reply is replaced at once
+        use_behavior(self.proxy, 'error', messages='GET,SET')
+        sock = create_connection(('localhost', self.proxy.server_port))
+        with gevent.Timeout(2):
+            sock.sendall('*2\r\n$3\r\nGET\r\n$1\r\nx\r\n')
+            received = ''
+            while len(received) < 1000:
+                received += sock.recv(65536)
+        sock.close()
+        self.assertNotEqual(received[:4], '*2\r\n')
+
+    def test_messages(self):
+        recorder = _Recorder()
+        recorder.update_settings({'messages': 'get1, Get3'})
+        self.proxy.behavior = recorder
+        self.proxy.behavior_name = 'recorder'
+
+        sock = create_connection(('localhost', self.proxy.server_port))
+        data = ''.join('*1\r\n$4\r\nGET%d\r\n' % i for i in range(4))
+        data += 'PING\r\n'
+        with gevent.Timeout(5):
+            # in pieces, the names are read whole anyway
+            for pos in range(0, len(data), 3):
+                sock.sendall(data[pos:pos + 3])
+                gevent.sleep(0.001)
+            received = ''
+            while received.count('$-1') < 5:
+                received += sock.recv(65536)
+        sock.close()
+
+        requests = [name for name, to_backend in recorder.messages
+                    if to_backend]
+        self.assertEqual(requests, ['GET0', 'GET1', 'GET2', 'GET3', 'PING'])
+        self.assertEqual(len(recorder.messages), 10)
+        # the commands picked and their replies
+        self.assertEqual(sorted(recorder.handled), [False, False, True, True])
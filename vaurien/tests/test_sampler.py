@@ -0,0 +1,152 @@
+import unittest
+
+import gevent
+from gevent.server import StreamServer
+from gevent.socket import create_connection
+
+from vaurien import logger
+from vaurien.behaviors.dummy import Dummy
+from vaurien.config import DEFAULT_SETTINGS
+from vaurien.proxy import OnTheFlyProxy, RandomProxy, _Choice
+from vaurien.run import build_parser
+from vaurien.tests.support import start_inprocess_proxy
+from vaurien._sampler import AliasSampler
+
+
+class TestSampler(unittest.TestCase):
+
+    def test_pick(self):
+        values = iter([0., .5, .999])
+        sampler = AliasSampler([('a', 1), ('b', 0), ('c', 1)],
+                               random=lambda: next(values))
+        self.assertEqual([sampler.pick() for i in range(3)],
+                         ['a', 'c', 'c'])
+
+    def test_small_weights(self):
+        sampler = AliasSampler([('rare', .01), ('common', 99.99)])
+        picks = [sampler.pick() for i in range(10000)]
+        self.assertTrue(picks.count('rare') < 20)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, AliasSampler, [])
+        self.assertRaises(ValueError, AliasSampler, [('a', 0)])
+        self.assertRaises(ValueError, AliasSampler, [('a', -1)])
+
+
+def _echo(sock, address):
+    try:
+        while True:
+            data = sock.recv(1024)
+            if not data:
+                return
+            sock.sendall(data)
+    finally:
+        sock.close()
+
+
+class _Recorder(Dummy):
+    name = 'recorder'
+
+    def __init__(self, index, calls):
+        super(_Recorder, self).__init__()
+        self.index = index
+        self.calls = calls
+
+    def on_before_handle(self, protocol, source, dest, to_backend):
+        self.calls.append((self.index, to_backend))
+        return True
+
+
+class _Sampler(object):
+    # a new behavior for every pick
+    def __init__(self):
+        self.calls = []
+        self.picks = 0
+
+    def pick(self):
+        self.picks += 1
+        return _Recorder(self.picks, self.calls), 'recorder'
+
+
+class TestRandomProxy(unittest.TestCase):
+
+    def _get_proxy(self, behavior, granularity='chunk',
+                   proxy_class=RandomProxy):
+        settings = DEFAULT_SETTINGS.copy()
+        settings['vaurien.behavior'] = behavior
+        settings['vaurien.granularity'] = granularity
+        settings['args'] = build_parser().parse_args([])
+        return proxy_class(proxy='localhost:8001', backend='localhost:8002',
+                           settings=settings, logger=logger)
+
+    def test_weights(self):
+        proxy = self._get_proxy('0.01:error,5:delay')
+        self.assertEqual(proxy.weights['error'], .01)
+        self.assertAlmostEqual(proxy.weights['dummy'], 94.99)
+
+        proxy.set_weights('100:blackout')
+        self.assertEqual(proxy.get_behavior()[1], 'blackout')
+
+        # a bad update leaves the current weights in place
+        self.assertRaises(ValueError, proxy.set_weights, '60:delay,60:error')
+        self.assertRaises(ValueError, proxy.set_weights, 'x:delay')
+        self.assertEqual(proxy.get_behavior()[1], 'blackout')
+
+    def test_granularity(self):
+        proxy = self._get_proxy('100:dummy', 'connection')
+        proxy.set_weights('100:delay')
+        choice = _Choice(*proxy.get_behavior())
+        proxy.set_weights('100:error')
+        self.assertEqual(proxy._pick_behavior(choice, True)[1], 'delay')
+
+        proxy.granularity = 'message'
+        self.assertEqual(proxy._pick_behavior(choice, True)[1], 'error')
+        proxy.set_weights('100:hang')
+        # the response gets the behavior of the request
+        self.assertEqual(proxy._pick_behavior(choice, False)[1], 'error')
+
+        proxy.granularity = 'chunk'
+        self.assertEqual(proxy._pick_behavior(choice, False)[1], 'hang')
+
+        self.assertRaises(ValueError, self._get_proxy, '100:dummy', 'byte')
+
+    def test_response_behavior(self):
+        # the response gets the behavior of its request, not the one
+        # picked while the backend was still answering it
+        backend = StreamServer(('localhost', 0), _echo)
+        backend.start()
+        proxy = start_inprocess_proxy(backend.server_port,
+                                      options=['--protocol-tcp-keep-alive'],
+                                      proxy_class=RandomProxy,
+                                      granularity='message')
+        sampler = proxy._sampler = _Sampler()
+        sock = create_connection(('localhost', proxy.server_port))
+        try:
+            with gevent.Timeout(5):
+                for data in ('one', 'two'):
+                    sock.sendall(data)
+                    self.assertEqual(sock.recv(1024), data)
+        finally:
+            sock.close()
+            proxy.stop()
+            backend.stop()
+
+        requests = [index for index, to_backend in sampler.calls
+                    if to_backend]
+        responses = [index for index, to_backend in sampler.calls
+                     if not to_backend]
+        self.assertEqual(len(requests), 2)
+        self.assertEqual(responses, requests)
+
+    def test_on_the_fly(self):
+        proxy = self._get_proxy('100:dummy', proxy_class=OnTheFlyProxy)
+        proxy.set_behavior(name='delay', sleep=0)
+        self.assertEqual(proxy.get_behavior()[1], 'delay')
+        self.assertEqual(proxy.get_weights(), {'delay': 100.})
+
+        # a mix of behaviors can be set too
+        proxy.set_weights('50:error')
+        self.assertEqual(proxy.get_weights(), {'error': 50., 'dummy': 50.})
+        self.assertTrue(proxy.get_behavior()[1] in ('error', 'dummy'))
+        self.assertRaises(ValueError, proxy.set_weights, 'x:delay')
+        self.assertRaises(KeyError, proxy.set_behavior, name='unknown')
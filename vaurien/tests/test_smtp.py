@@ -0,0 +1,258 @@
+import unittest
+
+import gevent
+from gevent.server import StreamServer
+from gevent.socket import create_connection
+
+from vaurien.behaviors.error import Error
+from vaurien.protocols.smtp import (CommandParser, ReplyParser, Session,
+                                    parse_steps, error_reply, TUNNEL)
+from vaurien.tests.support import start_inprocess_proxy
+from vaurien.tests.test_redis import _split
+
+
+def _feed(session, parser, data, client):
+    # feeds *data* to *parser* and the messages found to *session*
+    buffer = bytearray(data)
+    start = 0
+    while start < len(buffer):
+        end = parser.feed(buffer, start, len(buffer))
+        if end == -1:
+            break
+        if client:
+            session.on_client_message(parser)
+        else:
+            session.on_server_message(parser)
+        start = end
+
+
+class TestParsers(unittest.TestCase):
+
+    def test_commands(self):
+        commands = ['EHLO client\r\n', 'MAIL FROM:<a@example.com>\r\n',
+                    'BDAT 10\r\n0123456789', 'BDAT 0 LAST\r\n', 'QUIT\r\n']
+        data = ''.join(commands)
+        for chunk in (1, 2, 5, 8192):
+            parser = CommandParser()
+            self.assertEqual(_split(parser, data, chunk), commands)
+            self.assertTrue(parser.at_boundary())
+            self.assertEqual(parser.verb, 'QUIT')
+
+    def test_message_data(self):
+        messages = ['Subject: hi\r\n\r\n..\r\n.. \r\nbody\r\n.\r\n',
+                    '.\r\n', 'x' * 100000 + '\r\n.\r\n']
+        for message in messages:
+            for chunk in (1, 2, 3, 4, 5, 6, 8192):
+                parser = CommandParser()
+                parser.data = True
+                self.assertEqual(_split(parser, message + 'QUIT\r\n', chunk),
+                                 [message, 'QUIT\r\n'])
+                self.assertFalse(parser.data)
+
+    def test_replies(self):
+        replies = ['220 ready\r\n',
+                   '250-mail.example.com\r\n250-PIPELINING\r\n'
+                   '250 SIZE 1000\r\n', '354 go ahead\r\n']
+        data = ''.join(replies)
+        for chunk in (1, 3, 8192):
+            parser = ReplyParser()
+            self.assertEqual(_split(parser, data, chunk), replies)
+            self.assertEqual(parser.code, 354)
+
+        parser = ReplyParser()
+        self.assertRaises(ValueError, parser.feed, bytearray('what\r\n'), 0, 6)
+        parser = CommandParser()
+        self.assertRaises(ValueError, parser.feed, bytearray('x' * 4096), 0,
+                          4096)
+
+    def test_steps(self):
+        self.assertEqual(parse_steps(''), None)
+        self.assertEqual(parse_steps('mail, Rcpt'), set(['MAIL', 'RCPT']))
+        for i in range(20):
+            self.assertTrue(error_reply('RCPT', '4xx').startswith('45'))
+            self.assertTrue(error_reply('EOM', '5xx').startswith('55'))
+            self.assertTrue(error_reply('NOOP')[:3] in ('451', '554'))
+
+
+class TestSession(unittest.TestCase):
+
+    def test_pipelining(self):
+        session = Session()
+        client, server = CommandParser(), ReplyParser()
+        self.assertEqual(session.step, 'CONNECT')
+        _feed(session, server, '220 ready\r\n', False)
+        self.assertTrue(session.idle)
+
+        _feed(session, client, 'EHLO me\r\n', True)
+        _feed(session, server, '250-hi\r\n250-PIPELINING\r\n250 8BITMIME\r\n',
+              False)
+        self.assertEqual(session.extensions, set(['PIPELINING', '8BITMIME']))
+
+        _feed(session, client, 'MAIL FROM:<a@b>\r\nRCPT TO:<c@d>\r\nDATA\r\n',
+              True)
+        self.assertEqual(session.step, 'MAIL')
+        session.inject('RSET', '250 ok\r\n')
+        _feed(session, server, '250 ok\r\n250 ok\r\n', False)
+        self.assertEqual(session.step, 'DATA')
+        self.assertEqual(session.injected(), [])
+        _feed(session, server, '354 go\r\n', False)
+        self.assertTrue(session.data)
+        # the reply injected after DATA is due
+        self.assertEqual(session.injected(), ['250 ok\r\n'])
+        self.assertTrue(session.idle)
+
+    def test_auth(self):
+        session = Session()
+        client, server = CommandParser(), ReplyParser()
+        _feed(session, server, '220 ready\r\n', False)
+        _feed(session, client, 'AUTH LOGIN\r\n', True)
+        _feed(session, server, '334 VXNlcm5hbWU6\r\n', False)
+        self.assertTrue(session.challenge)
+        self.assertEqual(session.next_step(client, 'AUTH'), None)
+        _feed(session, client, 'dXNlcg==\r\n', True)
+        _feed(session, server, '334 UGFzc3dvcmQ6\r\n', False)
+        _feed(session, client, 'cGFzcw==\r\n', True)
+        _feed(session, server, '235 ok\r\n', False)
+        self.assertFalse(session.challenge)
+        self.assertTrue(session.idle)
+
+    def test_starttls(self):
+        session = Session()
+        client, server = CommandParser(), ReplyParser()
+        _feed(session, server, '220 ready\r\n', False)
+        _feed(session, client, 'STARTTLS\r\n', True)
+        _feed(session, server, '220 go ahead\r\n', False)
+        self.assertEqual(session.phase, TUNNEL)
+
+
+class _Server(StreamServer):
+    # a server accepting all the mails, recording the commands it gets
+    # and the size of the messages
+
+    def __init__(self):
+        StreamServer.__init__(self, ('localhost', 0), self._serve)
+        self.commands = []
+        self.sizes = []
+
+    def _serve(self, sock, address):
+        sock.sendall('220 localhost ready\r\n')
+        rfile = sock.makefile('rb')
+        try:
+            while True:
+                line = rfile.readline()
+                if not line:
+                    break
+                verb = line.split()[0].upper()
+                self.commands.append(verb)
+                if verb == 'EHLO':
+                    sock.sendall('250-localhost\r\n250 PIPELINING\r\n')
+                elif verb == 'DATA':
+                    sock.sendall('354 go ahead\r\n')
+                    size = 0
+                    while True:
+                        line = rfile.readline()
+                        if line == '.\r\n':
+                            break
+                        size += len(line)
+                    self.sizes.append(size)
+                    sock.sendall('250 queued\r\n')
+                elif verb == 'QUIT':
+                    sock.sendall('221 bye\r\n')
+                    break
+                else:
+                    sock.sendall('250 ok\r\n')
+        finally:
+            rfile.close()
+            sock.close()
+
+
+class TestSMTPProxy(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = _Server()
+        self.backend.start()
+        self.proxy = None
+
+    def tearDown(self):
+        if self.proxy is not None:
+            self.proxy.stop()
+        self.backend.stop()
+
+    def _send_mail(self, message, options=(), behavior=None):
+        self.proxy = start_inprocess_proxy(self.backend.server_port,
+                                           protocol='smtp',
+                                           options=list(options))
+        if behavior is not None:
+            self.proxy.behavior = behavior
+            self.proxy.behavior_name = behavior.name
+
+        sock = create_connection(('localhost', self.proxy.server_port))
+        rfile = sock.makefile('rb')
+        codes = []
+
+        def read_reply():
+            while True:
+                line = rfile.readline()
+                if line[3:4] != '-':
+                    codes.append(line[:3])
+                    return
+
+        with gevent.Timeout(5):
+            read_reply()
+            sock.sendall('EHLO me\r\n')
+            read_reply()
+            # pipelined
+            sock.sendall('MAIL FROM:<a@example.com>\r\n'
+                         'RCPT TO:<b@example.com>\r\nDATA\r\n')
+            for i in range(3):
+                read_reply()
+            if codes[-1] == '354':
+                sock.sendall(message + '\r\n.\r\n')
+                read_reply()
+            sock.sendall('QUIT\r\n')
+            read_reply()
+        rfile.close()
+        sock.close()
+        return codes
+
+    def test_large_message(self):
+        message = '\r\n'.join(['x' * 998] * 3000)
+        codes = self._send_mail(message)
+        self.assertEqual(codes, ['220', '250', '250', '250', '354', '250',
+                                 '221'])
+        self.assertEqual(self.backend.sizes, [len(message) + 2])
+
+    def test_error(self):
+        codes = self._send_mail('hello', ['--protocol-smtp-steps', 'RCPT',
+                                          '--protocol-smtp-errors', '4xx'],
+                                Error())
+        # the server doesn't get the recipient, the reply to it is in
+        # order with the other ones
+        self.assertTrue(codes[3].startswith('45'))
+        self.assertEqual(codes[:3], ['220', '250', '250'])
+        self.assertEqual(codes[4:], ['354', '250', '221'])
+        self.assertEqual(self.backend.commands,
+                         ['EHLO', 'MAIL', 'DATA', 'QUIT'])
+
+    def test_error_eom(self):
+        codes = self._send_mail('hello', ['--protocol-smtp-steps', 'EOM',
+                                          '--protocol-smtp-errors', '5xx'],
+                                Error())
+        # the message went through, but the client is told otherwise
+        self.assertEqual(codes[:5], ['220', '250', '250', '250', '354'])
+        self.assertTrue(codes[5].startswith('55'))
+        self.assertEqual(self.backend.sizes, [len('hello') + 2])
+
+    def test_tls(self):
+        # the data goes through untouched, in chunks
+        self.proxy = start_inprocess_proxy(
+            self.backend.server_port, protocol='smtp',
+            options=['--protocol-smtp-tls'])
+        handler = self.proxy.handler
+        sock = create_connection(('localhost', self.proxy.server_port))
+        with gevent.Timeout(5):
+            self.assertEqual(sock.recv(1024), '220 localhost ready\r\n')
+            sock.sendall('QUIT\r\n')
+            self.assertEqual(sock.recv(1024), '221 bye\r\n')
+        sock.close()
+        self.assertTrue(handler.option('tls'))
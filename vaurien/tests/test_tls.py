@@ -0,0 +1,95 @@
+import os
+import unittest
+
+import gevent
+from gevent import ssl
+from gevent.server import StreamServer
+from gevent.socket import create_connection, error
+
+from vaurien._tls import create_server_context, create_client_context
+from vaurien.tests.support import start_inprocess_proxy, _recv_exactly
+from vaurien.tests.test_redis import _redis
+
+
+# a self-signed certificate for localhost, with its key
+CERT = os.path.join(os.path.dirname(__file__), 'localhost.pem')
+
+
+def _is_closed(sock):
+    # the proxy may close the connection with data left unread
+    try:
+        return sock.recv(1024) == ''
+    except error:
+        return True
+
+
+class _TLSRedis(StreamServer):
+    # the redis server of the tests, over TLS
+
+    def __init__(self):
+        StreamServer.__init__(self, ('localhost', 0), self._serve,
+                              ssl_context=create_server_context(CERT))
+        self.connections = 0
+
+    def _serve(self, sock, address):
+        self.connections += 1
+        _redis(sock, address)
+
+
+class TestTLSProxy(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = _TLSRedis()
+        self.backend.start()
+        self.proxy = start_inprocess_proxy(
+            self.backend.server_port, protocol='redis',
+            options=['--protocol-redis-reuse-socket'],
+            tls_certfile=CERT, backend_tls=True, backend_tls_cafile=CERT)
+
+    def tearDown(self):
+        self.proxy.stop()
+        self.backend.stop()
+
+    def _connect(self):
+        sock = create_connection(('localhost', self.proxy.server_port))
+        return create_client_context(CERT).wrap_socket(
+            sock, server_hostname='localhost')
+
+    def test_decrypted(self):
+        command = '*2\r\n$3\r\nGET\r\n$1\r\nx\r\n'
+        reply = '*2\r\n$3\r\nGET\r\n$-1\r\n'
+        for i in range(3):
+            sock = self._connect()
+            with gevent.Timeout(5):
+                # more than a TLS record at once
+                sock.sendall(command * 1000)
+                self.assertEqual(_recv_exactly(sock, len(reply) * 1000),
+                                 reply * 1000)
+            sock.close()
+            gevent.sleep(0.05)
+        # the commands were handled one by one, the backend connection
+        # is kept in the pool
+        self.assertTrue(self.proxy.get_stats()['redis.dummy.to_backend'] >=
+                        3000)
+        self.assertEqual(self.backend.connections, 1)
+
+    def test_handshake_error(self):
+        sock = create_connection(('localhost', self.proxy.server_port))
+        with gevent.Timeout(5):
+            sock.sendall('*1\r\n$4\r\nPING\r\n')
+            self.assertTrue(_is_closed(sock))
+        sock.close()
+        self.assertEqual(self.proxy.get_stats()['tls.handshake_errors'], 1)
+
+    def test_untrusted_backend(self):
+        proxy = start_inprocess_proxy(self.backend.server_port,
+                                      protocol='redis', backend_tls=True)
+        sock = create_connection(('localhost', proxy.server_port))
+        try:
+            with gevent.Timeout(5):
+                sock.sendall('*1\r\n$4\r\nPING\r\n')
+                self.assertTrue(_is_closed(sock))
+        finally:
+            sock.close()
+            proxy.stop()
+        self.assertRaises(ssl.SSLError, create_client_context, '/dev/null')
@@ -1,8 +1,64 @@
 import unittest
-from vaurien.util import chunked
+
+from gevent import socket
+
+from vaurien.behaviors.delay import Delay
+from vaurien.util import (chunked, get_data_into, BufferPool,
+                          compile_options, apply_settings)
 
 
 class TestUtil(unittest.TestCase):
 
     def test_chunked(self):
         self.assertEqual(sum(list(chunked(7634, 2049))), 7634)
+
+    def test_buffer_pool(self):
+        pool = BufferPool(size=16, maxsize=1)
+        one, two = socket.socketpair()
+        try:
+            buffer, view = pool.get(one)
+            self.assertEqual(len(buffer), 16)
+            # the buffer stays bound to the socket
+            self.assertTrue(pool.get(one)[0] is buffer)
+
+            two.sendall('hello')
+            read = get_data_into(one, view)
+            self.assertEqual(view[:read].tobytes(), 'hello')
+
+            # and is recycled once the socket gives it back
+            pool.put(one)
+            self.assertTrue(pool.get(two)[0] is buffer)
+        finally:
+            one.close()
+            two.close()
+
+    def test_compile_options(self):
+        options = {'sleep': ('Delay in seconds', float, 1),
+                   'on': ('Switch', bool, False)}
+        opts = compile_options(options, {'sleep': '0.5', 'on': 'yes'})
+        self.assertEqual(opts.sleep, 0.5)
+        self.assertTrue(opts.on)
+
+        # defaults are used for missing values
+        opts = compile_options(options, {})
+        self.assertEqual(opts.sleep, 1.)
+        self.assertFalse(opts.on)
+
+        # the snapshot is immutable
+        self.assertRaises(AttributeError, setattr, opts, 'sleep', 2)
+        self.assertRaises(ValueError, compile_options, options,
+                          {'sleep': 'never'})
+
+    def test_apply_settings(self):
+        delay = Delay()
+        apply_settings(delay, {'sleep': '0.5'})
+        apply_settings(delay, {'jitter': '1'})
+        self.assertEqual((delay.option('sleep'), delay.option('jitter')),
+                         (0.5, 1.))
+        self.assertEqual(delay.version, 2)
+
+        # nothing changes with an invalid value
+        self.assertRaises(ValueError, apply_settings, delay,
+                          {'sleep': 'never', 'jitter': '2'})
+        self.assertEqual(delay.option('jitter'), 1.)
+        self.assertEqual(delay.version, 2)
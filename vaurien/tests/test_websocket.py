@@ -0,0 +1,211 @@
+import base64
+import hashlib
+import struct
+import unittest
+
+import gevent
+from gevent.server import StreamServer
+from gevent.socket import create_connection, socketpair
+
+from vaurien.protocols.http import Http, MessageParser
+from vaurien.protocols.websocket import (frame, header_size, parse_header,
+                                         parse_opcodes, TEXT, BINARY,
+                                         CONTINUATION, CLOSE, PING, MASKED)
+from vaurien.tests.support import (start_inprocess_proxy, use_behavior,
+                                   _recv_exactly)
+
+
+_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+HANDSHAKE = ('GET /chat HTTP/1.1\r\nHost: localhost\r\n'
+             'Upgrade: websocket\r\nConnection: Upgrade\r\n'
+             'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+             'Sec-WebSocket-Version: 13\r\n\r\n')
+
+
+def _read_frame(sock):
+    # the (fin, opcode, payload) of the next frame of *sock*, unmasked
+    data = _recv_exactly(sock, 2)
+    if data is None:
+        return None
+    data += _recv_exactly(sock, header_size(ord(data[1])) - 2)
+    fin, opcode, length = parse_header(bytearray(data))
+    payload = bytearray(_recv_exactly(sock, length) or '')
+    if ord(data[1]) & MASKED:
+        mask = bytearray(data[-4:])
+        for index in range(length):
+            payload[index] ^= mask[index % 4]
+    return fin, opcode, str(payload)
+
+
+class WebSocketServer(StreamServer):
+    """Echoes the frames it gets, and keeps their payloads."""
+
+    def __init__(self, address=('localhost', 0)):
+        StreamServer.__init__(self, address, self._serve)
+        self.received = []
+
+    def _serve(self, sock, address):
+        try:
+            request = ''
+            while not request.endswith('\r\n\r\n'):
+                request += sock.recv(1)
+            key = request.split('Sec-WebSocket-Key: ')[1].split('\r\n')[0]
+            accept = base64.b64encode(hashlib.sha1(key + _GUID).digest())
+            sock.sendall('HTTP/1.1 101 Switching Protocols\r\n'
+                         'Upgrade: websocket\r\nConnection: Upgrade\r\n'
+                         'Sec-WebSocket-Accept: %s\r\n\r\n' % accept)
+            while True:
+                received = _read_frame(sock)
+                if received is None:
+                    return
+                fin, opcode, payload = received
+                self.received.append((opcode, payload))
+                sock.sendall(frame(opcode, payload, fin=fin))
+                if opcode == CLOSE:
+                    return
+        finally:
+            sock.close()
+
+
+class TestFraming(unittest.TestCase):
+
+    def test_headers(self):
+        for length in (0, 125, 126, 65535, 65536):
+            for masked in (False, True):
+                data = frame(BINARY, 'x' * length, masked)
+                header = bytearray(data[:14])
+                size = header_size(header[1])
+                self.assertEqual(size + length, len(data))
+                self.assertEqual(parse_header(header), (True, BINARY, length))
+        self.assertEqual(parse_header(bytearray(frame(TEXT, fin=False))),
+                         (False, TEXT, 0))
+
+    def test_opcodes(self):
+        self.assertEqual(parse_opcodes(' text, Ping,'),
+                         frozenset([TEXT, PING]))
+        self.assertRaises(ValueError, parse_opcodes, 'TEXT,What')
+        protocol = Http()
+        self.assertRaises(ValueError, protocol.update_settings,
+                          {'websocket_frames': 'What'})
+        self.assertEqual(protocol.option('websocket_frames'), 'TEXT,BINARY')
+
+    def test_upgrade(self):
+        parser = MessageParser(requests=True)
+        head = bytearray(HANDSHAKE)
+        self.assertEqual(parser.feed_head(head, 0, len(head)), len(head))
+        parser.parse()
+        # no body, the frames come after the response
+        self.assertTrue(parser.done)
+        self.assertEqual(parser.upgrade, 'websocket')
+
+        parser = MessageParser()
+        head = bytearray('HTTP/1.1 101 Switching Protocols\r\n'
+                         'Upgrade: websocket\r\nConnection: Upgrade\r\n\r\n')
+        parser.feed_head(head, 0, len(head))
+        parser.parse('GET')
+        self.assertTrue(parser.done)
+        self.assertTrue(parser.keep_alive)
+
+    def test_wait(self):
+        # an idle connection gives its buffer back
+        protocol = Http()
+        sock, peer = socketpair()
+        try:
+            sock.settimeout(1)
+            protocol._get_buffer(sock)
+            gevent.spawn_later(0.05, peer.sendall, frame(PING))
+            protocol._framer.wait(sock)
+            self.assertEqual(sock._buffer, None)
+            self.assertEqual(protocol._framer.next_frame(sock),
+                             (True, PING, 0, 2))
+        finally:
+            sock.close()
+            peer.close()
+
+
+class TestWebSocketProxy(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = WebSocketServer()
+        self.backend.start()
+        self.proxy = start_inprocess_proxy(self.backend.server_port,
+                                           protocol='http')
+
+    def tearDown(self):
+        self.proxy.stop()
+        self.backend.stop()
+
+    def _connect(self):
+        sock = create_connection(('localhost', self.proxy.server_port))
+        sock.settimeout(5)
+        sock.sendall(HANDSHAKE)
+        response = ''
+        while not response.endswith('\r\n\r\n'):
+            data = sock.recv(1)
+            if not data:
+                break
+            response += data
+        self.assertTrue(response.startswith('HTTP/1.1 101 '))
+        return sock
+
+    def test_echo(self):
+        sock = self._connect()
+        sock.sendall(frame(TEXT, 'hello', True) +
+                     frame(BINARY, 'x' * 70000, True) +
+                     frame(TEXT, 'frag', True, fin=False) +
+                     frame(PING, 'ping', True) +
+                     frame(CONTINUATION, 'ment', True))
+        self.assertEqual(_read_frame(sock), (True, TEXT, 'hello'))
+        self.assertEqual(_read_frame(sock), (True, BINARY, 'x' * 70000))
+        self.assertEqual(_read_frame(sock), (False, TEXT, 'frag'))
+        self.assertEqual(_read_frame(sock), (True, PING, 'ping'))
+        self.assertEqual(_read_frame(sock), (True, CONTINUATION, 'ment'))
+        sock.close()
+
+    def test_idle(self):
+        # the WebSocket outlives the timeout of the proxy
+        self.proxy.stop()
+        self.proxy = start_inprocess_proxy(self.backend.server_port,
+                                           protocol='http', timeout=0.1)
+        sock = self._connect()
+        gevent.sleep(0.3)
+        sock.sendall(frame(TEXT, 'later', True))
+        self.assertEqual(_read_frame(sock), (True, TEXT, 'later'))
+        sock.close()
+
+    def test_drop(self):
+        use_behavior(self.proxy, 'drop', messages='BINARY')
+        sock = self._connect()
+        # the whole message is dropped, not the control frames
+        sock.sendall(frame(BINARY, 'a', True, fin=False) +
+                     frame(PING, 'ping', True) +
+                     frame(CONTINUATION, 'b', True) +
+                     frame(TEXT, 'c', True))
+        self.assertEqual(_read_frame(sock), (True, PING, 'ping'))
+        self.assertEqual(_read_frame(sock), (True, TEXT, 'c'))
+        self.assertEqual(self.backend.received, [(PING, 'ping'),
+                                                 (TEXT, 'c')])
+        sock.close()
+
+    def test_error(self):
+        use_behavior(self.proxy, 'error', messages='TEXT')
+        sock = self._connect()
+        sock.sendall(frame(TEXT, 'hello world', True))
+        fin, opcode, payload = _read_frame(sock)
+        self.assertEqual((fin, opcode, len(payload)), (True, TEXT, 11))
+        self.assertNotEqual(self.backend.received[0][1], 'hello world')
+        sock.close()
+
+    def test_abort(self):
+        use_behavior(self.proxy, 'abort', messages='TEXT')
+        sock = self._connect()
+        sock.sendall(frame(PING, 'ping', True))
+        self.assertEqual(_read_frame(sock), (True, PING, 'ping'))
+        sock.sendall(frame(TEXT, 'hello', True))
+        self.assertEqual(_read_frame(sock),
+                         (True, CLOSE, struct.pack('>H', 1001)))
+        self.assertEqual(_read_frame(sock), None)
+        self.assertEqual(self.backend.received,
+                         [(PING, 'ping'), (CLOSE, struct.pack('>H', 1001))])
+        sock.close()
@@ -0,0 +1,28 @@
+import unittest
+
+from vaurien import logger
+from vaurien.workers import Workers
+
+
+class _Worker(object):
+
+    def __init__(self, stats, gauges):
+        self.results = {'get_stats': stats, 'get_gauges': gauges}
+
+    def call(self, command, **kwargs):
+        return self.results[command]
+
+
+class TestWorkers(unittest.TestCase):
+
+    def test_stats(self):
+        workers = Workers(2, None, 'localhost:8888', logger)
+        workers.workers = [
+            _Worker({'tcp.start': 3, 'tcp.active': 2, 'http.parser.pure': 1},
+                    {'tcp.active': 2, 'http.parser.pure': 1}),
+            _Worker({'tcp.start': 4, 'tcp.active': 1, 'http.parser.pure': 1},
+                    {'tcp.active': 1, 'http.parser.pure': 1})]
+        # the totals are added up, not the gauges
+        self.assertEqual(workers.get_stats(),
+                         {'tcp.start': 7, 'tcp.active': 2,
+                          'http.parser.pure': 1})
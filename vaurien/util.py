@@ -1,13 +1,61 @@
+from collections import namedtuple
 from errno import EAGAIN, EWOULDBLOCK
+import select
 import sys
 import time
 import subprocess
 
-from gevent.socket import gethostbyname
+from gevent.socket import gethostbyname, socket, SOL_SOCKET, SO_REUSEADDR
+from gevent.socket import SOCK_STREAM
 from gevent.socket import error
 from gevent.socket import wait_read
 from gevent import sleep
 
+from vaurien._tls import is_tls, buffered, drain_records
+
+try:
+    from socket import SO_REUSEPORT
+except ImportError:
+    SO_REUSEPORT = None
+
+
+def _get_monotonic():
+    # Python 3.3+
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+
+    if sys.platform.startswith('linux'):
+        import ctypes
+        import ctypes.util
+
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long),
+                        ('tv_nsec', ctypes.c_long)]
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                               use_errno=True)
+            clock_gettime = libc.clock_gettime
+        except (OSError, AttributeError):
+            return time.time
+
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        CLOCK_MONOTONIC = 1
+
+        def monotonic():
+            spec = timespec()
+            clock_gettime(CLOCK_MONOTONIC, ctypes.byref(spec))
+            return spec.tv_sec + spec.tv_nsec * 1e-9
+
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(timespec())) == 0:
+            return monotonic
+
+    return time.time
+
+
+#: seconds from a clock that never goes back, to measure durations.
+monotonic = _get_monotonic()
+
 
 class ImportStringError(ImportError):
     """Provides information about a failed :func:`import_string` attempt."""
@@ -127,6 +175,25 @@ def get_prefixed_sections(settings, prefix, logger=None):
     return behaviors
 
 
+def get_reuse_port_listener(address, backlog=8192, type_=SOCK_STREAM):
+    """Returns a socket listening on *address* with SO_REUSEPORT set, so
+    several processes can accept connections on the same port.
+
+    With a *type_* of SOCK_DGRAM, the socket is only bound: the kernel
+    spreads the datagrams over the processes."""
+    if SO_REUSEPORT is None:
+        raise ValueError('SO_REUSEPORT is not supported on this system')
+
+    sock = socket(type=type_)
+    sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    sock.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.bind(address)
+    if type_ == SOCK_STREAM:
+        sock.listen(backlog)
+    sock.setblocking(0)
+    return sock
+
+
 _PROXIES = {}
 
 
@@ -198,6 +265,148 @@ def get_data(sock, buffer=1024):
                 wait_read(sock.fileno(), timeout=timeout)
 
 
+def is_closed(sock):
+    """Returns True if the socket was closed by vaurien or by gevent."""
+    # gevent 1.x introduced 'closed'
+    return getattr(sock, '_closed', False) or getattr(sock, 'closed', False)
+
+
+def is_alive(sock):
+    """Returns True if an idle socket can still be used.
+
+    A socket the peer closed, or that has unexpected data waiting, is
+    readable: one poll() call tells it apart from a healthy idle socket.
+    A TLS peer may also send records of its own, like session tickets.
+    """
+    if is_closed(sock):
+        return False
+    try:
+        if not is_readable(sock):
+            return True
+        return is_tls(sock) and drain_records(sock)
+    except (error, ValueError):
+        return False
+
+
+def is_readable(sock):
+    """Returns True if reading the socket would not block.
+
+    An EOF counts as readable data. Uses poll() so it works with any
+    file descriptor number, and the decrypted data a TLS socket holds.
+    """
+    if buffered(sock):
+        return True
+    poller = select.poll()
+    poller.register(sock.fileno(), select.POLLIN)
+    return len(poller.poll(0)) > 0
+
+
+def get_data_into(sock, buffer, size=None):
+    """Like :func:`get_data`, but reads into *buffer*, a bytearray or a
+    writable memoryview. Returns the number of bytes read."""
+    if size is None:
+        size = len(buffer)
+    while True:
+        try:
+            return sock.recv_into(buffer, size)
+        except error, e:
+            if e.args[0] not in (EWOULDBLOCK, EAGAIN):
+                raise
+            timeout = sock.gettimeout()
+            if timeout == 0:
+                # we are in async mode here so we just need to switch
+                sleep(0)
+            else:
+                wait_read(sock.fileno(), timeout=timeout)
+
+
+class BufferPool(object):
+    """A pool of preallocated read buffers.
+
+    Each socket gets its own buffer the first time it is read, and keeps
+    it until :meth:`put` is called, so reading a connection does not
+    allocate anything per chunk. Buffers are returned as a
+    *(bytearray, memoryview)* tuple over the same memory.
+    """
+
+    def __init__(self, size=8192, maxsize=1024):
+        self.size = size
+        self.maxsize = maxsize
+        self._free = []
+
+    def acquire(self):
+        if self._free:
+            return self._free.pop()
+        buffer = bytearray(self.size)
+        return buffer, memoryview(buffer)
+
+    def release(self, buffer):
+        if len(self._free) < self.maxsize:
+            self._free.append(buffer)
+
+    def get(self, sock):
+        """Returns the buffer bound to *sock*."""
+        buffer = getattr(sock, '_buffer', None)
+        if buffer is None or len(buffer[0]) != self.size:
+            buffer = sock._buffer = self.acquire()
+        return buffer
+
+    def put(self, sock):
+        """Gives the buffer bound to *sock* back to the pool."""
+        buffer = getattr(sock, '_buffer', None)
+        if buffer is not None:
+            sock._buffer = None
+            if len(buffer[0]) == self.size:
+                self.release(buffer)
+
+
+def convert_option(value, type_):
+    """Converts a raw option value to *type_*."""
+    if isinstance(value, type_):
+        return value
+    if type_ == bool:
+        value = value.lower()
+        return value in ('y', 'yes', '1', 'on')
+    return type_(value)
+
+
+_OPTIONS_CLASSES = {}
+
+
+def compile_options(options, settings):
+    """Returns an immutable snapshot of the values of *options* found in
+    *settings*, or their defaults, converted to the options types.
+
+    The values are read as attributes of the returned object.
+    """
+    names = tuple(sorted(options))
+    klass = _OPTIONS_CLASSES.get(names)
+    if klass is None:
+        klass = namedtuple('Options', names)
+        _OPTIONS_CLASSES[names] = klass
+
+    values = {}
+    for name, option in options.items():
+        type_, default = option[1:3]
+        values[name] = convert_option(settings.get(name, default), type_)
+    return klass(**values)
+
+
+def apply_settings(obj, settings):
+    """Updates the settings of *obj*, a behavior or a protocol, with
+    *settings*, compiles its options again and bumps its version.
+
+    The options are converted once per change of the settings, so reading
+    them is just an attribute lookup. Invalid values raise a ValueError
+    before anything is changed.
+    """
+    new_settings = dict(obj.settings)
+    new_settings.update(settings)
+    obj.opts = compile_options(obj.options, new_settings)
+    obj.settings = new_settings
+    obj.version += 1
+
+
 def extract_settings(args, prefix, name):
     settings = {}
     prefix = '%s_%s_' % (prefix, name)
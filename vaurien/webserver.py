@@ -3,11 +3,11 @@ from cornice.service import Service
 from pyramid.config import Configurator
 from pyramid.events import NewRequest
 
-from vaurien.util import parse_address
-
 behavior = Service('behavior', path='/behavior')
 behaviors = Service('behaviors', path='/behaviors')
+weights = Service('weights', path='/weights')
 backend = Service('backend', path='/backend')
+stats = Service('stats', path='/stats')
 
 @behavior.put()
 def set_behavior(request):
@@ -26,6 +26,8 @@ def set_behavior(request):
         except KeyError:
             request.errors.add('body', 'name',
                                "the '%s' behavior does not exist" % name)
+        except ValueError as error:
+            request.errors.add('body', '', str(error))
     return {'status': 'ok'}
 
 
@@ -39,6 +41,30 @@ def get_behaviors(request):
     return {'behaviors': request.proxy.get_behavior_names()}
 
 
+@weights.put()
+def set_weights(request):
+    try:
+        data = request.json
+        behavior = data['behavior']
+    except ValueError:
+        request.errors.add('body', '',
+                           'the value is not a valid json object')
+    except KeyError:
+        request.errors.add('body', '',
+                           'the value should contain a "behavior" key')
+    else:
+        try:
+            request.proxy.set_weights(behavior)
+        except ValueError as error:
+            request.errors.add('body', 'behavior', str(error))
+    return {'status': 'ok'}
+
+
+@weights.get()
+def get_weights(request):
+    return {'weights': request.proxy.get_weights()}
+
+
 def add_proxy_to_request(event):
     event.request.proxy = event.request.registry['proxy']
 
@@ -55,7 +81,7 @@ def get_config(global_config=None, **settings):
 
 @backend.get()
 def get_backend(request):
-    return {'backend': request.proxy.backend}
+    return request.proxy.get_backend_status()
 
 @backend.put()
 def set_backend(request):
@@ -68,8 +94,15 @@ def set_backend(request):
     except KeyError:
         request.errors.add('body', '',
                            'the value should contain a "backend" key')
-
-    proxy = request.proxy
-    proxy.backend = backend
-    proxy.dest = parse_address(backend)
+    else:
+        try:
+            request.proxy.set_backend(backend,
+                                      strategy=data.get('strategy'))
+        except ValueError as error:
+            request.errors.add('body', 'backend', str(error))
     return {'status': 'ok'}
+
+
+@stats.get()
+def get_stats(request):
+    return {'stats': request.proxy.get_stats()}
@@ -0,0 +1,199 @@
+"""Runs the proxy in several processes.
+
+Each worker is a forked process running its own proxy, all of them
+listening on the same address thanks to SO_REUSEPORT, so the kernel
+spreads the connections over them.
+
+The master process keeps a control socket for every worker. The
+:class:`Workers` class exposes the same API as the proxies to the HTTP
+server, and fans the calls out to the workers through those sockets.
+"""
+import os
+import json
+import signal
+import socket
+
+import gevent
+import gevent.os
+from gevent.lock import Semaphore
+from gevent.socket import socket as gsocket
+
+try:
+    from gevent import signal_handler
+except ImportError:
+    from gevent import signal as signal_handler
+
+
+# proxy methods a worker calls for the master
+_COMMANDS = ('get_behavior', 'set_behavior', 'get_behavior_names',
+             'set_weights', 'get_weights', 'set_backend',
+             'get_backend_status', 'get_stats', 'get_gauges')
+
+
+class Worker(object):
+    """A worker process, seen from the master."""
+
+    def __init__(self, pid, control):
+        self.pid = pid
+        self.control = control
+        self.lines = control.makefile()
+        self.lock = Semaphore()
+
+    def call(self, command, **kwargs):
+        request = json.dumps({'command': command, 'kwargs': kwargs})
+        with self.lock:
+            self.control.sendall(request + '\n')
+            line = self.lines.readline()
+
+        if not line:
+            raise ValueError('Worker %d is gone' % self.pid)
+
+        response = json.loads(line)
+        if 'error' in response:
+            if response['error'] == 'KeyError':
+                raise KeyError(response['message'])
+            raise ValueError(response['message'])
+        return response['result']
+
+
+class Workers(object):
+    """Forks *count* workers, each of them running the proxy returned by
+    *create_proxy*.
+    """
+
+    def __init__(self, count, create_proxy, backend, logger):
+        self.count = count
+        self.create_proxy = create_proxy
+        self.backend = backend
+        self.workers = []
+        self._logger = logger
+
+    def start(self):
+        for i in range(self.count):
+            master_end, worker_end = socket.socketpair()
+            pid = gevent.fork()
+            if pid == 0:
+                master_end.close()
+                for worker in self.workers:
+                    worker.control.close()
+                self._run_worker(gsocket(_sock=worker_end))
+
+            worker_end.close()
+            self.workers.append(Worker(pid, gsocket(_sock=master_end)))
+            self._logger.info('Started worker %d' % pid)
+
+    def _run_worker(self, control):
+        code = 0
+        try:
+            proxy = self.create_proxy()
+            gevent.spawn(self._serve_control, proxy, control)
+            proxy.serve_forever()
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        except Exception:
+            self._logger.exception('Worker %d failed' % os.getpid())
+            code = 1
+        finally:
+            os._exit(code)
+
+    def _serve_control(self, proxy, control):
+        for line in control.makefile():
+            request = json.loads(line)
+            command = request['command']
+            try:
+                if command not in _COMMANDS:
+                    raise ValueError('Unknown command %r' % command)
+                result = getattr(proxy, command)(**request['kwargs'])
+                if command == 'get_behavior':
+                    # the behavior instance stays here
+                    result = result[1]
+                response = {'result': result}
+            except KeyError, e:
+                response = {'error': 'KeyError', 'message': e.args[0]}
+            except Exception, e:
+                response = {'error': e.__class__.__name__,
+                            'message': str(e)}
+            control.sendall(json.dumps(response) + '\n')
+
+        # the master is gone
+        proxy.stop()
+
+    def serve_forever(self):
+        """Waits for the workers, and stops them on SIGTERM."""
+        main = gevent.getcurrent()
+        signal_handler(signal.SIGTERM, gevent.kill, main, SystemExit)
+        try:
+            for worker in self.workers:
+                gevent.os.waitpid(worker.pid, 0)
+                self._logger.info('Worker %d exited' % worker.pid)
+        finally:
+            self.stop()
+
+    def stop(self):
+        for worker in self.workers:
+            try:
+                os.kill(worker.pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    # the proxy API, used by the HTTP server.
+
+    def _call_all(self, command, **kwargs):
+        return [worker.call(command, **kwargs) for worker in self.workers]
+
+    def get_behavior(self):
+        return None, self.workers[0].call('get_behavior')
+
+    def set_behavior(self, **options):
+        self._call_all('set_behavior', **options)
+
+    def get_behavior_names(self):
+        return self.workers[0].call('get_behavior_names')
+
+    def set_weights(self, behavior):
+        self._call_all('set_weights', behavior=behavior)
+
+    def get_weights(self):
+        return self.workers[0].call('get_weights')
+
+    def set_backend(self, backend, strategy=None):
+        self._call_all('set_backend', backend=backend, strategy=strategy)
+        self.backend = self.workers[0].call('get_backend_status')['backend']
+
+    def get_backend_status(self):
+        """Returns the backend status, with the connections in use added
+        up across workers."""
+        status = None
+        draining = {}
+        for worker_status in self._call_all('get_backend_status'):
+            if status is None:
+                status = worker_status
+            else:
+                for total, backend in zip(status['backends'],
+                                          worker_status['backends']):
+                    total['in_use'] += backend['in_use']
+            for old in worker_status['draining']:
+                key = old['generation'], old['backend']
+                draining[key] = draining.get(key, 0) + old['in_use']
+
+        status['draining'] = [{'backend': backend, 'generation': generation,
+                               'in_use': in_use}
+                              for (generation, backend), in_use
+                              in sorted(draining.items())]
+        return status
+
+    def get_stats(self):
+        """Returns the stats of all workers: the totals are added up, the
+        gauges give the highest value of a worker."""
+        gauges = {}
+        for worker_gauges in self._call_all('get_gauges'):
+            for name, value in worker_gauges.items():
+                gauges[name] = max(gauges.get(name, value), value)
+
+        total = {}
+        for stats in self._call_all('get_stats'):
+            for name, value in stats.items():
+                if name not in gauges:
+                    total[name] = total.get(name, 0) + value
+        total.update(gauges)
+        return total